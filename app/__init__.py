@@ -87,6 +87,9 @@ def create_app(config_name="dev", with_hardcoded_prefix=True):
 
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
 
+    from app.api.instrumentation import init_instrumentation
+    init_instrumentation(app)
+
     """
         ========================================================
               Setup Flask-JWT-Extended
@@ -124,8 +127,20 @@ def create_app(config_name="dev", with_hardcoded_prefix=True):
 
     app.get_current_user = get_current_user
 
+    from app.api.http import make_http_client
+    app.http = make_http_client(app.config)
+    app.metrics.add_source("http", lambda: app.http.stats)
+
+    from app.api.manifest.cache import make_manifest_cache
     from app.api.manifest.manifest_factory import ManifestFactory
-    app.manifest_factory = ManifestFactory()
+    app.manifest_factory = ManifestFactory(cache=make_manifest_cache(app.config),
+                                           timeout=app.config.get("MANIFEST_FETCH_TIMEOUT", 10),
+                                           max_workers=app.config.get("MANIFEST_FETCH_WORKERS", 8),
+                                           http=app.http)
+    app.metrics.add_source("manifest-cache", lambda: app.manifest_factory.cache.stats)
+
+    from app.api.count_stats import CountStats
+    app.count_stats = CountStats(reconcile_interval=app.config.get("COUNT_STATS_RECONCILE_INTERVAL", 600))
 
     # =====================================
     # Import models & app routes
@@ -134,6 +149,22 @@ def create_app(config_name="dev", with_hardcoded_prefix=True):
     with app.app_context():
         from app import models
         from app import routes
+        # session listeners maintaining the collection_stats table
+        from app.api.collection import stats
+        models.CollectionStats.__table__.create(db.engine, checkfirst=True)
+        # session listeners filling the indexing_task table (ASYNC_INDEXING)
+        from app.api import indexing_queue
+        models.IndexingTask.__table__.create(db.engine, checkfirst=True)
+        # session listeners maintaining the data_version table (ETags)
+        from app.api import conditional
+        models.DataVersion.__table__.create(db.engine, checkfirst=True)
+        # session listeners rebuilding the stored IIIF resources of the modified witnesses
+        from app.api.manifest.store import IIIFStore, IIIFStoreBuilder
+        app.iiif_store = IIIFStore(app.config["IIIF_STORE_PATH"])
+        app.iiif_store_builder = IIIFStoreBuilder(app, app.iiif_store)
+
+        from app.api.compression import compress_response
+        app.after_request(compress_response)
 
         # =====================================
         # register api routes
@@ -185,6 +216,8 @@ def create_app(config_name="dev", with_hardcoded_prefix=True):
         # generate search endpoint
         app.api_url_registrar.register_count_route()
         app.api_url_registrar.register_search_route()
+        # the operations are checked by the write routes they are dispatched to
+        app.api_url_registrar.register_operations_route()
 
         #for rule in app.url_map.iter_rules():
         #    print(rule)
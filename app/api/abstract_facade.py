@@ -1,9 +1,27 @@
-from flask import current_app, request
+from collections import OrderedDict
+
+from flask import current_app, request, has_request_context
+from sqlalchemy.orm import defer
 
 from app import db
+from app.api.operations import commit
 from app.models import Collection
 
 
+def get_sparse_fields(resource_type):
+    """
+    The attributes and relationships of a resource type requested with fields[type]=a,b (sparse fieldsets)
+    Only honoured when reading: the facades of the write requests also build the indexed payloads
+    :return: the set of the requested names, None if every field is requested
+    """
+    if not has_request_context() or request.method != "GET":
+        return None
+    fields = request.args.get("fields[%s]" % resource_type)
+    if fields is None:
+        return None
+    return {f for f in fields.split(",") if f}
+
+
 class JSONAPIAbstractFacade(object):
     """
 
@@ -13,6 +31,18 @@ class JSONAPIAbstractFacade(object):
 
     ITEMS_PER_PAGE = 1000  # TODO: au delà il faut passer par l'api scroll d'elastic search
 
+    # attributes of the resource read from the indexed payload when searching with source=index
+    # (None exposes the whole payload)
+    INDEXED_ATTRIBUTES = None
+
+    # attribute -> model column which is not loaded when the attribute is left out of fields[type]
+    DEFERRABLE_ATTRIBUTES = {}
+
+    # relationships whose resources are reindexed along with this one (propagate=True)
+    PROPAGATED_RELATIONSHIPS = ()
+    # number of dependent resources loaded per query when propagating
+    PROPAGATION_BATCH_SIZE = 200
+
     def __init__(self, url_prefix, obj, with_relationships_links=True, with_relationships_data=True):
         self.obj = obj
         self.url_prefix = url_prefix
@@ -49,12 +79,76 @@ class JSONAPIAbstractFacade(object):
 
     @classmethod
     def get_index_name(cls):
+        """
+        Name of the alias pointing to the current version of the index
+        (versions are built by 'db-reindex --rebuild', see app/cli.py)
+        """
         return "{prefix}__{env}__{index_name}".format(
             prefix=current_app.config.get("INDEX_PREFIX", ""),
             env=current_app.config.get("ENV"),
             index_name=cls.TYPE_PLURAL
         )
 
+    @classmethod
+    def get_loading_options(cls):
+        """
+        SQLAlchemy loader options (selectinload, joinedload...) applied when a batch of objects
+        is loaded to be exposed by this facade, so that the relationships it walks through
+        are fetched in a constant number of queries instead of one lazy load per object
+        """
+        return []
+
+    @classmethod
+    def get_request_loading_options(cls):
+        """
+        The loading options completed with the deferral of the large columns that are not requested
+        """
+        options = list(cls.get_loading_options())
+        fields = get_sparse_fields(cls.TYPE)
+        if fields is not None:
+            options.extend(
+                defer(getattr(cls.MODEL, column))
+                for attribute, column in cls.DEFERRABLE_ATTRIBUTES.items() if attribute not in fields
+            )
+        return options
+
+    @property
+    def fields(self):
+        return get_sparse_fields(self.TYPE)
+
+    def make_attributes(self, attributes):
+        """
+        Keep the attributes requested by fields[type]
+        Callable values are getters, only called when the attribute is requested,
+        for the values that are costly to compute or that need to load something
+        """
+        fields = self.fields
+        return {
+            name: value() if callable(value) else value
+            for name, value in attributes.items() if fields is None or name in fields
+        }
+
+    @classmethod
+    def make_resource_from_index(cls, url_prefix, source, fields=None):
+        """
+        Build the resource of a search hit from its indexed payload, without loading the object
+        The values are the indexed ones (eg. text without html tags) and there is no relationship
+        :param fields: the attributes to expose (fields[type] parameter), all the indexed attributes if None
+        """
+        attributes = OrderedDict()
+        for name in cls.INDEXED_ATTRIBUTES or [k for k in source.keys() if k not in ("id", "type")]:
+            if (fields is None or name in fields) and name in source:
+                attributes[name] = source[name]
+        return {
+            **cls.make_resource_identifier(source["id"], cls.TYPE),
+            "attributes": attributes,
+            "links": {
+                "self": "{url_prefix}/{type_plural}/{id}".format(
+                    url_prefix=url_prefix, type_plural=cls.TYPE_PLURAL, id=source["id"]
+                )
+            }
+        }
+
     @property
     def meta(self):
         return {}
@@ -133,7 +227,7 @@ class JSONAPIAbstractFacade(object):
             # print("CREATING RESOURCE:", model, obj_id, attributes, related_resources)
             resource = JSONAPIAbstractFacade.post_resource(model, obj_id, attributes, related_resources)
             db.session.add(resource)
-            db.session.commit()
+            commit()
         except Exception as e:
             print(e)
             errors = {
@@ -208,7 +302,7 @@ class JSONAPIAbstractFacade(object):
             resource = JSONAPIAbstractFacade.patch_resource(obj, obj_type, attributes, related_resources, append)
             #print('patch_resource', resource)
             db.session.add(resource)
-            db.session.commit()
+            commit()
         except Exception as e:
             print('JSONAPIAbstractFacade.patch_resource failed : ', e)
             errors = {
@@ -251,7 +345,7 @@ class JSONAPIAbstractFacade(object):
                     raise AttributeError("Relationship %s does not exist" % rel_name)
 
             db.session.add(obj)
-            db.session.commit()
+            commit()
         except Exception as e:
             print(e)
             errors = {
@@ -272,7 +366,7 @@ class JSONAPIAbstractFacade(object):
                 raise ValueError("Resource does not exist")
             print("DELETING RESOURCE:", obj)
             db.session.delete(obj)
-            db.session.commit()
+            commit()
         except Exception as e:
             errors = {
                 "status": 404 if obj is None else 400,
@@ -331,13 +425,17 @@ class JSONAPIAbstractFacade(object):
         }
 
     def get_exposed_relationships(self):
+        fields = self.fields
+        relationships = {
+            rel_name: rel for rel_name, rel in self.relationships.items() if fields is None or rel_name in fields
+        }
         if self.with_relationships_data:
             return {
                 rel_name: {
                     "links": rel["links"],
                     "data": rel["resource_identifier_getter"]()
                 }
-                for rel_name, rel in self.relationships.items()
+                for rel_name, rel in relationships.items()
             }
         else:
             # do not provide relationship data, provide just the links
@@ -345,7 +443,7 @@ class JSONAPIAbstractFacade(object):
                 rel_name: {
                     "links": rel["links"],
                 }
-                for rel_name, rel in self.relationships.items()
+                for rel_name, rel in relationships.items()
             }
 
     def get_data_to_index_when_added(self, propagate):
@@ -354,46 +452,82 @@ class JSONAPIAbstractFacade(object):
     def get_data_to_index_when_removed(self, propagate):
         return []
 
-    def get_relationship_data_to_index(self, rel_name):
+    @classmethod
+    def get_data_to_index_of(cls, resource_identifiers):
+        """
+        The data to index of a set of resources, loaded by batches of PROPAGATION_BATCH_SIZE objects
+        along with the relationships their payloads are built from
+        """
         from app.api.facade_manager import JSONAPIFacadeManager
-        to_be_reindexed = []
         url_prefix = request.host_url[:-1] + current_app.api_url_registrar.url_prefix
 
-        ri = self.relationships[rel_name]['resource_identifier_getter']()
-        if ri is not None:
-            ri = [ri] if not isinstance(ri, list) else ri
+        ids_by_type = OrderedDict()
+        for resource_identifier in resource_identifiers:
+            ids_by_type.setdefault(resource_identifier["type"], OrderedDict())[resource_identifier["id"]] = None
 
-        for resource_identifier in ri:
-            facade_class = JSONAPIFacadeManager.get_facade_class_from_facade_type(resource_identifier['type'])
+        to_be_reindexed = []
+        for resource_type, ids in ids_by_type.items():
+            facade_class = JSONAPIFacadeManager.get_facade_class_from_facade_type(resource_type)
+            model = facade_class.MODEL
+            ids = list(ids)
+            for i in range(0, len(ids), cls.PROPAGATION_BATCH_SIZE):
+                batch = ids[i:i + cls.PROPAGATION_BATCH_SIZE]
+                objs = model.query.options(*facade_class.get_loading_options()).filter(model.id.in_(batch)).all()
+                for obj in objs:
+                    to_be_reindexed.extend(facade_class(url_prefix, obj).get_data_to_index_when_added(False) or [])
+        return to_be_reindexed
 
-            f_obj, kwargs, errors = facade_class.get_resource_facade(url_prefix, id=resource_identifier['id'])
-            to_be_reindexed.extend(
-                f_obj.get_data_to_index_when_added(False)
-            )
+    def get_relationship_data_to_index(self, rel_name):
+        ri = self.relationships[rel_name]['resource_identifier_getter']()
+        if ri is None:
+            return []
+        return self.get_data_to_index_of(ri if isinstance(ri, list) else [ri])
 
-        return to_be_reindexed
+    def get_propagated_data_to_index(self):
+        """ The data to index of the resources depending on this one, each of them being built once """
+        return self.get_data_to_index_of(self.get_propagated_resource_identifiers())
 
-    def add_to_index(self, propagate=False):
+    def reindex_updated_attributes(self, attributes):
+        """
+        Reindex the resource after a change of its attributes only, its relationships being unchanged.
+        The facades whose attributes are copied into other payloads can patch these copies in place
+        instead of rebuilding the dependent resources
+        :param attributes: the updated attributes
+        """
+        self.reindex("update", propagate=True)
+
+    def get_propagated_resource_identifiers(self):
+        """ The resources reindexed along with this one, as resource identifiers """
+        identifiers = []
+        for rel_name in self.PROPAGATED_RELATIONSHIPS:
+            ri = self.relationships[rel_name]["resource_identifier_getter"]()
+            if ri is not None:
+                identifiers.extend(ri if isinstance(ri, list) else [ri])
+        return identifiers
+
+    def add_to_index(self, propagate=False, indexer=None):
         from app.api.search import SearchIndexManager
         for data in self.get_data_to_index_when_added(propagate):
-            SearchIndexManager.add_to_index(index=data["index"], id=data["id"], payload=data["payload"])
+            SearchIndexManager.add_to_index(index=data["index"], id=data["id"], payload=data["payload"],
+                                            indexer=indexer)
 
-    def remove_from_index(self, propagate=False):
+    def remove_from_index(self, propagate=False, indexer=None):
         from app.api.search import SearchIndexManager
         for data in self.get_data_to_index_when_removed(propagate):
-            SearchIndexManager.remove_from_index(index=data["index"], id=data["id"])
+            SearchIndexManager.remove_from_index(index=data["index"], id=data["id"], indexer=indexer)
 
-    def reindex(self, op, propagate=False):
+    def reindex(self, op, propagate=False, indexer=None):
         """
 
         :param op:
         :param propagate:  if True then reindex related indexes too
+        :param indexer: a BulkIndexer buffering the index writes, which are sent one by one otherwise
         :return:
         """
         if op in ("insert", "update"):
-            self.add_to_index(propagate)
+            self.add_to_index(propagate, indexer=indexer)
         else:
-            self.remove_from_index(propagate)
+            self.remove_from_index(propagate, indexer=indexer)
 
 
 class JSONAPIAbstractChangeloggedFacade(JSONAPIAbstractFacade):
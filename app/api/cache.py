@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A thread safe LRU cache whose entries expire after ttl seconds (never if ttl is None)
+    get, set and pop are O(1); the least recently used entry is evicted when maxsize is reached
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiration time, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expiration, value = entry
+                if expiration is None or expiration > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expiration = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[key] = (expiration, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return entry[1] if entry is not None else default
+
+    def invalidate(self, predicate):
+        """ Drop the entries whose key matches the predicate """
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def stats(self):
+        return {"size": len(self.entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
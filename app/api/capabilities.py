@@ -5,10 +5,11 @@ from app import JSONAPIResponseFactory
 
 COLLECTIONS_PARAMETERS = {
     "search": "search[fieldname1,fieldname2]=expression ou search=expression pour chercher parmis tous les champs indexés",
-    "filter": "filter[field_name]=searched_value. Le nom du champs DOIT être un des champs du model",
+    "filter": "filter[field_name]=searched_value ou filter[field_name][op]=value avec op parmi eq, prefix, contains, in, range. Le nom du champs DOIT être un des champs du model",
     "sort": "sort=field1,field2,field3. Le tri respecte l'ordre des champs. Utiliser - pour effectuer un tri descendant",
-    "page": "page[number]=3&page[size]=10. La pagination nécessite page[number], page[size] ou les deux paramètres en même temps. La taille ne peut pas excéder la limite inscrite dans la facade correspondante. La pagination produit des liens de navigation prev,next,self,first,last dans tous les cas où cela a du sens.",
+    "page": "page[number]=3&page[size]=10. La pagination nécessite page[number], page[size] ou les deux paramètres en même temps. La taille ne peut pas excéder la limite inscrite dans la facade correspondante. La pagination produit des liens de navigation prev,next,self,first,last dans tous les cas où cela a du sens. page[after]=curseur active la pagination par curseur (lien next uniquement, total calculé seulement avec meta[count]).",
     "include": "include=relation1,relation2. Le document retourné incluera les ressources liées à la présente ressource. Il n'est pas possible d'inclure une relation indirecte (ex: model.relation1.relation2)",
+    "fields": "fields[type]=attribut1,relation1. Seuls les attributs et relations listés sont calculés et retournés pour les ressources de ce type, y compris les ressources incluses (fields[type]= pour n'en retourner aucun).",
     "lightweight": "Ce paramètre n'a pas de valeur. Sa seule présence dans l'URL permet d'obtenir une version allégée du document (les relations ne sont pas incluses dans la réponse)."
 }
 
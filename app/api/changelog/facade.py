@@ -19,13 +19,13 @@ class ChangelogFacade(JSONAPIAbstractFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "object-id": self.obj.object_id,
                 "object-type": self.obj.object_type,
 
                 "event-date": datetime_to_str(self.obj.event_date),
                 "description": self.obj.description,
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -1,6 +1,9 @@
 from flask import current_app
+from sqlalchemy.orm import selectinload
 
 from app.api.abstract_facade import JSONAPIAbstractChangeloggedFacade
+from app.api.collection.stats import get_collection_stats
+from app.api.indexing_queue import is_async_indexing
 from app.api.user.facade import UserFacade
 from app.api.document.facade import DocumentFacade
 from app.models import Collection, User
@@ -12,6 +15,7 @@ class CollectionFacade(JSONAPIAbstractChangeloggedFacade):
     """
     TYPE = "collection"
     TYPE_PLURAL = "collections"
+    PROPAGATED_RELATIONSHIPS = ("documents",)
 
     MODEL = Collection
 
@@ -19,6 +23,15 @@ class CollectionFacade(JSONAPIAbstractChangeloggedFacade):
     def id(self):
         return self.obj.id
 
+    @classmethod
+    def get_loading_options(cls):
+        return [
+            selectinload(Collection.changes),
+            selectinload(Collection.children),
+            selectinload(Collection.admin),
+            selectinload(Collection.stats),
+        ]
+
     #@staticmethod
     #def get_resource_facade(url_prefix, id, **kwargs):
     #    e = Collection.query.filter(Collection.id == id).first()
@@ -71,45 +84,23 @@ class CollectionFacade(JSONAPIAbstractChangeloggedFacade):
 
     @property
     def resource(self):
-        #user = current_app.get_current_user()
-        #if user:
-        if not self.obj.documents_including_children:
-            date_min = None
-            date_max = date_min
-        else:
-            creation = [
-                doc.creation for doc in self.obj.documents_including_children
-                if doc.creation
-            ]
-            date_min = min(creation) if creation else None
-            date_max = max(creation) if creation else None
-        #else:
-        if not self.obj.published_including_children:
-            date_min_pub = None
-            date_max_pub = date_min_pub
-        else:
-            creation = [
-                doc.creation for doc in self.obj.published_including_children
-                if doc.creation
-            ]
-            date_min_pub = min(creation) if creation else None
-            date_max_pub = max(creation) if creation else None
+        stats = get_collection_stats(self.obj)
 
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "title": self.obj.title,
-                "path": [c.title for c in self.obj.parents] + [self.obj.title],
+                "path": lambda: [c.title for c in self.obj.parents] + [self.obj.title],
                 "description": self.obj.description,
-                "nb_docs": len(self.obj.documents_including_children),
-                "nb_pub_docs": len(self.obj.published_including_children),
+                "nb_docs": stats["nb_docs"],
+                "nb_pub_docs": stats["nb_pub_docs"],
                 #"parents": [c.id for c in self.obj.parents],
                 #"childrens": [c.id for c in self.obj.children_including_children],
-                "date_min": date_min,
-                "date_max": date_max,
-                "date_min_pub": date_min_pub,
-                "date_max_pub": date_max_pub
-            },
+                "date_min": stats["date_min"],
+                "date_max": stats["date_max"],
+                "date_min_pub": stats["date_min_pub"],
+                "date_max_pub": stats["date_max_pub"]
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -178,25 +169,26 @@ class CollectionFacade(JSONAPIAbstractChangeloggedFacade):
         if not propagate:
             return collection_data
         else:
-            return collection_data + self.get_relationship_data_to_index(rel_name="documents")
+            return collection_data + self.get_propagated_data_to_index()
 
-    def remove_from_index(self, propagate):
+    def remove_from_index(self, propagate, indexer=None):
         from app.api.search import SearchIndexManager
-        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id)
+        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id, indexer=indexer)
 
         if propagate:
             # reindex the docs without the resource
             for data in self.get_data_to_index_when_added(propagate):
                 if data["payload"]["id"] != self.id and data["payload"]["type"] != self.TYPE:
                     data["payload"]["collections"] = [l for l in data["payload"]["collections"] if l.get("id") != self.id]
-                    SearchIndexManager.add_to_index(index=data["index"], id=data["id"], payload=data["payload"])
+                    SearchIndexManager.add_to_index(index=data["index"], id=data["id"], payload=data["payload"],
+                                                    indexer=indexer)
 
-    def reindex(self, op, propagate=False):
+    def reindex(self, op, propagate=False, indexer=None):
         if op == "update":
             # Updates of collection metadata shouldn't impact linked documents
-            self.add_to_index(False)
+            self.add_to_index(False, indexer=indexer)
         else:
-            super().reindex(op, propagate)
+            super().reindex(op, propagate, indexer=indexer)
 
     @staticmethod
     def delete_resource(obj):
@@ -234,7 +226,8 @@ class CollectionFacade(JSONAPIAbstractChangeloggedFacade):
                 attributes={},
                 related_resources={"collections": collections}
             )
-            DocumentFacade("", document).reindex("update", propagate=True)
+            if not is_async_indexing():
+                DocumentFacade("", document).reindex("update", propagate=True)
         # delete all collections
         # remove child collections before parent collections
         collections_to_remove.sort(key=lambda c: c.id, reverse=True)
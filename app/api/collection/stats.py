@@ -0,0 +1,169 @@
+from sqlalchemy import event, select, func, case, distinct, inspect
+from sqlalchemy.orm import attributes
+
+from app import db
+from app.models import Collection, CollectionStats, Document, association_document_has_collection
+
+_PENDING_KEY = "collection_stats_pending"
+
+STATS_FIELDS = ("nb_docs", "nb_pub_docs", "date_min", "date_max", "date_min_pub", "date_max_pub")
+
+
+def compute_collection_stats(connection, collection_ids):
+    """
+    Compute the stats of the given collections, documents of their sub-collections included
+    :return: a dict collection_id -> stats dict
+    """
+    if not collection_ids:
+        return {}
+
+    collection = Collection.__table__
+    document = Document.__table__
+    dhc = association_document_has_collection
+
+    subtree = select(collection.c.id.label("root_id"), collection.c.id.label("id")) \
+        .where(collection.c.id.in_(list(collection_ids))) \
+        .cte("subtree", recursive=True)
+    subtree = subtree.union(
+        select(subtree.c.root_id, collection.c.id).where(collection.c.parent_id == subtree.c.id)
+    )
+
+    # empty creation dates are ignored, like documents without a date
+    creation = func.nullif(document.c.creation, "")
+    published = document.c.is_published == True
+
+    stmt = select(
+        subtree.c.root_id,
+        func.count(distinct(document.c.id)),
+        func.count(distinct(case((published, document.c.id)))),
+        func.min(creation),
+        func.max(creation),
+        func.min(case((published, creation))),
+        func.max(case((published, creation))),
+    ).select_from(
+        subtree.join(dhc, dhc.c.collection_id == subtree.c.id).join(document, document.c.id == dhc.c.document_id)
+    ).group_by(subtree.c.root_id)
+
+    stats = {c_id: dict(zip(STATS_FIELDS, (0, 0, None, None, None, None))) for c_id in collection_ids}
+    for row in connection.execute(stmt):
+        stats[row[0]] = dict(zip(STATS_FIELDS, row[1:]))
+    return stats
+
+
+def get_ancestor_ids(connection, collection_ids):
+    """
+    :return: the given collection ids and the ids of all their parents
+    """
+    collection = Collection.__table__
+    parents = dict(connection.execute(select(collection.c.id, collection.c.parent_id)).fetchall())
+    ids = set()
+    for c_id in collection_ids:
+        while c_id is not None and c_id not in ids:
+            ids.add(c_id)
+            c_id = parents.get(c_id)
+    return {c_id for c_id in ids if c_id in parents}
+
+
+def refresh_collection_stats(connection, collection_ids=None):
+    """
+    Recompute and store the stats of the given collections (every collection if None)
+    """
+    table = CollectionStats.__table__
+    if collection_ids is None:
+        collection_ids = [c_id for (c_id,) in connection.execute(select(Collection.__table__.c.id))]
+        connection.execute(table.delete())
+    else:
+        collection_ids = list(collection_ids)
+        if not collection_ids:
+            return
+        connection.execute(table.delete().where(table.c.collection_id.in_(collection_ids)))
+
+    stats = compute_collection_stats(connection, collection_ids)
+    if stats:
+        connection.execute(table.insert(), [{"collection_id": c_id, **s} for c_id, s in stats.items()])
+
+
+def get_collection_stats(collection):
+    """
+    Read the precomputed stats of a collection, or compute them when they have not been stored yet
+    """
+    if collection.stats is not None:
+        return {field: getattr(collection.stats, field) for field in STATS_FIELDS}
+    return compute_collection_stats(db.session.connection(), [collection.id])[collection.id]
+
+
+def _has_changes(obj, *keys):
+    state = inspect(obj)
+    return any(state.attrs[key].history.has_changes() for key in keys)
+
+
+def _document_collection_ids(session, document):
+    dhc = association_document_has_collection
+    ids = set()
+    if document.id is not None:
+        ids.update(c_id for (c_id,) in session.connection().execute(
+            select(dhc.c.collection_id).where(dhc.c.document_id == document.id)
+        ))
+    history = attributes.get_history(document, "collections")
+    ids.update(c.id for c in list(history.added or ()) + list(history.deleted or ()) if c.id is not None)
+    return ids
+
+
+@event.listens_for(db.session, "before_flush")
+def _collect_affected_collections(session, flush_context, instances):
+    """
+    Find out which collections see their documents change during the flush:
+    documents (un)published, redated, added to or removed from a collection,
+    collections moved in the hierarchy
+    """
+    pending = session.info.setdefault(_PENDING_KEY, {"ids": set(), "new": []})
+    moved = set()
+
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, Document):
+                pending["ids"].update(_document_collection_ids(session, obj))
+            elif isinstance(obj, Collection):
+                pending["new"].append(obj)
+
+        for obj in session.dirty:
+            if isinstance(obj, Document):
+                if _has_changes(obj, "is_published", "creation", "collections"):
+                    pending["ids"].update(_document_collection_ids(session, obj))
+            elif isinstance(obj, Collection):
+                if _has_changes(obj, "documents"):
+                    pending["ids"].add(obj.id)
+                # the parent_id column is only synchronized with the parent relationship during the flush
+                if _has_changes(obj, "parent_id", "parent"):
+                    moved.add(obj.id)
+                if _has_changes(obj, "children"):
+                    history = attributes.get_history(obj, "children")
+                    moved.add(obj.id)
+                    moved.update(c.id for c in list(history.added or ()) + list(history.deleted or ()))
+
+        for obj in session.deleted:
+            if isinstance(obj, Document):
+                pending["ids"].update(_document_collection_ids(session, obj))
+            elif isinstance(obj, Collection) and obj.parent_id is not None:
+                pending["ids"].add(obj.parent_id)
+
+        # the previous ancestors of the moved collections are read from the database before it changes,
+        # the new ones are found after the flush
+        moved.discard(None)
+        if moved:
+            pending["ids"].update(get_ancestor_ids(session.connection(), moved))
+
+
+@event.listens_for(db.session, "after_flush_postexec")
+def _refresh_affected_collections(session, flush_context):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+
+    ids = {c_id for c_id in pending["ids"] if c_id is not None}
+    ids.update(c.id for c in pending["new"] if c.id is not None)
+    if not ids:
+        return
+
+    connection = session.connection()
+    refresh_collection_stats(connection, get_ancestor_ids(connection, ids))
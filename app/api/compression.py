@@ -0,0 +1,91 @@
+"""
+Compression of the responses (gzip, or brotli when the brotli package is installed),
+negotiated with the Accept-Encoding header of the request. The streamed responses are
+compressed chunk by chunk
+"""
+
+import zlib
+
+from flask import current_app, request
+
+try:
+    # optional, better compression ratio than gzip
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/vnd.api+json", "application/ld+json",
+                          "application/xml", "text/html", "text/plain", "text/xml")
+
+
+def get_supported_encodings():
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate_encoding():
+    """ :return: the content coding of the response ("br", "gzip") or None """
+    if not current_app.config.get("COMPRESS_RESPONSES"):
+        return None
+    return request.accept_encodings.best_match(get_supported_encodings())
+
+
+class Compressor(object):
+
+    def __init__(self, encoding, level=6):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=min(level, 11))
+        else:
+            # wbits=31: gzip container
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        """ Compress a chunk and flush it, so that it can be sent right away """
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+def iter_compressed(chunks, encoding, level=6):
+    compressor = Compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response):
+    """ after_request handler compressing the response when the client accepts it """
+    if request.method == "HEAD" or response.status_code != 200 or response.direct_passthrough \
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    level = current_app.config.get("COMPRESS_LEVEL", 6)
+    if response.is_streamed:
+        response.response = iter_compressed(response.response, encoding, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config.get("COMPRESS_MIN_SIZE", 1024):
+            response.vary.add("Accept-Encoding")
+            return response
+        compressor = Compressor(encoding, level)
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
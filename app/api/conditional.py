@@ -0,0 +1,93 @@
+"""
+Conditional GET requests (ETag / If-None-Match)
+
+The ETags are derived from a version of the whole database, stored in the data_version table
+and incremented within every flush that writes a model. A resource embeds data of its related
+resources (relationships, included resources, labels of the persons of a document...), so the
+version of its own row would not tell whether its representation changed.
+The locks expire without any write: the next expiration date is part of the version as well.
+When the client already holds the representation of the current version, the 304 response is
+sent before any facade is built.
+"""
+
+import datetime
+import hashlib
+from functools import wraps
+
+from flask import current_app, request, Response
+from sqlalchemy import event, func, select
+
+from app import db
+from app.api.compression import negotiate_encoding
+from app.models import DataVersion, IndexingTask, Lock
+
+DATA_VERSION_ID = 1
+
+# models whose writes do not change any representation
+UNVERSIONED_MODELS = (DataVersion, IndexingTask)
+
+
+def get_data_version():
+    """ :return: (version of the data, next expiration date of a lock) """
+    version = select(DataVersion.__table__.c.version) \
+        .where(DataVersion.__table__.c.id == DATA_VERSION_ID).scalar_subquery()
+    next_expiration = select(func.min(Lock.__table__.c.expiration_date)) \
+        .where(Lock.__table__.c.expiration_date > datetime.datetime.now()).scalar_subquery()
+    return tuple(db.session.execute(select(version, next_expiration)).one())
+
+
+def _is_versioned_write(session):
+    for obj in list(session.new) + list(session.deleted):
+        if not isinstance(obj, UNVERSIONED_MODELS):
+            return True
+    for obj in session.dirty:
+        if not isinstance(obj, UNVERSIONED_MODELS) and session.is_modified(obj):
+            return True
+    return False
+
+
+def bump_data_version(connection):
+    """ Increment the version of the data, for the changes of the representations made outside of a flush """
+    table = DataVersion.__table__
+    result = connection.execute(
+        table.update().where(table.c.id == DATA_VERSION_ID).values(version=table.c.version + 1)
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert(), {"id": DATA_VERSION_ID, "version": 1})
+
+
+@event.listens_for(db.session, "after_flush")
+def _bump_data_version(session, flush_context):
+    if not _is_versioned_write(session):
+        return
+    bump_data_version(session.connection())
+
+
+def make_etag(version, encoding):
+    """ The representation depends on the data, on the requested url and on its content coding """
+    key = "\0".join((str(version), request.url, encoding or "identity"))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def conditional_response(endpoint):
+    """
+    Wrap a GET endpoint so that it answers 304 Not Modified to the requests whose If-None-Match
+    holds the ETag of the current version of the data
+    """
+    @wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        if not current_app.config.get("CONDITIONAL_REQUESTS"):
+            return endpoint(*args, **kwargs)
+
+        # the version is read before the data, a concurrent write then only makes the ETag older
+        etag = make_etag(get_data_version(), negotiate_encoding())
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = current_app.make_response(endpoint(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.vary.add("Accept-Encoding")
+        return response
+    return wrapper
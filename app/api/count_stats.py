@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import Counter
+
+from elasticsearch.helpers import scan
+from flask import current_app
+
+# the fields of the indexed documents the counters are computed from
+SOURCE_FIELDS = ["is-published", "persons.id", "placenames.id", "collections.id", "collections.parents"]
+
+
+def get_document_keys(source):
+    """
+    :return: the persons, placenames and collections a document of the index counts for
+    """
+    source = source or {}
+    collections = set()
+    for c in source.get("collections") or []:
+        collections.add(str(c["id"]))
+        collections.update(str(p) for p in c.get("parents") or [])
+    return {
+        "persons": {str(p["id"]) for p in source.get("persons") or []},
+        "placenames": {str(p["id"]) for p in source.get("placenames") or []},
+        "collections": collections,
+    }
+
+
+class CountStats(object):
+    """
+    Counters of the landing page (/count): number of documents, persons, placenames and collections,
+    for all the documents and for the published ones only.
+
+    The contribution of every indexed document (published or not, the persons, placenames and
+    collections it counts for) is kept in memory, so that the counters are updated without reading
+    the index when a document is indexed or removed. They are rebuilt from a scan of the index every
+    reconcile_interval seconds (writes done by other processes, such as db-reindex, are picked up then):
+    a single scan runs at a time, in the background once the counters are loaded, the previous counters
+    being served meanwhile. The updates received during a scan are replayed over its result
+    """
+
+    FIELDS = ("persons", "placenames", "collections")
+
+    def __init__(self, reconcile_interval=600):
+        self.reconcile_interval = reconcile_interval
+        self.lock = threading.Lock()
+        # held while the counters are loaded for the first time
+        self.load_lock = threading.Lock()
+        self.documents = None  # id -> contribution of the document
+        self.counters = None  # published (bool) -> {"documents": int, "persons": Counter, ...}
+        self.reconciled_at = None
+        # (id, contribution) of the updates received during the running scan, None when no scan is running
+        self.pending_updates = None
+
+    @staticmethod
+    def get_contribution(source):
+        """ :return: (published, keys) of an indexed document """
+        source = source or {}
+        return bool(source.get("is-published")), get_document_keys(source)
+
+    @staticmethod
+    def _apply(counters, contribution, delta):
+        published, keys = contribution
+        for variant in ((False, True) if published else (False,)):
+            variant_counters = counters[variant]
+            variant_counters["documents"] += delta
+            for field in CountStats.FIELDS:
+                for key in keys[field]:
+                    variant_counters[field][key] += delta
+                    if variant_counters[field][key] <= 0:
+                        del variant_counters[field][key]
+
+    @staticmethod
+    def _replace(documents, counters, id, contribution):
+        old_contribution = documents.pop(id, None)
+        if old_contribution is not None:
+            CountStats._apply(counters, old_contribution, -1)
+        if contribution is not None:
+            documents[id] = contribution
+            CountStats._apply(counters, contribution, +1)
+
+    def reconcile(self):
+        """
+        Rebuild the counters from a scan of the index
+        :return: False if another scan is already running
+        """
+        with self.lock:
+            if self.pending_updates is not None:
+                return False
+            self.pending_updates = []
+        try:
+            index = current_app.config["DEFAULT_INDEX_NAME"]
+            documents = {
+                hit["_id"]: self.get_contribution(hit.get("_source"))
+                for hit in scan(current_app.elasticsearch, index=index, query={"query": {"match_all": {}}},
+                                _source_includes=SOURCE_FIELDS, size=5000)
+            }
+            counters = {published: {"documents": 0, **{field: Counter() for field in CountStats.FIELDS}}
+                        for published in (False, True)}
+            for contribution in documents.values():
+                self._apply(counters, contribution, +1)
+            with self.lock:
+                # the scan may have missed these updates
+                for id, contribution in self.pending_updates:
+                    self._replace(documents, counters, id, contribution)
+                self.documents = documents
+                self.counters = counters
+                self.reconciled_at = time.monotonic()
+            return True
+        finally:
+            with self.lock:
+                self.pending_updates = None
+
+    def reconcile_in_background(self):
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                try:
+                    self.reconcile()
+                except Exception as e:
+                    print("WARNING: cannot reconcile the count stats:", str(e))
+                    # keep serving the previous counters, try again after reconcile_interval
+                    self.reconciled_at = time.monotonic()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self, published=False):
+        if self.counters is None:
+            # the first requests wait for the first scan, which only one of them runs
+            with self.load_lock:
+                if self.counters is None:
+                    self.reconcile()
+        elif time.monotonic() - self.reconciled_at > self.reconcile_interval and self.pending_updates is None:
+            self.reconcile_in_background()
+        with self.lock:
+            counters = self.counters[bool(published)]
+            return {
+                "documents": counters["documents"],
+                "persons": len(counters["persons"]),
+                "placenames": len(counters["placenames"]),
+                "collections": len(counters["collections"]),
+            }
+
+    def update(self, id, source):
+        """
+        Replace the contribution of a document by the one of its new source (None if it has been removed)
+        """
+        contribution = self.get_contribution(source) if source is not None else None
+        with self.lock:
+            if self.pending_updates is not None:
+                self.pending_updates.append((str(id), contribution))
+            if self.documents is None:
+                # nothing loaded yet, the first scan will see the change
+                return
+            self._replace(self.documents, self.counters, str(id), contribution)
@@ -1,9 +1,12 @@
 import re
 from flask import current_app, request
+from sqlalchemy.orm import selectinload, joinedload
 
 from app.api.abstract_facade import JSONAPIAbstractChangeloggedFacade
+from app.api.manifest.store import schedule_build
 from app.api.witness.facade import WitnessFacade
-from app.models import Document, WITNESS_STATUS_VALUES, datetime_to_str
+from app.models import Document, WITNESS_STATUS_VALUES, datetime_to_str, Witness, Lock, PersonHasRole, \
+    PlacenameHasRole
 
 clean_tags = re.compile('<.*?>')
 clean_notes = re.compile('\[\d+\]')
@@ -27,10 +30,37 @@ class DocumentFacade(JSONAPIAbstractChangeloggedFacade):
 
     MODEL = Document
 
+    # the attributes of DocumentSearchFacade, as indexed ("creation" is the sort date, no witness manifest url)
+    INDEXED_ATTRIBUTES = (
+        "title", "argument", "creation", "creation-not-after", "transcription", "address", "is-published",
+        "witnesses", "senders", "recipients", "location_dates_from", "location_dates_to"
+    )
+
+    DEFERRABLE_ATTRIBUTES = {"transcription": "transcription", "argument": "argument", "address": "address"}
+
     @property
     def id(self):
         return self.obj.id
 
+    @classmethod
+    def get_loading_options(cls):
+        return [
+            selectinload(Document.witnesses).selectinload(Witness.images),
+            selectinload(Document.languages),
+            selectinload(Document.collections_list),
+            selectinload(Document.notes),
+            selectinload(Document.changes),
+            selectinload(Document.prev_document),
+            selectinload(Document.next_document),
+            selectinload(Document.locks).joinedload(Lock.user),
+            selectinload(Document.persons_having_roles).options(
+                joinedload(PersonHasRole.person), joinedload(PersonHasRole.person_role)
+            ),
+            selectinload(Document.placenames_having_roles).options(
+                joinedload(PlacenameHasRole.placename), joinedload(PlacenameHasRole.placename_role)
+            ),
+        ]
+
     def get_persons_having_roles_resource_identifiers(self, rel_facade=None):
         from app.api.person_has_role.facade import PersonHasRoleFacade
         rel_facade = PersonHasRoleFacade if not rel_facade else rel_facade
@@ -169,10 +199,12 @@ class DocumentFacade(JSONAPIAbstractChangeloggedFacade):
         canvas_ids = [img.canvas_id for img in w[0].images]
         if len(canvas_ids) == 0:
             return None
-        f_obj, errors, kwargs = WitnessFacade.get_facade('', w[0])
-        manifest, canvas_id = WitnessFacade.get_iiif_manifest(f_obj)
-        print("\nmanifest, canvas_id : ", manifest, canvas_id)
-        return manifest
+        # the manifests are never built while serving a request (see app/api/manifest/store.py)
+        stored = current_app.iiif_store.get_manifest(w[0].id)
+        if stored is None:
+            schedule_build([self.obj.id])
+            return None
+        return stored.json()
 
     def get_iiif_collection_url(self):
         #return "https://iiif.chartes.psl.eu/collections/encpos/encpos_1892.json"
@@ -181,38 +213,32 @@ class DocumentFacade(JSONAPIAbstractChangeloggedFacade):
         return f"{host}{prefix}/documents/{self.obj.id}/collection"
 
     def get_iiif_thumbnail(self):
-        for w in self.obj.witnesses:
-            canvas_ids = [img.canvas_id for img in w.images]
-            if canvas_ids:
-                from app.api.witness.facade import WitnessFacade
-                f_obj, errors, kwargs = WitnessFacade.get_facade('', w)
-                manifest_url = f_obj.get_iiif_manifest_url()
-                if manifest_url:
-                    canvases = current_app.manifest_factory.fetch_canvas(manifest_url, canvas_ids, cache=True)
-                    for c in canvases:
-                        if "thumbnail" in c:
-                            return c["thumbnail"]["@id"]
-        return None
+        if not any(w.images for w in self.obj.witnesses):
+            return None
+        is_built, thumbnail_url = current_app.iiif_store.get_thumbnail_url(self.obj.id)
+        if not is_built:
+            schedule_build([self.obj.id])
+        return thumbnail_url
 
     @property
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "title": self.obj.title,
-                "argument": self.obj.argument,
+                "argument": lambda: self.obj.argument,
                 "creation": self.obj.creation,
                 "creation-not-after": self.obj.creation_not_after,
                 "creation-label": self.obj.creation_label,
-                "transcription": self.obj.transcription,
-                "address": self.obj.address,
+                "transcription": lambda: self.obj.transcription,
+                "address": lambda: self.obj.address,
 
                 "is-published": False if self.obj.is_published is None else self.obj.is_published,
 
-                "iiif-base-witness-manifest-url": self.get_first_witness_manifest_url(),
-                "iiif-collection-url": self.get_iiif_collection_url(),
-                "iiif-thumbnail-url": self.get_iiif_thumbnail()
-            },
+                "iiif-base-witness-manifest-url": lambda: self.get_first_witness_manifest_url(),
+                "iiif-collection-url": lambda: self.get_iiif_collection_url(),
+                "iiif-thumbnail-url": lambda: self.get_iiif_thumbnail()
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -281,6 +307,8 @@ class DocumentFacade(JSONAPIAbstractChangeloggedFacade):
             "current-lock": (LockFacade, False)
         }.items():
             u_rel_name = rel_name.replace("-", "_")
+            if u_rel_name == "collections":
+                u_rel_name = "collections_list"
 
             self.relationships[rel_name] = {
                 "links": self._get_links(rel_name=rel_name),
@@ -342,7 +370,7 @@ class DocumentFacade(JSONAPIAbstractChangeloggedFacade):
                     "id": c.id,
                     "parents": [parent.id for parent in c.parents] if c.parents else None
                 }
-                for c in self.obj.collections
+                for c in self.obj.collections_list
             ],
             "persons": [
                 {
@@ -436,16 +464,16 @@ class DocumentFrontFacade(DocumentFacade):
         """
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "title": self.obj.title,
                 "creation": self.obj.creation,
                 "creation-label": self.obj.creation_label,
                 "creation-not-after": self.obj.creation_not_after,
-                "argument": self.obj.argument,
-                "address": self.obj.address,
-                "transcription": self.obj.transcription,
+                "argument": lambda: self.obj.argument,
+                "address": lambda: self.obj.address,
+                "transcription": lambda: self.obj.transcription,
                 "is-published": False if self.obj.is_published is None else self.obj.is_published,
-                "currentLock": {
+                "currentLock": lambda: {
                     "id": self.obj.current_lock.id,
                     "description": self.obj.current_lock.description,
                     "event-date": datetime_to_str(self.obj.current_lock.event_date),
@@ -454,18 +482,18 @@ class DocumentFrontFacade(DocumentFacade):
                     "object-type": self.obj.current_lock.object_type,
                     "is-active": self.obj.current_lock.is_active,
                 } if self.obj.current_lock else None,
-                "witnesses": [{"id": w.id, "content": w.content, "classification-mark": w.classification_mark, "manifest_url": self.get_witness_manifest_url(w.id), "manifest": self.get_iiif_manifest(w.id), "num": w.num, "status": w.status, "tradition": w.tradition} for w in sorted(self.obj.witnesses, key=lambda k: k.num) if self.obj.witnesses],
-                "notes": [{"id": n.id, "content": n.content, "occurences": n.occurences} for n in self.obj.notes],
-                "languages": [{"id": l.id, "code": l.code, "label": l.label} for l in self.obj.languages],
-                "collections": [
+                "witnesses": lambda: [{"id": w.id, "content": w.content, "classification-mark": w.classification_mark, "manifest_url": self.get_witness_manifest_url(w.id), "manifest": self.get_iiif_manifest(w.id), "num": w.num, "status": w.status, "tradition": w.tradition} for w in sorted(self.obj.witnesses, key=lambda k: k.num) if self.obj.witnesses],
+                "notes": lambda: [{"id": n.id, "content": n.content, "occurences": n.occurences} for n in self.obj.notes],
+                "languages": lambda: [{"id": l.id, "code": l.code, "label": l.label} for l in self.obj.languages],
+                "collections": lambda: [
                     {
                         "id": c.id,
                         "title": c.title,
                         "description": c.description,
                     }
-                    for c in self.obj.collections
+                    for c in self.obj.collections_list
                 ],
-                "persons": [
+                "persons": lambda: [
                     {
                         "person":
                             {
@@ -488,7 +516,7 @@ class DocumentFrontFacade(DocumentFacade):
                     }
                     for c_h_r in self.obj.persons_having_roles
                 ],
-                "placenames": [
+                "placenames": lambda: [
                     {
                         "placename":
                             {
@@ -513,7 +541,7 @@ class DocumentFrontFacade(DocumentFacade):
                     }
                     for c_h_r in self.obj.placenames_having_roles
                 ],
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -537,17 +565,17 @@ class DocumentSearchFacade(DocumentFacade):
         """
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "title": self.obj.title,
-                "argument": self.obj.argument,
+                "argument": lambda: self.obj.argument,
                 "creation": self.obj.creation,
                 #"creation-not-after": self.obj.creation_not_after,
                 #"creation-label": self.obj.creation_label,
-                "transcription": self.obj.transcription,
-                "address": self.obj.address,
+                "transcription": lambda: self.obj.transcription,
+                "address": lambda: self.obj.address,
                 "is-published": False if self.obj.is_published is None else self.obj.is_published,
-                "witnesses": [{"id": w.id, "content": w.content, "classification-mark": w.classification_mark, "manifest_url": self.get_witness_manifest_url(w.id)} for w in sorted(self.obj.witnesses, key=lambda k: k.num) if self.obj.witnesses],
-                "senders": [
+                "witnesses": lambda: [{"id": w.id, "content": w.content, "classification-mark": w.classification_mark, "manifest_url": self.get_witness_manifest_url(w.id)} for w in sorted(self.obj.witnesses, key=lambda k: k.num) if self.obj.witnesses],
+                "senders": lambda: [
                     {
                         "id": c_h_r.person.id,
                         "label": c_h_r.person.label,
@@ -555,7 +583,7 @@ class DocumentSearchFacade(DocumentFacade):
                     }
                     for c_h_r in self.obj.persons_having_roles if c_h_r.person_role.label == 'sender'
                 ],
-                "recipients": [
+                "recipients": lambda: [
                     {
                         "id": c_h_r.person.id,
                         "label": c_h_r.person.label,
@@ -563,7 +591,7 @@ class DocumentSearchFacade(DocumentFacade):
                     }
                     for c_h_r in self.obj.persons_having_roles if c_h_r.person_role.label == 'recipient'
                 ],
-                "location_dates_from": [
+                "location_dates_from": lambda: [
                     {
                         "id": c_h_r.placename.id,
                         "label": c_h_r.placename.label,
@@ -571,7 +599,7 @@ class DocumentSearchFacade(DocumentFacade):
                     }
                     for c_h_r in self.obj.placenames_having_roles if c_h_r.placename_role.label == 'location-date-from'
                 ],
-                "location_dates_to": [
+                "location_dates_to": lambda: [
                     {
                         "id": c_h_r.placename.id,
                         "label": c_h_r.placename.label,
@@ -580,7 +608,7 @@ class DocumentSearchFacade(DocumentFacade):
                     for c_h_r in self.obj.placenames_having_roles if c_h_r.placename_role.label == 'location-date-to'
                 ]
                 #"iiif-thumbnail-url": self.get_iiif_thumbnail()
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -598,12 +626,12 @@ class DocumentLockFacade(DocumentFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "is-published": False if self.obj.is_published is None else self.obj.is_published,
-                "witnesses": [{"id": w.id, "content": w.content, "classification-mark": w.classification_mark,
+                "witnesses": lambda: [{"id": w.id, "content": w.content, "classification-mark": w.classification_mark,
                                "manifest_url": self.get_witness_manifest_url(w.id)} for w in self.obj.witnesses],
-                "collections": [{'id': c.id, 'title': c.title} for c in self.obj.collections if self.obj.collections],
-                "lock": [
+                "collections": lambda: [{'id': c.id, 'title': c.title} for c in self.obj.collections_list],
+                "lock": lambda: [
                     {
                         "id": self.obj.locks[0].id,
                         "is_active": self.obj.locks[0].is_active,
@@ -614,7 +642,7 @@ class DocumentLockFacade(DocumentFacade):
                         "expiration_date": datetime_to_str(self.obj.locks[0].expiration_date),
                     }
                     if self.obj.locks else []]
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -635,9 +663,9 @@ class DocumentStatusFacade(DocumentFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "is-published": False if self.obj.is_published is None else self.obj.is_published,
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -679,14 +707,14 @@ class DocumentBookmarkFacade(DocumentFacade):
         """
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "title": self.obj.title,
-                "argument": self.obj.argument,
+                "argument": lambda: self.obj.argument,
                 "creation": self.obj.creation,
                 "creation-not-after": self.obj.creation_not_after,
                 "creation-label": self.obj.creation_label,
                 "is-published": False if self.obj.is_published is None else self.obj.is_published,
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -1,8 +1,9 @@
-from flask import jsonify, current_app
+from flask import current_app
 
 from app.api.decorators import api_require_roles
 from app.api.document.decorators import manage_publication_status
 from app.api.document.facade import DocumentFacade
+from app.api.response_factory import JSONAPIResponseFactory
 from app.models import Document
 
 
@@ -40,6 +41,8 @@ def register_document_api_urls(app):
 
     @current_app.route('/api/<api_version>/all-documents')
     def all_documents(api_version):
-        documents = Document.query.with_entities(Document.id, Document.is_published).distinct().order_by(Document.id).all()
-        response = jsonify({"data": [{"id": d[0], "is_published": d[1]} for d in documents]})
-        return response, 200
+        documents = Document.query.with_entities(Document.id, Document.is_published).distinct().order_by(Document.id)
+        return JSONAPIResponseFactory.make_streamed_response(
+            {"data": ({"id": d[0], "is_published": d[1]} for d in documents.yield_per(1000))},
+            content_type="application/json", status=200
+        )
@@ -0,0 +1,176 @@
+"""
+Compile the filter[...] parameters of a request into bound-parameter SQLAlchemy expressions
+
+  filter[field]=v1,v2           legacy syntax: field LIKE %v1% AND field LIKE %v2%
+                                TRUE/FALSE values test a boolean, an empty value means IS NULL
+  filter[!field]                field IS NOT NULL
+  filter[field][eq]=v           field = v (an empty value means IS NULL)
+  filter[field][prefix]=v       field starts with v, as a range comparison so that the index can be used
+  filter[field][contains]=v1,v2 field LIKE %v1% AND field LIKE %v2%
+  filter[field][in]=v1,v2       field IN (v1, v2)
+  filter[field][range]=min,max  min <= field <= max, both bounds are optional
+  filter[!field][op]=...        negation of filter[field][op]
+
+The resolution of the fields and operators only depends on the model and on the filter names,
+the resulting plan is cached and the values are bound when the expressions are built.
+"""
+
+import ast
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+from sqlalchemy import and_, or_, not_, Integer
+from sqlalchemy.orm.attributes import InstrumentedAttribute
+from sqlalchemy.orm.properties import ColumnProperty
+
+FILTER_PARAM_RE = re.compile(r"^filter\[(?P<field>[^\[\]]+)\](?:\[(?P<op>[^\[\]]+)\])?$")
+
+OPERATORS = ("eq", "prefix", "contains", "in", "range")
+
+# a step of a compiled filter plan
+# kind is 'column' or 'property' (python properties are left to the caller)
+FilterStep = namedtuple("FilterStep", ("param", "kind", "fieldname", "op", "negate"))
+
+
+def get_filter_signature(args):
+    """
+    :return: the (param, fieldname, op) of the filter parameters found in the request args
+    """
+    signature = []
+    for param in args.keys():
+        match = FILTER_PARAM_RE.match(param)
+        if match is not None:
+            signature.append((param, match.group("field"), match.group("op")))
+    return tuple(signature)
+
+
+@lru_cache(maxsize=256)
+def compile_filter_plan(model, signature):
+    """
+    Resolve the filtered fields and operators of a filter signature
+    :return: a tuple of FilterStep
+    """
+    plan = []
+    for param, fieldname, op in signature:
+        fieldname = fieldname.replace("-", "_").replace('#', '')
+        negate = fieldname.startswith("!")
+        if negate:
+            fieldname = fieldname[1:]
+
+        if not hasattr(model, fieldname):
+            raise ValueError("cannot parse filter parameter '%s.%s'" % (model, fieldname))
+        if op is not None and op not in OPERATORS:
+            raise ValueError("unknown filter operator '%s' (expected one of %s)" % (op, ", ".join(OPERATORS)))
+
+        attr = getattr(model, fieldname)
+        if isinstance(attr, property):
+            if op is not None:
+                raise ValueError("cannot use the '%s' operator on the property '%s'" % (op, fieldname))
+            plan.append(FilterStep(param, "property", fieldname, None, negate))
+        elif isinstance(attr, InstrumentedAttribute) and isinstance(attr.property, ColumnProperty):
+            plan.append(FilterStep(param, "column", fieldname, op, negate))
+        else:
+            raise ValueError("cannot filter on '%s.%s'" % (model.__tablename__, fieldname))
+
+    return tuple(plan)
+
+
+def has_property_filters(model, args):
+    return any(step.kind == "property" for step in compile_filter_plan(model, get_filter_signature(args)))
+
+
+def _coerce(column, value):
+    """ Convert a parameter value to the python type of the column so that it is bound as such """
+    value_upper = str(value).upper()
+    if value_upper in ("TRUE", "FALSE"):
+        return value_upper == "TRUE"
+    if isinstance(column.type, Integer):
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _next_prefix(prefix):
+    """ The smallest string greater than every string starting with prefix """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _legacy_criteria(column, value):
+    value_upper = value.upper()
+    if value_upper in ("TRUE", "FALSE"):
+        return column.is_(value_upper == "TRUE")
+    if value == "":
+        # filter[field] means IS NULL
+        return column.is_(None)
+    return column.contains(value, autoescape=True)
+
+
+def _user_id_criteria(column, value):
+    # user_id filters are given as a python list literal: filter[user_id]=[1,2]
+    values = ast.literal_eval(value)
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+    criteriae = []
+    for criteria in values:
+        criteria_upper = str(criteria).upper()
+        if criteria_upper in ("TRUE", "FALSE"):
+            criteriae.append(column.is_(criteria_upper == "TRUE"))
+        elif criteria:
+            criteriae.append(column == _coerce(column, criteria))
+        else:
+            criteriae.append(column.is_(None))
+    return or_(*criteriae)
+
+
+def _operator_criteria(column, op, value):
+    if op == "eq":
+        if value == "":
+            return column.is_(None)
+        return column == _coerce(column, value)
+    elif op == "prefix":
+        if value == "":
+            return column.isnot(None)
+        return and_(column >= value, column < _next_prefix(value))
+    elif op == "contains":
+        return and_(*[column.contains(v, autoescape=True) for v in value.split(',')])
+    elif op == "in":
+        return column.in_([_coerce(column, v) for v in value.split(',')])
+    elif op == "range":
+        low, _, high = value.partition(',')
+        criteriae = []
+        if low != "":
+            criteriae.append(column >= _coerce(column, low))
+        if high != "":
+            criteriae.append(column <= _coerce(column, high))
+        return and_(*criteriae)
+
+
+def build_filter_criteriae(model, args):
+    """
+    :return: the SQL criteriae of the column filters and the (param, fieldname, not_null_operator)
+    of the filters on python properties
+    """
+    criteriae = []
+    properties_fieldnames = []
+    for step in compile_filter_plan(model, get_filter_signature(args)):
+        if step.kind == "property":
+            properties_fieldnames.append((step.param, step.fieldname, step.negate))
+            continue
+
+        column = getattr(model, step.fieldname)
+        value = args[step.param]
+        if step.op is not None:
+            criteria = _operator_criteria(column, step.op, value)
+            criteriae.append(not_(criteria) if step.negate else criteria)
+        elif step.negate:
+            # filter[!field] means IS NOT NULL
+            criteriae.append(column.isnot(None))
+        elif step.fieldname == "user_id":
+            criteriae.append(_user_id_criteria(column, value))
+        else:
+            criteriae.extend(_legacy_criteria(column, v) for v in value.split(','))
+
+    return criteriae, properties_fieldnames
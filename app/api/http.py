@@ -0,0 +1,129 @@
+"""
+Shared client of the outbound HTTP requests (remote IIIF servers, elasticsearch administration)
+
+- the connections are pooled and kept alive between the requests (one pool per host)
+- the idempotent requests are retried with an exponential backoff on connection errors and on
+  the 429/502/503/504 responses
+- at most max_per_host requests are sent at once to a host, the others wait for their turn
+- the counters of the requests and of the connection pools are reported by /metrics
+"""
+
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class HTTPClient(object):
+
+    def __init__(self, pool_size=10, max_per_host=8, max_retries=3, backoff_factor=0.5, timeout=10):
+        """
+        :param pool_size: number of connections kept alive per host
+        :param max_per_host: number of concurrent requests per host
+        :param max_retries: number of retries of the idempotent requests (0 disables them)
+        :param backoff_factor: the n-th retry waits backoff_factor * 2 ** (n - 1) seconds
+        :param timeout: default timeout of the requests (in seconds)
+        """
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        retry = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                      raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.hosts = {}
+
+    def _get_host(self, host):
+        """ :return: (semaphore, counters) of a host """
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+                self.hosts[host] = {"requests": 0, "errors": 0, "retries": 0, "in-flight": 0,
+                                    "duration": 0.0, "wait-duration": 0.0}
+            return self.semaphores[host], self.hosts[host]
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        semaphore, counters = self._get_host(urlsplit(url).netloc)
+        start = time.perf_counter()
+        with semaphore:
+            sent = time.perf_counter()
+            with self.lock:
+                counters["in-flight"] += 1
+                counters["wait-duration"] += sent - start
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+                return response
+            finally:
+                retries = getattr(getattr(response, "raw", None), "retries", None)
+                with self.lock:
+                    counters["in-flight"] -= 1
+                    counters["requests"] += 1
+                    counters["duration"] += time.perf_counter() - sent
+                    if response is None or response.status_code >= 500:
+                        counters["errors"] += 1
+                    if retries is not None:
+                        counters["retries"] += len(retries.history)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def get_pools_stats(self):
+        """ :return: the connections opened by each pool and its idle connections, kept alive """
+        pools = {}
+        manager = self.adapter.poolmanager
+        with manager.pools.lock:
+            items = list(manager.pools._container.items())
+        for key, pool in items:
+            pools["%s://%s:%s" % (key.key_scheme, key.key_host, key.key_port)] = {
+                "connections": pool.num_connections,
+                "requests": pool.num_requests,
+                # the queue of the pool is filled with None placeholders of the connections not opened
+                "idle": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+            }
+        return pools
+
+    @property
+    def stats(self):
+        with self.lock:
+            hosts = {}
+            for host, counters in sorted(self.hosts.items()):
+                nb = counters["requests"]
+                hosts[host] = {
+                    "requests": nb,
+                    "errors": counters["errors"],
+                    "retries": counters["retries"],
+                    "in-flight": counters["in-flight"],
+                    "mean-duration": round(counters["duration"] / nb, 4) if nb else 0.0,
+                    "mean-wait-duration": round(counters["wait-duration"] / nb, 4) if nb else 0.0,
+                }
+        return {"hosts": hosts, "pools": self.get_pools_stats()}
+
+
+def make_http_client(config):
+    return HTTPClient(
+        pool_size=config["HTTP_POOL_SIZE"],
+        max_per_host=config["HTTP_MAX_PER_HOST"],
+        max_retries=config["HTTP_MAX_RETRIES"],
+        backoff_factor=config["HTTP_RETRY_BACKOFF"],
+        timeout=config["HTTP_TIMEOUT"],
+    )
@@ -32,10 +32,10 @@ class ImageFacade(JSONAPIAbstractFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "canvas-id": self.obj.canvas_id,
                 "order-num": self.obj.order_num,
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
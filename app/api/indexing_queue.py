@@ -0,0 +1,217 @@
+"""
+Asynchronous indexing (ASYNC_INDEXING)
+
+The objects added, modified or deleted by a write are recorded in the indexing_task table, in the
+same transaction as the change, instead of being reindexed while the request is being served.
+The index-worker command (see app/cli.py) drains the table: the tasks of an object are coalesced,
+the object is reindexed from the current state of the database and the index writes are sent
+through _bulk requests. The tasks that fail are retried later, with an exponential backoff.
+"""
+
+import datetime
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+from app import db
+from app.api.search import BulkIndexer, SearchIndexManager
+from app.models import IndexingTask, MODELS
+
+
+def is_async_indexing():
+    return has_app_context() and bool(current_app.config.get("ASYNC_INDEXING"))
+
+
+def _get_indexed_facade_class(obj):
+    """ The default facade of an object, if this facade writes something into the indexes """
+    from app.api.abstract_facade import JSONAPIAbstractFacade
+    from app.api.facade_manager import JSONAPIFacadeManager
+
+    if isinstance(obj, IndexingTask):
+        return None
+    facades = JSONAPIFacadeManager.FACADES.get(getattr(obj, "__tablename__", None))
+    facade_class = facades.get("default") if isinstance(facades, dict) else None
+    if facade_class is None or \
+            facade_class.get_data_to_index_when_added is JSONAPIAbstractFacade.get_data_to_index_when_added:
+        return None
+    return facade_class
+
+
+def _task(object_type, object_id, op, propagate=True):
+    return {"object_type": object_type, "object_id": object_id, "op": op, "propagate": propagate}
+
+
+@event.listens_for(db.session, "before_flush")
+def _collect_deleted_objects(session, flush_context, instances):
+    # the relationships of the deleted objects cannot be read anymore once the flush is done:
+    # the resources that are reindexed along with them are collected now
+    if not is_async_indexing():
+        return
+    tasks = session.info.setdefault("indexing_tasks", [])
+    for obj in session.deleted:
+        facade_class = _get_indexed_facade_class(obj)
+        if facade_class is None:
+            continue
+        tasks.append(_task(obj.__tablename__, obj.id, "delete"))
+        for ri in facade_class("", obj).get_propagated_resource_identifiers():
+            tasks.append(_task(ri["type"].replace("-", "_"), ri["id"], "update", propagate=False))
+
+
+@event.listens_for(db.session, "after_flush")
+def _write_indexing_tasks(session, flush_context):
+    if not is_async_indexing():
+        return
+    tasks = session.info.pop("indexing_tasks", [])
+    # the ids of the new objects are known now
+    for op, objs in (("insert", session.new), ("update", session.dirty)):
+        for obj in objs:
+            if op == "update" and not session.is_modified(obj):
+                continue
+            if _get_indexed_facade_class(obj) is not None:
+                tasks.append(_task(obj.__tablename__, obj.id, op))
+    if tasks:
+        session.connection().execute(IndexingTask.__table__.insert(), tasks)
+
+
+class TaskBulkIndexer(BulkIndexer):
+    """
+    A BulkIndexer which remembers the task that produced each action, so that only the tasks
+    whose documents were rejected are retried. It is flushed by the worker, between two tasks
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TaskBulkIndexer, self).__init__(*args, **kwargs)
+        self.key = None
+        self.keys_by_id = {}  # id -> [(index, task key)]
+        self.pending_keys = set()
+
+    def _track(self, index, id):
+        self.keys_by_id.setdefault(str(id), []).append((index, self.key))
+        self.pending_keys.add(self.key)
+
+    def add(self, index, id, payload):
+        self._track(index, id)
+        super(TaskBulkIndexer, self).add(index, id, payload)
+
+    def delete(self, index, id):
+        self._track(index, id)
+        super(TaskBulkIndexer, self).delete(index, id)
+
+    def _flush_if_needed(self):
+        pass
+
+    def flush(self):
+        super(TaskBulkIndexer, self).flush()
+        self.pending_keys = set()
+
+    def discard(self):
+        """ Drop the buffered actions (after a failed flush) """
+        self.actions = []
+        self.pending_keys = set()
+
+    def get_failed_keys(self, failure):
+        # the failures name the concrete index (eg. a versioned index behind the alias)
+        return [
+            key for index, key in self.keys_by_id.get(str(failure["id"]), [])
+            if failure["index"] is None or failure["index"] == index or failure["index"].startswith(index + "_v")
+        ]
+
+
+class IndexingWorker(object):
+    """
+    Drain the indexing_task table. Must run within a request context whose host is the one
+    of the indexed urls (the facades build their links from it)
+    """
+
+    def __init__(self, url_prefix, batch_size=500, retry_delay=5.0, max_retry_delay=600.0):
+        self.url_prefix = url_prefix
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+    def get_retry_delay(self, attempts):
+        return min(self.max_retry_delay, self.retry_delay * 2 ** (attempts - 1))
+
+    def process(self, object_type, object_id, tasks, indexer):
+        """
+        Reindex an object from its current state, whatever the number of tasks queued for it
+        :param indexer: the BulkIndexer buffering the index writes
+        """
+        from app.api.facade_manager import JSONAPIFacadeManager
+
+        facade_class = JSONAPIFacadeManager.FACADES[object_type]["default"]
+        obj = MODELS[object_type].query.get(object_id)
+        if obj is None:
+            # deleted since the tasks were queued
+            SearchIndexManager.remove_from_index(index=facade_class.get_index_name(), id=object_id, indexer=indexer)
+        else:
+            op = "insert" if any(t.op == "insert" for t in tasks) else "update"
+            facade_class(self.url_prefix, obj).reindex(op, propagate=any(t.propagate for t in tasks), indexer=indexer)
+
+    def drain_once(self):
+        """
+        Handle the next batch of due tasks
+        :return: (number of objects reindexed, errors by (object_type, object_id))
+        """
+        now = datetime.datetime.now()
+        tasks = IndexingTask.query.filter(IndexingTask.next_attempt_at <= now) \
+            .order_by(IndexingTask.id).limit(self.batch_size).all()
+        if not tasks:
+            return 0, {}
+
+        # coalesce the tasks of the same object
+        groups = OrderedDict()
+        for task in tasks:
+            groups.setdefault((task.object_type, task.object_id), []).append(task)
+
+        indexer = TaskBulkIndexer(batch_size=self.batch_size)
+        errors = {}
+
+        def flush():
+            try:
+                indexer.flush()
+            except Exception as e:
+                for key in indexer.pending_keys:
+                    errors.setdefault(key, str(e))
+                indexer.discard()
+
+        for key, group in groups.items():
+            indexer.key = key
+            try:
+                self.process(key[0], key[1], group, indexer)
+            except Exception as e:
+                errors[key] = str(e)
+            if len(indexer.actions) >= indexer.batch_size:
+                flush()
+        flush()
+        for failure in indexer.failures:
+            for key in indexer.get_failed_keys(failure):
+                errors.setdefault(key, str(failure["error"].get("reason", failure["error"])))
+
+        # the reindexing only reads the database, leave it in a clean state before updating the queue
+        db.session.rollback()
+        for key, group in groups.items():
+            if key in errors:
+                for task in group:
+                    task.attempts += 1
+                    task.last_error = errors[key]
+                    task.next_attempt_at = now + datetime.timedelta(seconds=self.get_retry_delay(task.attempts))
+            else:
+                for task in group:
+                    db.session.delete(task)
+        db.session.commit()
+        return len(groups) - len(errors), errors
+
+    def run(self, poll_interval=2.0, once=False):
+        while True:
+            nb_done, errors = self.drain_once()
+            if nb_done or errors:
+                print("index-worker: %s reindexed, %s failed" % (nb_done, len(errors)), flush=True)
+                for (object_type, object_id), error in errors.items():
+                    print("  FAILED %s/%s: %s" % (object_type, object_id, error), flush=True)
+            elif once:
+                return
+            else:
+                time.sleep(poll_interval)
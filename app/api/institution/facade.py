@@ -31,10 +31,10 @@ class InstitutionFacade(JSONAPIAbstractFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "name": self.obj.name,
                 "ref": self.obj.ref
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -72,6 +72,6 @@ class InstitutionFacade(JSONAPIAbstractFacade):
         institution_data = [{"id": _res["id"], "index": self.get_index_name(), "payload": payload}]
         return institution_data
 
-    def remove_from_index(self, propagate):
+    def remove_from_index(self, propagate, indexer=None):
         from app.api.search import SearchIndexManager
-        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id)
+        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id, indexer=indexer)
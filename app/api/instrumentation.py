@@ -0,0 +1,203 @@
+"""
+Request-scoped instrumentation
+
+Every request records the number and the duration of its SQL statements (engine events), of its
+elasticsearch calls (InstrumentedElasticsearch) and the time spent building the facade resources.
+These timings are added to the meta section of the response when the request carries the
+TIMINGS_HEADER header (in debug mode or for an administrator only), and are aggregated per
+endpoint for the /metrics route (administrators only).
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+TIMINGS_HEADER = "X-Debug-Timings"
+
+COUNTERS = ("sql", "es", "facades")
+
+
+class RequestTimings(object):
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.durations = dict.fromkeys(COUNTERS, 0.0)
+        self._depth = dict.fromkeys(COUNTERS, 0)
+
+    def add(self, name, duration):
+        self.counts[name] += 1
+        self.durations[name] += duration
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def to_dict(self):
+        timings = {"total": round(self.total, 4)}
+        for name in COUNTERS:
+            timings[name] = {"count": self.counts[name], "duration": round(self.durations[name], 4)}
+        return timings
+
+
+def get_request_timings():
+    if has_request_context():
+        return g.get("timings")
+    return None
+
+
+def is_admin_request():
+    """ Whether the request is authenticated as an administrator, the user is looked up once per request """
+    if "is_admin_request" not in g:
+        try:
+            user = current_app.get_current_user()
+        except Exception:
+            user = None
+        g.is_admin_request = user is not None and user.is_admin()
+    return g.is_admin_request
+
+
+def wants_timings():
+    if not has_request_context() or TIMINGS_HEADER not in request.headers or get_request_timings() is None:
+        return False
+    return current_app.debug or is_admin_request()
+
+
+@contextmanager
+def timed(name):
+    """
+    Record the time spent within the block. The nested blocks of the same name are not counted
+    twice (eg. the resources built while including the related resources of a resource)
+    """
+    timings = get_request_timings()
+    if timings is None or timings._depth[name]:
+        yield
+        return
+    timings._depth[name] += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings._depth[name] -= 1
+        timings.add(name, time.perf_counter() - start)
+
+
+def iter_timed(name, iterable):
+    """ Record the time spent producing each item of an iterable (eg. streamed resources) """
+    iterator = iter(iterable)
+    while True:
+        with timed(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if get_request_timings() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = get_request_timings()
+    starts = conn.info.get("query_start")
+    if timings is not None and starts:
+        timings.add("sql", time.perf_counter() - starts.pop())
+
+
+class InstrumentedElasticsearch(object):
+    """ Proxy of the elasticsearch client recording the duration of its calls """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with timed("es"):
+                return attr(*args, **kwargs)
+        return call
+
+
+class Metrics(object):
+    """
+    Timings of the requests aggregated per endpoint, since the process started, and the counters
+    of the components registered with add_source() (eg. the manifest cache)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.endpoints = {}
+        self.sources = {}
+
+    def add_source(self, name, get_stats):
+        """ :param get_stats: callable returning the counters reported under name """
+        self.sources[name] = get_stats
+
+    def record(self, endpoint, status, timings):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    "requests": 0, "errors": 0, "duration": 0.0, "max-duration": 0.0,
+                    **{name: {"count": 0, "duration": 0.0} for name in COUNTERS}
+                }
+            total = timings.total
+            stats["requests"] += 1
+            if status >= 500:
+                stats["errors"] += 1
+            stats["duration"] += total
+            stats["max-duration"] = max(stats["max-duration"], total)
+            for name in COUNTERS:
+                stats[name]["count"] += timings.counts[name]
+                stats[name]["duration"] += timings.durations[name]
+
+    def to_dict(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, stats in sorted(self.endpoints.items()):
+                nb = stats["requests"]
+                endpoints[endpoint] = {
+                    "requests": nb,
+                    "errors": stats["errors"],
+                    "mean-duration": round(stats["duration"] / nb, 4),
+                    "max-duration": round(stats["max-duration"], 4),
+                    **{name: {
+                        "mean-count": round(stats[name]["count"] / nb, 2),
+                        "mean-duration": round(stats[name]["duration"] / nb, 4),
+                    } for name in COUNTERS}
+                }
+        metrics = {"uptime": round(time.time() - self.started_at), "endpoints": endpoints}
+        for name, get_stats in sorted(self.sources.items()):
+            metrics[name] = get_stats()
+        return metrics
+
+
+def init_instrumentation(app):
+    app.metrics = Metrics()
+    if app.elasticsearch is not None:
+        app.elasticsearch = InstrumentedElasticsearch(app.elasticsearch)
+
+    @app.before_request
+    def start_request_timings():
+        g.timings = RequestTimings()
+
+    @app.after_request
+    def record_request_timings(response):
+        timings = get_request_timings()
+        if timings is not None and request.endpoint is not None:
+            endpoint, status = request.endpoint, response.status_code
+            # streamed responses are still being built: they are recorded once sent
+            response.call_on_close(lambda: app.metrics.record(endpoint, status, timings))
+        return response
@@ -8,6 +8,7 @@ class LanguageFacade(JSONAPIAbstractChangeloggedFacade):
     """
     TYPE = "language"
     TYPE_PLURAL = "languages"
+    PROPAGATED_RELATIONSHIPS = ("documents",)
 
     MODEL = Language
 
@@ -31,10 +32,10 @@ class LanguageFacade(JSONAPIAbstractChangeloggedFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "code": self.obj.code,
                 "label": self.obj.label
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -73,16 +74,17 @@ class LanguageFacade(JSONAPIAbstractChangeloggedFacade):
         if not propagate:
             return languages_data
         else:
-            return languages_data + self.get_relationship_data_to_index(rel_name="documents")
+            return languages_data + self.get_propagated_data_to_index()
 
-    def remove_from_index(self, propagate):
+    def remove_from_index(self, propagate, indexer=None):
         from app.api.search import SearchIndexManager
 
-        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id)
+        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id, indexer=indexer)
 
         if propagate:
             # reindex the docs without the resource
             for data in self.get_data_to_index_when_added(propagate):
                 if data["payload"]["id"] != self.id and data["payload"]["type"] != self.TYPE:
                     data["payload"]["languages"] = [l for l in data["payload"]["languages"] if l.get("id") != self.id]
-                    SearchIndexManager.add_to_index(index=data["index"], id=data["id"], payload=data["payload"])
+                    SearchIndexManager.add_to_index(index=data["index"], id=data["id"], payload=data["payload"],
+                                                    indexer=indexer)
@@ -7,6 +7,7 @@ from app.api.user.facade import UserFacade
 from functools import wraps
 
 from app import db
+from app.api.operations import commit
 from app.api.decorators import error_403_privileges, error_400_unhandled_error
 from app.api.route_registrar import json_loads
 from app.models import Lock, DATETIME_FORMAT, User
@@ -57,7 +58,7 @@ def manage_lock_addition():
                         DATETIME_FORMAT
                     )'''
                     db.session.delete(plock)
-                db.session.commit()
+                commit()
 
             return response
 
@@ -97,7 +98,7 @@ def manage_lock_update():
                 lock.expiration_date = datetime.now()#TODO Timezone
                 #print("now : ", datetime.now())
                 #print("lock event date", lock.event_date)
-                db.session.commit()
+                commit()
 
             return response
         return wrapped_f
@@ -134,7 +135,7 @@ def manage_lock_removal():
             response = view_function(*args, **kwargs)
             if response.status.startswith("20"):
                 db.session.delete(lock)
-                db.session.commit()
+                commit()
 
             return response
 
@@ -12,6 +12,7 @@ class LockFacade(JSONAPIAbstractFacade):
     """
     TYPE = "lock"
     TYPE_PLURAL = "locks"
+    PROPAGATED_RELATIONSHIPS = ("documents",)
 
     MODEL = Lock
 
@@ -49,7 +50,7 @@ class LockFacade(JSONAPIAbstractFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "object-id": self.obj.object_id,
                 "object-type": self.obj.object_type,
 
@@ -57,7 +58,7 @@ class LockFacade(JSONAPIAbstractFacade):
                 "expiration-date": datetime_to_str(self.obj.expiration_date),
                 "is-active": self.obj.is_active,
                 "description": self.obj.description,
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -98,7 +99,7 @@ class LockFacade(JSONAPIAbstractFacade):
         if not propagate:
             return
         else:
-            return self.get_relationship_data_to_index(rel_name="documents")
+            return self.get_propagated_data_to_index()
 
-    def reindex(self, op, propagate):
-        super().reindex(op, propagate)
+    def reindex(self, op, propagate, indexer=None):
+        super().reindex(op, propagate, indexer=indexer)
@@ -0,0 +1,153 @@
+"""
+Caches of the remote IIIF manifests (eg. Gallica) the manifests of the witnesses are built from
+
+- MemoryManifestCache: in-process LRU cache, lost on restart and private to each worker
+- SQLiteManifestCache: SQLite file shared by the workers of the application
+
+The entries expire ttl seconds after the manifest was fetched, reading them does not extend their
+lifetime. The failed fetches are cached as well (negative caching) for negative_ttl seconds, so
+that an unreachable server is not requested again by every page showing the document.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from app.api.cache import LRUCache
+
+# returned by get() when the url is not cached (None being a cached failure)
+MISSING = object()
+
+
+class ManifestCache(object):
+
+    def __init__(self, ttl=1800, negative_ttl=60):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.counters_lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        """ :return: the cached manifest, None if its fetch failed recently or MISSING """
+        manifest = self._get(url)
+        with self.counters_lock:
+            if manifest is MISSING:
+                self.misses += 1
+            elif manifest is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+        return manifest
+
+    def set(self, url, manifest):
+        """ Cache a manifest, or the failure of its fetch when manifest is None """
+        self._set(url, manifest, self.ttl if manifest is not None else self.negative_ttl)
+
+    def _get(self, url):
+        raise NotImplementedError
+
+    def _set(self, url, manifest, ttl):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    @property
+    def stats(self):
+        return {"backend": self.BACKEND, "size": len(self), "hits": self.hits,
+                "negative-hits": self.negative_hits, "misses": self.misses}
+
+
+class MemoryManifestCache(ManifestCache):
+    BACKEND = "memory"
+
+    def __init__(self, maxsize=150, **kwargs):
+        super(MemoryManifestCache, self).__init__(**kwargs)
+        self.entries = LRUCache(maxsize=maxsize)
+
+    def _get(self, url):
+        return self.entries.get(url, MISSING)
+
+    def _set(self, url, manifest, ttl):
+        self.entries.set(url, manifest, ttl=ttl)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteManifestCache(ManifestCache):
+    """
+    The entries are stored as json in a SQLite file (in WAL mode, so that the workers can read
+    while another one writes). When there are more than maxsize entries, the expired ones and
+    then the oldest ones are deleted
+    """
+    BACKEND = "sqlite"
+
+    def __init__(self, path, maxsize=1000, **kwargs):
+        super(SQLiteManifestCache, self).__init__(**kwargs)
+        self.path = path
+        self.maxsize = maxsize
+        self.local = threading.local()
+        connection = self.get_connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS manifest_cache ("
+                           "url TEXT PRIMARY KEY, manifest TEXT, fetched_at REAL NOT NULL, expires_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_manifest_cache_fetched_at ON manifest_cache (fetched_at)")
+
+    def get_connection(self):
+        """ sqlite3 connections cannot be shared between threads: one per thread """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    def _get(self, url):
+        row = self.get_connection().execute(
+            "SELECT manifest FROM manifest_cache WHERE url = ? AND expires_at > ?", (url, time.time())
+        ).fetchone()
+        if row is None:
+            return MISSING
+        return json.loads(row[0]) if row[0] is not None else None
+
+    def _set(self, url, manifest, ttl):
+        now = time.time()
+        connection = self.get_connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO manifest_cache (url, manifest, fetched_at, expires_at) VALUES (?, ?, ?, ?)",
+            (url, json.dumps(manifest) if manifest is not None else None, now, now + ttl)
+        )
+        if len(self) > self.maxsize:
+            connection.execute("DELETE FROM manifest_cache WHERE expires_at <= ?", (now,))
+            excess = len(self) - self.maxsize
+            if excess > 0:
+                connection.execute(
+                    "DELETE FROM manifest_cache WHERE url IN "
+                    "(SELECT url FROM manifest_cache ORDER BY fetched_at LIMIT ?)", (excess,)
+                )
+
+    def clear(self):
+        self.get_connection().execute("DELETE FROM manifest_cache")
+
+    def __len__(self):
+        return self.get_connection().execute("SELECT count(*) FROM manifest_cache").fetchone()[0]
+
+
+def make_manifest_cache(config):
+    options = {
+        "maxsize": config["MANIFEST_CACHE_SIZE"],
+        "ttl": config["MANIFEST_CACHE_TTL"],
+        "negative_ttl": config["MANIFEST_CACHE_NEGATIVE_TTL"],
+    }
+    if config["MANIFEST_CACHE_BACKEND"] == "sqlite":
+        return SQLiteManifestCache(config["MANIFEST_CACHE_PATH"], **options)
+    return MemoryManifestCache(**options)
@@ -1,12 +1,15 @@
-import datetime
+import copy
 import json
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from flask import current_app, request
 from operator import attrgetter
 
 from app.api.document.facade import DocumentFacade
+from app.api.http import HTTPClient
+from app.api.manifest.cache import MISSING, MemoryManifestCache
 from app.api.witness.facade import WitnessFacade
 
 
@@ -17,23 +20,27 @@ class ManifestFactory(object):
     MANIFEST_TEMPLATE_FILENAME = dir / "manifest_template.json"
     COLLECTION_TEMPLATE_FILENAME = dir / "collection_template.json"
 
-    CACHED_MANIFESTS = {
-
-    }
-
-    CACHE_DURATION = 1800    # cache manifests (in seconds)
-    CACHE_ENTRY_MAX = 150    # how many manifests to cache
-
-    def __init__(self):
+    def __init__(self, cache=None, timeout=10, max_workers=8, http=None):
+        """
+        :param cache: cache of the remote manifests (see app/api/manifest/cache.py)
+        :param timeout: timeout of the requests to the remote IIIF servers (in seconds)
+        :param max_workers: number of concurrent requests to the remote IIIF servers
+        :param http: HTTPClient sending the requests (see app/api/http.py)
+        """
         with open(ManifestFactory.MANIFEST_TEMPLATE_FILENAME, 'r') as f:
             self.manifest_template = json.load(f)
         with open(ManifestFactory.COLLECTION_TEMPLATE_FILENAME, 'r') as f:
             self.collection_template = json.load(f)
+        self.cache = cache if cache is not None else MemoryManifestCache()
+        self.timeout = timeout
+        # the remote manifests and info.json are fetched concurrently, by a pool shared by the requests
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="manifest-fetch")
+        self.http = http if http is not None else HTTPClient(pool_size=max_workers, max_per_host=max_workers)
 
     def make_collection(self, doc):
         f_obj, errors, kwargs = DocumentFacade.get_facade('', doc)
         collection_url = f_obj.get_iiif_collection_url()
-        collection = dict(self.collection_template)
+        collection = copy.deepcopy(self.collection_template)
 
         manifest_urls = []
         for witness in sorted(doc.witnesses, key=attrgetter('num')):
@@ -60,7 +67,7 @@ class ManifestFactory(object):
         f_obj, errors, kwargs = WitnessFacade.get_facade('', witness)
         manifest_url = f_obj.get_iiif_manifest_url()
 
-        manifest = dict(self.manifest_template)
+        manifest = copy.deepcopy(self.manifest_template)
 
         # ==== manifest @id
         manifest["@id"] = manifest_url
@@ -95,101 +102,105 @@ class ManifestFactory(object):
 
         # fetching canvases from manifests
         canvases = []
-        fetch_canvas = current_app.manifest_factory.fetch_canvas
-        for orig_manifest_url, canvas_ids in grouped_images.items():
-            new_canvases = fetch_canvas(orig_manifest_url, canvas_ids, cache=True)
+        for new_canvases in self.fetch_canvases(grouped_images, cache=True).values():
             canvases.extend(new_canvases)
 
         manifest["sequences"][0]["canvases"] = canvases
 
         return manifest, manifest_url
 
-    @classmethod
-    def _fetch(cls, manifest_url):
-        r = requests.get(manifest_url)
-        #print("fetching... %s" % manifest_url, end=" ", flush=True)
-        manifest = r.json()
-        #print(r.status_code)
-        # gallica returns incorrect canvases height and width now and then, they are accessed this way
-        # width = int(manifest["sequences"][0]["canvases"][0]["width"])
-        # height = int(manifest["sequences"][0]["canvases"][0]["height"])
+    def _map(self, func, items):
+        """ Apply func to the items concurrently, the results are in the order of the items """
+        items = list(items)
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        return list(self.executor.map(func, items))
 
-        return manifest
+    def _fetch(self, url):
+        r = self.http.get(url, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
 
-    @classmethod
-    def _get_from_cache(cls, manifest_url):
-        #print("\n cls.CACHED_MANIFESTS.keys()", cls.CACHED_MANIFESTS.keys())
-        if manifest_url not in cls.CACHED_MANIFESTS.keys():
-            try:
-                manifest = cls._fetch(manifest_url)
-            except Exception as e:
-                print("cannot get manifest", manifest_url)
-                manifest = {}
-            if len(cls.CACHED_MANIFESTS.keys()) >= cls.CACHE_ENTRY_MAX:
-                l = [(dt, url) for url, (_, dt) in cls.CACHED_MANIFESTS.items()]
-                l.sort(reverse=True)
-                oldest_cached_url = l[0][1]
-                cls.CACHED_MANIFESTS.pop(oldest_cached_url)
-                #print("popped", oldest_cached_url)
-            #print("caching", manifest_url)
-            cls.CACHED_MANIFESTS[manifest_url] = (manifest, datetime.datetime.now())
-            #print("nb cache entries:", len(cls.CACHED_MANIFESTS.keys()))
-            return manifest
-        else:
-            manifest, dt = cls.CACHED_MANIFESTS[manifest_url]
-            # gallica returns incorrect (-1) canvases height & width now and then, test before refreshing cache
-            width = int(manifest["sequences"][0]["canvases"][0]["width"])
-            height = int(manifest["sequences"][0]["canvases"][0]["height"])
-            if (width > 0) and (height > 0):
-                #print("get from cache")
-                # refresh the cache entry
-                duration = datetime.datetime.now() - dt
-                if duration.total_seconds() > cls.CACHE_DURATION:
-                    cls.CACHED_MANIFESTS.pop(manifest_url)
-                    #print("refresh cache entry")
-                    return cls._get_from_cache(manifest_url)
-                else:
-                    # extending cache duration
-                    cls.CACHED_MANIFESTS[manifest_url] = (manifest, datetime.datetime.now())
-                    return manifest
-            else:
-                # canvases height & width are incorrect, do not refresh cached manifest
-                # extending cache duration
-                cls.CACHED_MANIFESTS[manifest_url] = (manifest, datetime.datetime.now())
-                return manifest
-
-    @classmethod
-    def fetch_canvas(cls, manifest_url, canvas_ids, cache=False):
-        if cache:
-            manifest = cls._get_from_cache(manifest_url)
-            print("fetch_canvas if")
-        else:
-            print("fetch_canvas else")
-            manifest = cls._fetch(manifest_url)
+    def _fetch_manifest(self, manifest_url):
+        try:
+            return self._fetch(manifest_url)
+        except (requests.RequestException, ValueError) as e:
+            print("cannot get manifest", manifest_url, e)
+            return None
+
+    def get_manifest(self, manifest_url):
+        """
+        :return: the remote manifest, from the cache when it has been fetched recently,
+        None if it cannot be fetched
+        """
+        manifest = self.cache.get(manifest_url)
+        if manifest is MISSING:
+            manifest = self._fetch_manifest(manifest_url)
+            self.cache.set(manifest_url, manifest)
+        return manifest
 
+    @staticmethod
+    def _select_canvases(manifest, canvas_ids):
+        if manifest is None:
+            return []
         try:
-            canvases = [canvas for canvas in manifest["sequences"][0]["canvases"]
-                    if canvas["@id"] in canvas_ids if "sequences" in manifest]
-
-            for canvas in canvases:
-                # gallica returns incorrect canvases height and width now and then, they are accessed this way
-                width = int(canvas["width"])
-                height = int(canvas["height"])
-
-                # test if height and width are valid, otherwise fetch from folio info.json instead
-                if (width < 0) or (height < 0):
-                    folio = canvas["@id"].rsplit("/", maxsplit=2)[-1]
-                    folio_url = manifest_url.rsplit("manifest.json")[0] + folio
-                    folio_manifest_url = "{folio_url}/info.json".format(folio_url=folio_url)
-                    rfolio = requests.get(folio_manifest_url)
-                    correct_width = int(rfolio.json()["width"])
-                    correct_height = int(rfolio.json()["height"])
-                    canvas["width"] = correct_width
-                    canvas["height"] = correct_height
-                    canvas["images"][0]["resource"]["width"] = correct_width
-                    canvas["images"][0]["resource"]["height"] = correct_height
-        except KeyError as err:
+            return [canvas for canvas in manifest["sequences"][0]["canvases"] if canvas["@id"] in canvas_ids]
+        except (KeyError, IndexError) as err:
             print("KeyError", err)
-            canvases = []
+            return []
+
+    @staticmethod
+    def _has_invalid_dimensions(canvas):
+        # gallica returns incorrect canvases height and width now and then
+        try:
+            return int(canvas["width"]) < 0 or int(canvas["height"]) < 0
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def _correct_dimensions(self, manifest_url, canvas):
+        """ Set the dimensions of the canvas from the info.json of its folio, :return: False on failure """
+        folio = canvas["@id"].rsplit("/", maxsplit=2)[-1]
+        folio_url = manifest_url.rsplit("manifest.json")[0] + folio
+        folio_manifest_url = "{folio_url}/info.json".format(folio_url=folio_url)
+        try:
+            info = self._fetch(folio_manifest_url)
+            correct_width = int(info["width"])
+            correct_height = int(info["height"])
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print("cannot correct the canvas", canvas["@id"], e)
+            return False
+        canvas["width"] = correct_width
+        canvas["height"] = correct_height
+        canvas["images"][0]["resource"]["width"] = correct_width
+        canvas["images"][0]["resource"]["height"] = correct_height
+        return True
+
+    def fetch_canvases(self, grouped_canvas_ids, cache=False):
+        """
+        Fetch the canvases of several remote manifests: the manifests are fetched concurrently,
+        then the info.json of all their canvases with invalid dimensions. The latency is bounded
+        by the slowest fetch of each step rather than by their sum
+
+        :param grouped_canvas_ids: {manifest url: canvas ids}
+        :return: {manifest url: canvases}
+        """
+        manifest_urls = list(grouped_canvas_ids)
+        manifests = dict(zip(manifest_urls, self._map(
+            self.get_manifest if cache else self._fetch_manifest, manifest_urls
+        )))
+        grouped_canvases = {url: self._select_canvases(manifests[url], grouped_canvas_ids[url])
+                            for url in manifest_urls}
+
+        invalid_canvases = [(url, canvas) for url, canvases in grouped_canvases.items()
+                            for canvas in canvases if self._has_invalid_dimensions(canvas)]
+        corrected = self._map(lambda item: self._correct_dimensions(*item), invalid_canvases)
+
+        if cache:
+            # keep the corrected dimensions, not to fetch the info.json files again
+            for url in {url for (url, canvas), ok in zip(invalid_canvases, corrected) if ok}:
+                self.cache.set(url, manifests[url])
+
+        return grouped_canvases
 
-        return canvases
+    def fetch_canvas(self, manifest_url, canvas_ids, cache=False):
+        return self.fetch_canvases({manifest_url: canvas_ids}, cache=cache)[manifest_url]
@@ -4,6 +4,7 @@ from flask import current_app, request, Response, url_for
 
 
 from app import JSONAPIResponseFactory
+from app.api.manifest.store import make_not_built_response, make_stored_response, schedule_build
 from app.models import Document
 
 CONTENT_TYPE = "application/json; charset=utf-8"
@@ -15,13 +16,12 @@ HEADERS = {"Access-Control-Allow-Origin": "*",
 def get_collection(api_version, doc_id):
     document = Document.query.filter(Document.id == doc_id).first()
     if document:
-        collection, collection_url = current_app.manifest_factory.make_collection(document)
-        response = Response(
-            json.dumps(collection, indent=2, ensure_ascii=False),
-            content_type=CONTENT_TYPE,
-            headers=HEADERS,
-        )
-        return response, 200
+        stored = current_app.iiif_store.get_collection(document.id)
+        if stored is None:
+            schedule_build([document.id])
+            return make_not_built_response("The collection of document %s has not been built yet" % doc_id,
+                                           headers=HEADERS)
+        return make_stored_response(stored, content_type=CONTENT_TYPE, headers=HEADERS)
     else:
         return JSONAPIResponseFactory.make_errors_response(
             {"status": 404, "title": "Document %s does not exist" % doc_id}, status=404
@@ -0,0 +1,305 @@
+"""
+Local store of the IIIF resources built from the remote manifests (IIIF_STORE_PATH)
+
+The witness manifests, the document collections and the document thumbnail urls are rendered
+ahead of time, by the iiif-build command (see app/cli.py) or in the background once a write to
+a witness or to its images is committed. The read path (IIIF routes, document attributes) only
+reads the stored files and never calls the remote IIIF servers: a document which has not been
+built yet is scheduled for a build and served without its IIIF resources meanwhile (the IIIF routes
+answer 503 with a Retry-After header).
+
+    <IIIF_STORE_PATH>/witnesses/<id>/manifest.json
+    <IIIF_STORE_PATH>/documents/<id>/collection.json
+    <IIIF_STORE_PATH>/documents/<id>/thumbnail.json     {"url": ...}, written last
+    <IIIF_STORE_PATH>/documents/<id>/build.claim        the build is in progress in one of the processes
+
+A build changes the representations of the document (iiif-thumbnail-url, manifest urls): the data
+version of the ETags and the generation of the search caches are incremented once it is done.
+"""
+
+import hashlib
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from flask import current_app, has_request_context, request, Response
+from sqlalchemy import event, select
+
+from app import db
+from app.api.compression import negotiate_encoding
+from app.api.response_factory import dumps, JSONAPIResponseFactory
+from app.models import Document, Image, Witness
+
+_PENDING_KEY = "iiif_store_pending"
+
+
+class StoredResource(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def etag(self):
+        return hashlib.sha1(self.data).hexdigest()
+
+    def json(self):
+        return json.loads(self.data)
+
+
+class IIIFStore(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def manifest_name(witness_id):
+        return os.path.join("witnesses", str(witness_id), "manifest.json")
+
+    @staticmethod
+    def collection_name(document_id):
+        return os.path.join("documents", str(document_id), "collection.json")
+
+    @staticmethod
+    def thumbnail_name(document_id):
+        return os.path.join("documents", str(document_id), "thumbnail.json")
+
+    @staticmethod
+    def claim_name(document_id):
+        return os.path.join("documents", str(document_id), "build.claim")
+
+    def read(self, name):
+        """ :return: the StoredResource, None if it has not been built """
+        try:
+            with open(os.path.join(self.path, name), "rb") as f:
+                return StoredResource(f.read())
+        except FileNotFoundError:
+            return None
+
+    def write(self, name, resource):
+        """ The file is replaced atomically, the readers never see a partial file """
+        filename = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(dumps(resource))
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+
+    def delete(self, name):
+        try:
+            os.unlink(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def get_manifest(self, witness_id):
+        return self.read(self.manifest_name(witness_id))
+
+    def get_collection(self, document_id):
+        return self.read(self.collection_name(document_id))
+
+    def is_built(self, document_id):
+        return os.path.exists(os.path.join(self.path, self.thumbnail_name(document_id)))
+
+    def claim_build(self, document_id, timeout):
+        """
+        Claim the build of a document for the calling process, the store being shared by the workers
+        :param timeout: seconds after which the claim of a process which never released it expires
+        :return: False if the build has already been claimed by a process
+        """
+        filename = os.path.join(self.path, self.claim_name(document_id))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        try:
+            os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.path.getmtime(filename) < timeout:
+                return False
+            # the claim of a process which did not release it in time is taken over
+            os.utime(filename)
+            return True
+        except FileNotFoundError:
+            # released meanwhile
+            return self.claim_build(document_id, timeout)
+
+    def release_build(self, document_id):
+        self.delete(self.claim_name(document_id))
+
+    def get_thumbnail_url(self, document_id):
+        """ :return: (is built, thumbnail url) """
+        thumbnail = self.read(self.thumbnail_name(document_id))
+        if thumbnail is None:
+            return False, None
+        return True, thumbnail.json()["url"]
+
+    def build_document(self, doc, manifest_factory):
+        """ Render the manifests of the witnesses of a document, its collection and its thumbnail """
+        thumbnail_url = None
+        for witness in doc.witnesses:
+            manifest, manifest_url = manifest_factory.make_manifest(witness)
+            self.write(self.manifest_name(witness.id), manifest)
+            if thumbnail_url is None:
+                thumbnail_url = next((c["thumbnail"]["@id"] for c in manifest["sequences"][0]["canvases"]
+                                      if "thumbnail" in c), None)
+        collection, collection_url = manifest_factory.make_collection(doc)
+        self.write(self.collection_name(doc.id), collection)
+        self.write(self.thumbnail_name(doc.id), {"url": thumbnail_url})
+
+    def delete_witness(self, witness_id):
+        self.delete(self.manifest_name(witness_id))
+
+    def delete_document(self, document_id):
+        self.delete(self.thumbnail_name(document_id))
+        self.delete(self.collection_name(document_id))
+
+
+class IIIFStoreBuilder(object):
+    """
+    Builds the documents of the store in a background thread. A document already waiting for
+    its build is not scheduled twice, and the documents read before they were built are only
+    scheduled by the process which claimed their build (see IIIFStore.claim_build)
+    """
+
+    def __init__(self, app, store):
+        self.app = app
+        self.store = store
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def schedule(self, document_ids, host, rebuild=False):
+        """
+        :param host: base url of the urls of the built resources
+        :param rebuild: build the documents even if another process is building them, their
+        witnesses having been modified since
+        """
+        timeout = self.app.config["IIIF_STORE_BUILD_TIMEOUT"]
+        with self.lock:
+            for document_id in document_ids:
+                if (document_id, host) in self.pending:
+                    continue
+                if not self.store.claim_build(document_id, timeout) and not rebuild:
+                    continue
+                self.pending.add((document_id, host))
+                self.queue.put((document_id, host))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="iiif-store-builder", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            document_id, host = self.queue.get()
+            with self.lock:
+                self.pending.discard((document_id, host))
+            # the manifests build their urls from the request host
+            with self.app.test_request_context(base_url=host):
+                try:
+                    doc = Document.query.get(document_id)
+                    if doc is not None:
+                        self.store.build_document(doc, self.app.manifest_factory)
+                        bump_versions()
+                except Exception as e:
+                    print("cannot build the IIIF resources of document", document_id, e)
+                finally:
+                    self.store.release_build(document_id)
+            self.queue.task_done()
+
+    def join(self):
+        """ Wait for the scheduled builds """
+        self.queue.join()
+
+
+def bump_versions():
+    """ The representations of the built documents have changed: invalidate the ETags and the search caches """
+    from app.api.conditional import bump_data_version
+    from app.api.search import SearchIndexManager
+    with db.engine.begin() as connection:
+        bump_data_version(connection)
+    SearchIndexManager.bump_generation()
+
+
+def make_stored_response(stored, content_type=JSONAPIResponseFactory.CONTENT_TYPE, headers=None):
+    """ Serve a stored resource as is, answering 304 when the client holds its current version """
+    headers = dict(headers or {})
+    headers.update(JSONAPIResponseFactory.HEADERS)
+    encoding = negotiate_encoding()
+    response = Response(stored.data, content_type=content_type, headers=headers)
+    response.set_etag(stored.etag if encoding is None else "%s-%s" % (stored.etag, encoding))
+    response.vary.add("Accept-Encoding")
+    return response.make_conditional(request)
+
+
+def make_not_built_response(title, headers=None):
+    """ A resource of a document which has not been built yet: 503, the build being in progress """
+    headers = dict(headers or {})
+    headers.update({"Retry-After": str(current_app.config["IIIF_STORE_RETRY_AFTER"]), "Cache-Control": "no-store"})
+    return JSONAPIResponseFactory.make_errors_response({"status": 503, "title": title}, status=503, headers=headers)
+
+
+def schedule_build(document_ids, rebuild=False):
+    """ Build in the background the documents read before they were built, or modified """
+    if document_ids and has_request_context():
+        current_app.iiif_store_builder.schedule(document_ids, request.host_url, rebuild=rebuild)
+
+
+def _get_pending(session):
+    return session.info.setdefault(_PENDING_KEY, {"documents": set(), "deleted-witnesses": set(),
+                                                  "deleted-documents": set()})
+
+
+@event.listens_for(db.session, "before_flush")
+def _collect_deleted_documents(session, flush_context, instances):
+    # the witnesses of a deleted document cannot be read anymore once the flush is done
+    for obj in session.deleted:
+        if isinstance(obj, Document):
+            pending = _get_pending(session)
+            pending["deleted-documents"].add(obj.id)
+            pending["deleted-witnesses"].update(w.id for w in obj.witnesses)
+
+
+@event.listens_for(db.session, "after_flush")
+def _collect_changed_documents(session, flush_context):
+    for objs in (session.new, session.dirty, session.deleted):
+        for obj in objs:
+            if not isinstance(obj, (Witness, Image)) or (obj in session.dirty and not session.is_modified(obj)):
+                continue
+            pending = _get_pending(session)
+            if isinstance(obj, Witness):
+                document_id = obj.document_id
+                if obj in session.deleted:
+                    pending["deleted-witnesses"].add(obj.id)
+            elif obj.witness is not None:
+                document_id = obj.witness.document_id
+            else:
+                document_id = session.connection().execute(
+                    select(Witness.__table__.c.document_id).where(Witness.__table__.c.id == obj.witness_id)
+                ).scalar()
+            if document_id is not None:
+                pending["documents"].add(document_id)
+
+
+@event.listens_for(db.session, "after_commit")
+def _update_store(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    store = current_app.iiif_store
+    for witness_id in pending["deleted-witnesses"]:
+        store.delete_witness(witness_id)
+    for document_id in pending["deleted-documents"]:
+        store.delete_document(document_id)
+    if current_app.config.get("IIIF_STORE_BUILD_ON_COMMIT"):
+        schedule_build(pending["documents"] - pending["deleted-documents"], rebuild=True)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_pending(session):
+    session.info.pop(_PENDING_KEY, None)
@@ -32,10 +32,10 @@ class NoteFacade(JSONAPIAbstractChangeloggedFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "content": self.obj.content,
                 "occurences": self.obj.occurences,
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -0,0 +1,288 @@
+"""
+Atomic operations (POST /api/<api_version>/operations, JSON:API atomic extension)
+
+    {"atomic:operations": [
+        {"op": "add", "data": {"type": "document", "lid": "doc", "attributes": {...}}},
+        {"op": "add", "data": {"type": "witness", "attributes": {...},
+                               "relationships": {"document": {"data": {"type": "document", "lid": "doc"}}}}},
+        {"op": "add", "ref": {"type": "document", "lid": "doc", "relationship": "collections"},
+         "data": [{"type": "collection", "id": "3"}]},
+        {"op": "update", "data": {"type": "person", "id": "12", "attributes": {...}}},
+        {"op": "remove", "ref": {"type": "note", "id": "7"}}
+    ]}
+
+Each operation is handed to the write route of the resource (or of the relationship), with the
+headers of the batch request, so that the checks, the permissions and the facades are the same as
+for a single write. The writes are only flushed: the batch is committed once all its operations
+succeeded, and rolled back as a whole on the first failure. The lids of the created resources can
+be referenced by the next operations.
+
+The resources written by the routes are recorded instead of being reindexed one by one: once
+committed, each of them and of the resources depending on it is reindexed exactly once, from the
+final state of the database (unless ASYNC_INDEXING, the changes are then queued along with the
+writes as for any other request).
+"""
+
+import json
+from collections import OrderedDict
+
+from flask import current_app, g, has_app_context, request
+from werkzeug.exceptions import HTTPException
+
+from app import db
+from app.api.response_factory import dumps, JSONAPIResponseFactory
+
+_BATCH_KEY = "operations_batch"
+
+METHODS = {"add": "POST", "update": "PATCH", "remove": "DELETE"}
+
+
+class OperationError(Exception):
+
+    def __init__(self, title, status=400):
+        super(OperationError, self).__init__(title)
+        self.title = title
+        self.status = status
+
+
+def get_operations_batch():
+    """ :return: the batch of the operations being applied, None outside of an operations request """
+    return g.get(_BATCH_KEY) if has_app_context() else None
+
+
+def commit():
+    """ Commit the writes of a route, or only flush them when the route is called by an operations batch """
+    if get_operations_batch() is not None:
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+class OperationsBatch(object):
+    """ The resources written by the operations of a batch, reindexed once it is committed """
+
+    def __init__(self):
+        self.written = OrderedDict()  # (type, id) -> id, the resources written by the routes
+        self.affected = OrderedDict()  # (type, id) -> id, these resources and the ones depending on them
+        self.removed = OrderedDict()  # (index, id) -> id, the index entries of the deleted resources
+        self.models = set()
+
+    @staticmethod
+    def key(resource_identifier):
+        return resource_identifier["type"], str(resource_identifier["id"])
+
+    def _add(self, resources, resource_identifier):
+        resources.setdefault(self.key(resource_identifier), resource_identifier["id"])
+
+    def record(self, f_obj, op):
+        """
+        Record a resource written by a route. The resources depending on it are collected now,
+        before a deletion or an update of its relationships makes them unreachable
+        """
+        resource_identifier = {"type": f_obj.TYPE, "id": f_obj.obj.id}
+        self.models.add(f_obj.MODEL)
+        self._add(self.written, resource_identifier)
+        self._add(self.affected, resource_identifier)
+        for ri in f_obj.get_propagated_resource_identifiers():
+            self._add(self.affected, ri)
+        if op == "delete":
+            for data in f_obj.get_data_to_index_when_removed(False) or []:
+                self.removed.setdefault((data["index"], str(data["id"])), data["id"])
+
+    def get_affected_resource_identifiers(self, url_prefix):
+        """
+        The resources to reindex: the written ones still existing, the resources depending on
+        them before and after the batch
+        """
+        from app.api.facade_manager import JSONAPIFacadeManager
+
+        affected = OrderedDict(self.affected)
+        ids_by_type = OrderedDict()
+        for (resource_type, _), id in self.written.items():
+            ids_by_type.setdefault(resource_type, []).append(id)
+        for resource_type, ids in ids_by_type.items():
+            facade_class = JSONAPIFacadeManager.get_facade_class_from_facade_type(resource_type)
+            if not facade_class.PROPAGATED_RELATIONSHIPS:
+                continue
+            model = facade_class.MODEL
+            for obj in model.query.options(*facade_class.get_loading_options()).filter(model.id.in_(ids)).all():
+                for ri in facade_class(url_prefix, obj).get_propagated_resource_identifiers():
+                    self._add(affected, ri)
+        return [{"type": resource_type, "id": id} for (resource_type, _), id in affected.items()]
+
+    def reindex(self, url_prefix):
+        """ Write each affected resource once into the indexes, remove the deleted ones """
+        from app.api.abstract_facade import JSONAPIAbstractFacade
+        from app.api.search import SearchIndexManager
+
+        to_be_reindexed = OrderedDict()
+        for data in JSONAPIAbstractFacade.get_data_to_index_of(self.get_affected_resource_identifiers(url_prefix)):
+            to_be_reindexed[(data["index"], str(data["id"]))] = data
+        with SearchIndexManager.deferred_generation_bump():
+            for (index, key), data in to_be_reindexed.items():
+                if (index, key) not in self.removed:
+                    SearchIndexManager.add_to_index(index=index, id=data["id"], payload=data["payload"])
+            for (index, _), id in self.removed.items():
+                SearchIndexManager.remove_from_index(index=index, id=id)
+
+
+def resolve_identifier(resource_identifier, lids):
+    """ Replace the lid of a resource identifier by the id of the resource created by a previous operation """
+    if not isinstance(resource_identifier, dict) or "lid" not in resource_identifier:
+        return resource_identifier
+    resource_identifier = dict(resource_identifier)
+    lid = resource_identifier.pop("lid")
+    if "id" not in resource_identifier:
+        if lid not in lids:
+            raise OperationError("Unknown lid '%s'" % lid)
+        resource_identifier["id"] = lids[lid]
+    return resource_identifier
+
+
+def resolve_relationships(resource, lids):
+    if not isinstance(resource, dict) or not isinstance(resource.get("relationships"), dict):
+        return resource
+    relationships = {}
+    for rel_name, rel in resource["relationships"].items():
+        if isinstance(rel, dict) and isinstance(rel.get("data"), list):
+            rel = dict(rel, data=[resolve_identifier(ri, lids) for ri in rel["data"]])
+        elif isinstance(rel, dict) and rel.get("data") is not None:
+            rel = dict(rel, data=resolve_identifier(rel["data"], lids))
+        relationships[rel_name] = rel
+    return dict(resource, relationships=relationships)
+
+
+def make_request(operation, lids, api_version):
+    """
+    :return: (method, path, body, lid) of the write route of an operation, lid being the local
+    identifier of the resource it creates
+    """
+    from app.api.facade_manager import JSONAPIFacadeManager
+
+    if not isinstance(operation, dict) or operation.get("op") not in METHODS:
+        raise OperationError("The 'op' member must be one of %s" % ", ".join(METHODS))
+    op = operation["op"]
+    data = operation.get("data")
+    ref = operation.get("ref")
+
+    lid = None
+    if ref is not None:
+        if not isinstance(ref, dict) or "type" not in ref:
+            raise OperationError("Missing 'type' member in 'ref'")
+        target = resolve_identifier(ref, lids)
+    elif isinstance(data, dict) and "type" in data:
+        target = data
+    else:
+        raise OperationError("Missing 'ref' member or 'data' resource")
+
+    facade_class = JSONAPIFacadeManager.get_facade_class_from_facade_type(target["type"])
+    if facade_class is None:
+        raise OperationError("Unknown resource type '%s'" % target["type"], status=404)
+    path = "/api/{api_version}/{type_plural}".format(api_version=api_version, type_plural=facade_class.TYPE_PLURAL)
+
+    relationship = target.get("relationship") if ref is not None else None
+    if relationship is not None:
+        if "data" not in operation:
+            raise OperationError("Missing 'data' member")
+        if isinstance(data, list):
+            data = [resolve_identifier(ri, lids) for ri in data]
+        else:
+            data = resolve_identifier(data, lids)
+    elif op == "add":
+        if not isinstance(data, dict):
+            raise OperationError("Missing 'data' resource")
+        data = resolve_relationships(data, lids)
+        lid = data.pop("lid", None)
+        return METHODS[op], path, {"data": data}, lid
+    elif op == "update":
+        if not isinstance(data, dict):
+            raise OperationError("Missing 'data' resource")
+        data = resolve_relationships(resolve_identifier(data, lids), lids)
+        target = data if ref is None else target
+    elif data is not None:
+        data = resolve_relationships(resolve_identifier(data, lids), lids)
+
+    if "id" not in target:
+        raise OperationError("Missing 'id' or 'lid' member")
+    path = "{path}/{id}".format(path=path, id=target["id"])
+    if relationship is not None:
+        path = "{path}/relationships/{rel_name}".format(path=path, rel_name=relationship)
+    return METHODS[op], path, {"data": data} if data is not None or op != "remove" else None, lid
+
+
+def dispatch(method, path, body):
+    """
+    Call the write route of an operation with the headers of the operations request. The app
+    context, and the batch stored in g, are shared with the operations request
+    """
+    headers = [(k, v) for k, v in request.headers.items() if k.lower() not in ("content-type", "content-length")]
+    with current_app.test_request_context(path, base_url=request.url_root, method=method, headers=headers,
+                                          data=dumps(body) if body is not None else None,
+                                          content_type=JSONAPIResponseFactory.CONTENT_TYPE):
+        try:
+            endpoint, view_args = current_app.url_map.bind_to_environ(request.environ).match()
+        except HTTPException as e:
+            raise OperationError("Cannot %s %s" % (method, path), status=e.code)
+        return current_app.make_response(current_app.view_functions[endpoint](**view_args))
+
+
+def get_errors(response, pointer):
+    """ The errors of a failed operation, pointing to the operation """
+    try:
+        document = json.loads(response.get_data())
+    except ValueError:
+        document = {}
+    errors = document.get("errors") if isinstance(document, dict) else None
+    if errors is None:
+        errors = [{"status": response.status_code, "title": document.get("message", response.status)
+                   if isinstance(document, dict) else response.status}]
+    flattened = []
+    for error in errors if isinstance(errors, list) else [errors]:
+        flattened.extend(error if isinstance(error, list) else [error])
+    return [dict(error, source={"pointer": pointer}) for error in flattened if isinstance(error, dict)]
+
+
+def apply_operations(operations, api_version, url_prefix):
+    """
+    Apply the operations in a single transaction
+    :return: the response, {"atomic:results": [...]} or the errors of the first failed operation
+    """
+    batch = OperationsBatch()
+    setattr(g, _BATCH_KEY, batch)
+    lids = {}
+    results = []
+    try:
+        for i, operation in enumerate(operations):
+            pointer = "/atomic:operations/%s" % i
+            try:
+                method, path, body, lid = make_request(operation, lids, api_version)
+                response = dispatch(method, path, body)
+            except OperationError as e:
+                db.session.rollback()
+                return JSONAPIResponseFactory.make_errors_response(
+                    [{"status": e.status, "title": e.title, "source": {"pointer": pointer}}], status=e.status
+                )
+            if response.status_code >= 400:
+                db.session.rollback()
+                return JSONAPIResponseFactory.make_errors_response(get_errors(response, pointer),
+                                                                   status=response.status_code)
+
+            data = response.get_data()
+            document = json.loads(data) if data and response.status_code != 204 else {}
+            if isinstance(document, dict) and document.get("data") is not None:
+                results.append({"data": document["data"]})
+                if lid is not None and isinstance(document["data"], dict):
+                    lids[lid] = document["data"]["id"]
+            else:
+                results.append({})
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    finally:
+        g.pop(_BATCH_KEY, None)
+
+    for model in batch.models:
+        current_app.api_url_registrar.invalidate_counts(model)
+    batch.reindex(url_prefix)
+    return JSONAPIResponseFactory.make_response({"atomic:results": results})
@@ -0,0 +1,84 @@
+"""
+Keyset (cursor) pagination: page[after]=<cursor>
+
+The cursor encodes the values of the sort columns and the id of the last row of a page,
+the next page is fetched with a WHERE clause on those values instead of an OFFSET so that
+deep pages cost the same as the first one.
+The comparisons follow the SQLite ordering of NULLs: first in ascending order, last in descending order.
+"""
+
+import base64
+import datetime
+import json
+
+from sqlalchemy import and_, or_, asc, desc, false, Date, DateTime
+
+
+def _encode_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def _decode_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, DateTime):
+        return datetime.datetime.fromisoformat(value)
+    if isinstance(column.type, Date):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+def get_keyset_columns(model, sort_criteriae):
+    """
+    :param sort_criteriae: (column, direction) pairs as given by the sort parameter
+    :return: the sort criteriae completed with the id so that the order is total
+    """
+    keyset_columns = list(sort_criteriae)
+    if not any(column.key == "id" for column, direction in keyset_columns):
+        keyset_columns.append((model.id, asc))
+    return keyset_columns
+
+
+def order_by_keyset(objs_query, keyset_columns):
+    return objs_query.order_by(False).order_by(*[direction(column) for column, direction in keyset_columns])
+
+
+def encode_cursor(obj, keyset_columns):
+    values = [_encode_value(getattr(obj, column.key)) for column, direction in keyset_columns]
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, keyset_columns):
+    """
+    :raise ValueError: if the cursor was not built for these sort columns
+    """
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    if not isinstance(values, list) or len(values) != len(keyset_columns):
+        raise ValueError("invalid page[after] cursor '%s'" % cursor)
+    return [_decode_value(column, value) for (column, direction), value in zip(keyset_columns, values)]
+
+
+def _equals(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def _after(column, direction, value):
+    if direction is desc:
+        # NULLs come last
+        return false() if value is None else or_(column < value, column.is_(None))
+    # NULLs come first
+    return column.isnot(None) if value is None else column > value
+
+
+def keyset_criteria(keyset_columns, values):
+    """
+    The rows coming after the given values:
+    (c1 > v1) OR (c1 = v1 AND c2 > v2) OR (c1 = v1 AND c2 = v2 AND c3 > v3) ...
+    """
+    criteriae = []
+    for i, ((column, direction), value) in enumerate(zip(keyset_columns, values)):
+        equalities = [_equals(c, v) for (c, d), v in zip(keyset_columns[:i], values[:i])]
+        criteriae.append(and_(*equalities, _after(column, direction, value)))
+    return or_(*criteriae)
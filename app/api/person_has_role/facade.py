@@ -9,6 +9,7 @@ class PersonHasRoleFacade(JSONAPIAbstractFacade):
     """
     TYPE = "person-has-role"
     TYPE_PLURAL = "persons-having-roles"
+    PROPAGATED_RELATIONSHIPS = ("person",)
 
     MODEL = PersonHasRole
 
@@ -20,10 +21,10 @@ class PersonHasRoleFacade(JSONAPIAbstractFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "function": self.obj.function,
                 "field": self.obj.field
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -59,7 +60,7 @@ class PersonHasRoleFacade(JSONAPIAbstractFacade):
             }
 
     def get_data_to_index_when_added(self, propagate):
-        return self.get_relationship_data_to_index(rel_name="person")
+        return self.get_propagated_data_to_index()
 
 
 class PersonHasRoleIncludedFacade(PersonHasRoleFacade):
@@ -70,15 +71,15 @@ class PersonHasRoleIncludedFacade(PersonHasRoleFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "function": self.obj.function,
                 "field": self.obj.field,
                 "person_id": self.obj.person_id,
                 "document_id": self.obj.document_id,
                 "role_id": self.obj.person_role_id,
-                "document_title": self.obj.document.title,
-                "document_creation_label": self.obj.document.creation_label
-            },
+                "document_title": lambda: self.obj.document.title,
+                "document_creation_label": lambda: self.obj.document.creation_label
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
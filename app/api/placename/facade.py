@@ -1,4 +1,5 @@
 from sqlalchemy import and_
+from sqlalchemy.orm import selectinload, joinedload
 from app.api.abstract_facade import JSONAPIAbstractChangeloggedFacade, JSONAPIAbstractFacade
 from app.models import Placename
 
@@ -9,6 +10,9 @@ class PlacenameFacade(JSONAPIAbstractChangeloggedFacade):
     """
     TYPE = "placename"
     TYPE_PLURAL = "placenames"
+    PROPAGATED_RELATIONSHIPS = ("documents",)
+    # fields of the indexed documents holding a copy of the label and ref of the placename
+    DOCUMENT_COPY_FIELDS = ("location_dates_from", "location_dates_to", "locations_inlined")
 
     MODEL = Placename
 
@@ -16,6 +20,16 @@ class PlacenameFacade(JSONAPIAbstractChangeloggedFacade):
     def id(self):
         return self.obj.id
 
+    @classmethod
+    def get_loading_options(cls):
+        from app.models import PlacenameHasRole
+        return [
+            selectinload(Placename.changes),
+            selectinload(Placename.placenames_having_roles).options(
+                joinedload(PlacenameHasRole.document), joinedload(PlacenameHasRole.placename_role)
+            ),
+        ]
+
     @staticmethod
     def update_resource(obj, obj_type, attributes, related_resources, append=False):
         # rename the relationship
@@ -28,7 +42,7 @@ class PlacenameFacade(JSONAPIAbstractChangeloggedFacade):
         rel_facade = DocumentFacade if not rel_facade else rel_facade
 
         resIds = [] if self.obj.placenames_having_roles is None else [
-            rel_facade.make_resource_identifier(c_h_r.document.id, rel_facade.TYPE)
+            rel_facade.make_resource_identifier(c_h_r.document_id, rel_facade.TYPE)
             for c_h_r in self.obj.placenames_having_roles
         ]
         return list({object_['id']: object_ for object_ in resIds}.values())
@@ -75,13 +89,13 @@ class PlacenameFacade(JSONAPIAbstractChangeloggedFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "label": self.obj.label,
                 "long": self.obj.long,
                 "lat": self.obj.lat,
                 "ref": self.obj.ref,
-                "functions": self.get_functions_by_placeId(self.obj.id)
-            },
+                "functions": lambda: self.get_functions_by_placeId(self.obj.id)
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -137,16 +151,34 @@ class PlacenameFacade(JSONAPIAbstractChangeloggedFacade):
         if not propagate:
             return placename_data
         else:
-            return placename_data + self.get_relationship_data_to_index(rel_name="documents") + self.get_relationship_data_to_index(
-                rel_name="roles-within-documents")
+            return placename_data + self.get_propagated_data_to_index()
 
-    def remove_from_index(self, propagate):
+    def reindex_updated_attributes(self, attributes):
+        """
+        The documents only hold copies of the label and ref: these copies are updated in place
+        instead of rebuilding the payloads of every document the placename appears in
+        """
+        from app.api.document.facade import DocumentFacade
+        from app.api.search import SearchIndexManager
+        self.add_to_index(propagate=False)
+        if "label" in attributes or "ref" in attributes:
+            SearchIndexManager.update_embedded_entries(
+                index=DocumentFacade.get_index_name(), id_field="placenames.id", fields=self.DOCUMENT_COPY_FIELDS,
+                id=self.id, values={
+                    "facet_key": f'{self.obj.id}###{self.obj.label}',
+                    "label": self.obj.label,
+                    "ref": self.obj.ref
+                }
+            )
+
+    def remove_from_index(self, propagate, indexer=None):
         from app.api.search import SearchIndexManager
-        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id)
+        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id, indexer=indexer)
 
         if propagate:
             # reindex the docs without the resource
             for data in self.get_data_to_index_when_added(propagate):
                 if data["payload"]["id"] != self.id and data["payload"]["type"] != self.TYPE:
                     data["payload"]["placenames"] = [l for l in data["payload"]["placenames"] if l.get("id") != self.id]
-                    SearchIndexManager.add_to_index(index=data["index"], id=data["id"], payload=data["payload"])
+                    SearchIndexManager.add_to_index(index=data["index"], id=data["id"], payload=data["payload"],
+                                                    indexer=indexer)
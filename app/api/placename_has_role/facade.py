@@ -9,6 +9,7 @@ class PlacenameHasRoleFacade(JSONAPIAbstractFacade):
     """
     TYPE = "placename-has-role"
     TYPE_PLURAL = "placenames-having-roles"
+    PROPAGATED_RELATIONSHIPS = ("placename",)
 
     MODEL = PlacenameHasRole
 
@@ -20,10 +21,10 @@ class PlacenameHasRoleFacade(JSONAPIAbstractFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "function": self.obj.function,
                 "field": self.obj.field
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -59,7 +60,7 @@ class PlacenameHasRoleFacade(JSONAPIAbstractFacade):
             }
 
     def get_data_to_index_when_added(self, propagate):
-        return self.get_relationship_data_to_index(rel_name="placename")
+        return self.get_propagated_data_to_index()
 
 
 class PlacenameHasRoleIncludedFacade(PlacenameHasRoleFacade):
@@ -70,15 +71,15 @@ class PlacenameHasRoleIncludedFacade(PlacenameHasRoleFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "function": self.obj.function,
                 "field": self.obj.field,
                 "placename_id": self.obj.placename_id,
                 "document_id": self.obj.document_id,
                 "role_id": self.obj.placename_role_id,
-                "document_title": self.obj.document.title,
-                "document_creation_label": self.obj.document.creation_label
-            },
+                "document_title": lambda: self.obj.document.title,
+                "document_creation_label": lambda: self.obj.document.creation_label
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -20,11 +20,11 @@ class PlacenameRoleFacade(JSONAPIAbstractFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "id": self.obj.id,
                 "label": self.obj.label,
                 "description": self.obj.description
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -1,5 +1,76 @@
 import json
-from flask import Response
+from flask import Response, current_app, has_app_context, stream_with_context
+
+from app.api.instrumentation import get_request_timings, wants_timings
+
+try:
+    # optional, much faster serializer
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def get_json_indent():
+    """ The responses are only indented when debugging """
+    return 2 if has_app_context() and current_app.debug else None
+
+
+def dumps(obj, indent=None):
+    """ Serialize obj into utf-8 encoded json """
+    if orjson is not None and indent is None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    separators = (",", ":") if indent is None else None
+    return json.dumps(obj, indent=indent, ensure_ascii=False, separators=separators).encode("utf-8")
+
+
+# returned by a callable member of a streamed document to leave the member out
+OMITTED = object()
+
+
+def iter_dumps(document, chunk_size=65536):
+    """
+    Serialize a json object piece by piece.
+    The values of its top level members can be iterators, serialized as arrays as their items
+    are produced, or callables, called when the member is reached (eg. the meta section holding
+    the timings of the request, known once the data has been built) and left out when they
+    return OMITTED
+    :param chunk_size: the pieces are gathered into chunks of about chunk_size bytes
+    """
+    buffer = []
+    size = 0
+    for piece in _iter_json_pieces(document):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def _iter_json_pieces(document):
+    yield b"{"
+    num = 0
+    for key, value in document.items():
+        if callable(value):
+            value = value()
+            if value is OMITTED:
+                continue
+        if num > 0:
+            yield b","
+        num += 1
+        yield dumps(key) + b":"
+        if value is None or isinstance(value, (dict, list, str, int, float, bool)):
+            yield dumps(value)
+        else:
+            yield b"["
+            for num_item, item in enumerate(value):
+                if num_item > 0:
+                    yield b","
+                yield dumps(item)
+            yield b"]"
+    yield b"}"
 
 
 class JSONAPIResponseFactory:
@@ -34,19 +105,52 @@ class JSONAPIResponseFactory:
     def encapsulate_errors(cls, resource, links):
         return JSONAPIResponseFactory.encapsulate("errors", resource, links)
 
+    @classmethod
+    def add_timings(cls, resource, streamed=False):
+        """ Add the timings of the request to the meta section of a document, when asked for """
+        if not wants_timings() or not isinstance(resource, dict) or \
+                ("data" not in resource and "errors" not in resource):
+            return resource
+        meta = resource.get("meta") or {}
+        timings = get_request_timings()
+        if streamed:
+            resource["meta"] = lambda: {**meta, "timings": timings.to_dict()}
+        else:
+            resource["meta"] = {**meta, "timings": timings.to_dict()}
+        return resource
+
     @classmethod
     def make_response(cls, resource, **kwargs):
         headers = kwargs.get("headers", {})
         headers.update(JSONAPIResponseFactory.HEADERS)
         if "headers" in kwargs:
             kwargs.pop("headers")
+        resource = JSONAPIResponseFactory.add_timings(resource)
         return Response(
-            json.dumps(resource, indent=2, ensure_ascii=False),
+            dumps(resource, indent=get_json_indent()),
             content_type=JSONAPIResponseFactory.CONTENT_TYPE,
             headers=headers,
             **kwargs
         )
 
+    @classmethod
+    def make_streamed_response(cls, resource, **kwargs):
+        """
+        Stream a document whose members can be iterators or callables (see iter_dumps).
+        The response is never indented
+        """
+        headers = kwargs.get("headers", {})
+        headers.update(JSONAPIResponseFactory.HEADERS)
+        if "headers" in kwargs:
+            kwargs.pop("headers")
+        resource = JSONAPIResponseFactory.add_timings(resource, streamed=True)
+        return Response(
+            stream_with_context(iter_dumps(resource)),
+            content_type=kwargs.pop("content_type", JSONAPIResponseFactory.CONTENT_TYPE),
+            headers=headers,
+            **kwargs
+        )
+
     @classmethod
     def make_raw_response(cls, resource, **kwargs):
         headers = kwargs.get("headers", {})
@@ -65,8 +169,27 @@ class JSONAPIResponseFactory:
         resource = JSONAPIResponseFactory.encapsulate_data(data_resource, buckets, links, included_resources, meta)
         return JSONAPIResponseFactory.make_response(resource, **kwargs)
 
+    @classmethod
+    def make_streamed_data_response(cls, data_resources, links, included_resources, meta, buckets=None, **kwargs):
+        """
+        :param data_resources: an iterator over the resources, serialized as they are produced.
+        The status has been sent when an error interrupts it: the resources produced so far are
+        followed by an errors member, so that the document stays well-formed
+        """
+        errors = []
+
+        def iter_data():
+            try:
+                yield from data_resources
+            except Exception as e:
+                print("streamed response interrupted:", e)
+                errors.append({"status": 500, "title": "The response is incomplete", "detail": str(e)})
+
+        resource = JSONAPIResponseFactory.encapsulate_data(iter_data(), buckets, links, included_resources, meta)
+        resource["errors"] = lambda: errors or OMITTED
+        return JSONAPIResponseFactory.make_streamed_response(resource, **kwargs)
+
     @classmethod
     def make_errors_response(cls, errors_resource, **kwargs):
         resource = JSONAPIResponseFactory.encapsulate_errors(errors_resource, kwargs.get("links", None))
         return JSONAPIResponseFactory.make_response(resource, **kwargs)
-
@@ -2,33 +2,49 @@ import pprint
 import time
 
 import json
-import ast
 import urllib
 import sys
 
+from functools import wraps
 from math import ceil
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from itertools import chain, islice
 
-from flask import request, current_app
+from flask import request, current_app, Response
 
-from sqlalchemy import func, desc, asc, column, text, or_
+from sqlalchemy import func, desc, asc, or_, not_, inspect
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.sql.operators import ColumnOperators
 
 from app import JSONAPIResponseFactory, db
 from app.api.facade_manager import JSONAPIFacadeManager
+from app.api.cache import LRUCache
+from app.api.conditional import conditional_response
+from app.api.filters import build_filter_criteriae, has_property_filters
+from app.api.indexing_queue import is_async_indexing
+from app.api.instrumentation import timed, iter_timed, wants_timings
+from app.api.operations import apply_operations, get_operations_batch
+from app.api.pagination import get_keyset_columns, order_by_keyset, encode_cursor, decode_cursor, keyset_criteria
 from app.api.search import SearchIndexManager
-from app.models import MODELS
+from app.models import MODELS, get_property_filter
 
 if sys.version_info < (3, 6):
     json_loads = lambda s: json_loads(s.decode("utf-8")) if isinstance(s, bytes) else json.loads(s)
 else:
     json_loads = json.loads
 
+# number of rows loaded at once when a filtered property has to be evaluated in python
+PROPERTY_FILTER_BATCH_SIZE = 500
+
+# search parameters holding json encoded facets
+JSON_SEARCH_ARGS = ("recipients", "persons_inlined", "location_dates_to", "locations_inlined")
+
+# a search result built from its indexed payload (source=index), used in place of a facade
+IndexedResource = namedtuple("IndexedResource", ("id", "resource"))
+
 
 # TODO: voir si le param api_version est encore utile (on peut peut-être juste utiliser url_prefix
 # TODO: gérer les références transitives (qui passent par des relations)
-# TODO: gérer les sparse fields
 # TODO: gérer le cas de la pagination dans les links lors des aggregations; virer le link "last"
 
 class JSONAPIRouteRegistrar(object):
@@ -42,6 +58,13 @@ class JSONAPIRouteRegistrar(object):
 
         self.models = MODELS # dict tablename:model class
 
+        # total counts of the filtered listings: (tablename, filters) -> count
+        self.count_cache = LRUCache(maxsize=current_app.config.get("COUNT_CACHE_SIZE", 1024),
+                                    ttl=current_app.config.get("COUNT_CACHE_TTL", 60))
+        # responses of the search and count routes: (index generation, host, path, args) -> response
+        self.search_cache = LRUCache(maxsize=current_app.config.get("SEARCH_CACHE_SIZE", 256),
+                                     ttl=current_app.config.get("SEARCH_CACHE_TTL", 300))
+
     @staticmethod
     def get_relationships_mode(args):
         if "without-relationships" in args:
@@ -82,7 +105,8 @@ class JSONAPIRouteRegistrar(object):
 
             try:
                 # try bring the related resources and add them to the list
-                related_resources = relationships[rel_name]["resource_getter"](asked_facade)
+                with timed("facades"):
+                    related_resources = relationships[rel_name]["resource_getter"](asked_facade)
                 # make unique keys to avoid duplicates
                 if isinstance(related_resources, list):
                     for related_resource in related_resources:
@@ -101,10 +125,136 @@ class JSONAPIRouteRegistrar(object):
 
         return list(included_resources.values()), None
 
+    @staticmethod
+    def merge_included_resources(included_resources, resources):
+        """
+        Add resources to the (type, id) -> resource ordered dict of the included resources,
+        the first occurrence of a resource is kept
+        """
+        for resource in resources:
+            included_resources.setdefault((resource["type"], resource["id"]), resource)
+
+    @staticmethod
+    def sort_by_ids(facade_objs, sorted_ids_list):
+        """
+        Put the facades back in the order of the search results
+        :param sorted_ids_list: the ids (as strings) in the search engine order
+        """
+        # id -> position of its first occurrence in the search results
+        positions = {}
+        for index, sorted_id in enumerate(sorted_ids_list):
+            positions.setdefault(sorted_id, index)
+
+        sorted_facade_objs = [None] * len(sorted_ids_list)
+        for f_obj in facade_objs:
+            index = positions.get(str(f_obj.id))
+            if index is None:
+                raise ValueError("%s is not in the search results" % f_obj.id)
+            sorted_facade_objs[index] = f_obj
+        return [f for f in sorted_facade_objs if f is not None]
+
+    @staticmethod
+    def reindex(f_obj, op, updated_attributes=None):
+        """
+        Reindex a written resource and the resources depending on it, unless the indexing is
+        asynchronous: the changes were then queued along with the write (see app/api/indexing_queue.py).
+        The resources written by an operations batch are reindexed once it is committed (see app/api/operations.py)
+        :param updated_attributes: the attributes of an update which did not touch the relationships
+        """
+        if is_async_indexing():
+            return
+        batch = get_operations_batch()
+        if batch is not None:
+            batch.record(f_obj, op)
+            return
+        with SearchIndexManager.deferred_generation_bump():
+            if updated_attributes is not None:
+                f_obj.reindex_updated_attributes(updated_attributes)
+            else:
+                f_obj.reindex(op, propagate=True)
+
     @staticmethod
     def count(model):
         return db.session.query(func.count('*')).select_from(model).scalar()
 
+    def get_count(self, model, objs_query):
+        """
+        Total count of a filtered listing, cached per (model, filters) until a write on the model
+        goes through the registrar routes or COUNT_CACHE_TTL expires.
+        Filters on python properties are never cached since they can depend on the current time
+        """
+        if not self.count_cache.ttl or has_property_filters(model, request.args):
+            return objs_query.count()
+
+        filters = tuple(sorted((k, v) for k, v in request.args.items() if k.startswith('filter[')))
+        key = (model.__tablename__, filters)
+        count = self.count_cache.get(key)
+        if count is None:
+            count = objs_query.count()
+            self.count_cache.set(key, count)
+        return count
+
+    def invalidate_counts(self, model):
+        """
+        Drop the cached counts of the model and of the models related to it
+        (cascades, foreign keys updated through the relationships)
+        """
+        tablenames = {model.__tablename__}
+        tablenames.update(rel.mapper.class_.__tablename__ for rel in inspect(model).relationships)
+        self.count_cache.invalidate(lambda key: key[0] in tablenames)
+
+    def invalidating_counts(self, model, endpoint):
+        """
+        Wrap a write endpoint so that the cached counts of the model are dropped once it succeeded
+        """
+        @wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            response = current_app.make_response(endpoint(*args, **kwargs))
+            if response.status_code < 400:
+                self.invalidate_counts(model)
+            return response
+        return wrapper
+
+    @staticmethod
+    def canonicalize_args(args):
+        """
+        :return: a hashable form of the request args, independent of the parameters order
+        and of the formatting of the json encoded facets
+        """
+        canonical_args = []
+        for key, values in sorted(args.lists()):
+            if key in JSON_SEARCH_ARGS:
+                try:
+                    values = [json.dumps(json.loads(v), sort_keys=True) for v in values]
+                except json.JSONDecodeError:
+                    pass
+            canonical_args.append((key, tuple(values)))
+        return tuple(canonical_args)
+
+    def cached_search_response(self, endpoint):
+        """
+        Serve the responses of a search endpoint from the search cache.
+        The cache key holds the generation of the indexes, so that any index write invalidates it,
+        whatever the process which sent it (after SEARCH_GENERATION_TTL seconds for the other processes)
+        """
+        @wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            if not self.search_cache.ttl or wants_timings():
+                return endpoint(*args, **kwargs)
+
+            key = (SearchIndexManager.get_generation(), request.host_url, request.path,
+                   JSONAPIRouteRegistrar.canonicalize_args(request.args))
+            cached = self.search_cache.get(key)
+            if cached is not None:
+                data, status, headers = cached
+                return Response(data, status=status, headers=headers)
+
+            response = current_app.make_response(endpoint(*args, **kwargs))
+            if response.status_code == 200:
+                self.search_cache.set(key, (response.get_data(), response.status_code, list(response.headers.items())))
+            return response
+        return wrapper
+
     @staticmethod
     def make_url(url, args):
         url = url.replace("[", "%5B").replace("]", "%5D")
@@ -127,146 +277,79 @@ class JSONAPIRouteRegistrar(object):
     @staticmethod
     def parse_filter_parameter(objs_query, model):
         # if request has filter parameter
-        filter_criteriae = []
-        filter_ids_criteriae = []
-        properties_fieldnames = []
-        filters = [(f, f[len('filter['):-1])  # (filter_param, filter_fieldname)
-                   for f in request.args.keys() if f.startswith('filter[') and f.endswith(']')]
-        print('filters : ', filters)
-        if len(filters) > 0:
-            print('filters : ', filters)
-            for filter_param, filter_fieldname in filters:
-                filter_fieldname = filter_fieldname.replace("-", "_").replace('#', '')
-
-                not_null_operator = filter_fieldname.startswith("!")
-                if not_null_operator:
-                    filter_fieldname = filter_fieldname[1:]
-
-                if not hasattr(model, filter_fieldname):
-                    raise ValueError("cannot parse filter parameter '%s.%s'" % (model, filter_fieldname))
-
-                if isinstance(getattr(model, filter_fieldname), property):
-                    properties_fieldnames.append((filter_param, filter_fieldname, not_null_operator))
-                    continue
-                print('filter_fieldname : ', filter_fieldname)
-                if filter_fieldname == 'user_id':
-                    print('criteriae is list :', ast.literal_eval(request.args[filter_param]))
-                    for criteria in ast.literal_eval(request.args[filter_param]):
-                        criteria_upper = str(criteria).upper()
-                        if criteria_upper == 'TRUE' or criteria_upper == 'FALSE':
-                            new_criteria = "{table}.{field} is {criteria}".format(
-                                table=model.__tablename__,
-                                field=filter_fieldname,
-                                criteria=True if criteria_upper == 'TRUE' else False
-                            )
-                            # print(str(new_criteria))
-                        elif not not_null_operator:
-                            if criteria:
-                                # filter[field]=value
-                                new_criteria = "{table}.{field}{operator}'{criteria}'".format(
-                                    table=model.__tablename__,
-                                    field=filter_fieldname,
-                                    operator="==",
-                                    criteria="{}".format(criteria)
-                                )
-                            else:
-                                # filter[field] means IS NULL
-                                col = "{table}.{field}".format(table=model.__tablename__, field=filter_fieldname)
-                                new_criteria = column(col, is_literal=True).is_(None)
-                        else:
-                            # filter[!field]  means IS NOT NULL
-                            col = "{table}.{field}".format(table=model.__tablename__, field=filter_fieldname)
-                            new_criteria = column(col, is_literal=True).isnot(None)
-
-                        print(str(new_criteria))
-                        filter_ids_criteriae.append(text(str(new_criteria)))
-                        print('filter_ids_criteriae : ', str(filter_ids_criteriae))
-
-                    objs_query = objs_query.filter(or_(*filter_ids_criteriae))
-                else:
-                    for criteria in request.args[filter_param].split(','):
-                        criteria_upper = criteria.upper()
-                        if criteria_upper == 'TRUE' or criteria_upper == 'FALSE':
-                            new_criteria = "{table}.{field} is {criteria}".format(
-                                table=model.__tablename__,
-                                field=filter_fieldname,
-                                criteria=True if criteria_upper == 'TRUE' else False
-                            )
-                            # print(str(new_criteria))
-                        elif not not_null_operator:
-                            if criteria:
-                                # filter[field]=value
-                                new_criteria = "{table}.{field}{operator}'{criteria}'".format(
-                                    table=model.__tablename__,
-                                    field=filter_fieldname,
-                                    operator=" LIKE ",
-                                    criteria="%{}%".format(criteria)
-                                )
-                            else:
-                                # filter[field] means IS NULL
-                                col = "{table}.{field}".format(table=model.__tablename__, field=filter_fieldname)
-                                new_criteria = column(col, is_literal=True).is_(None)
-                        else:
-                            # filter[!field]  means IS NOT NULL
-                            col = "{table}.{field}".format(table=model.__tablename__, field=filter_fieldname)
-                            new_criteria = column(col, is_literal=True).isnot(None)
-
-                        print(str(new_criteria))
-                        filter_criteriae.append(text(str(new_criteria)))
-                        print('filter_criteriae : ', str(filter_criteriae))
-
-                    objs_query = objs_query.filter(*filter_criteriae)
-
-
-            #objs_query = objs_query.filter(*filter_criteriae)
+        filter_criteriae, properties_fieldnames = build_filter_criteriae(model, request.args)
+        if len(filter_criteriae) > 0 or len(properties_fieldnames) > 0:
+            print('filter_criteriae : ', [str(c) for c in filter_criteriae])
+            objs_query = objs_query.filter(*filter_criteriae)
 
             # Filter the 'property fields' after the 'true' model fields
-            filtered_prop_ids = []
             print('len(properties_fieldnames) : ', len(properties_fieldnames))
 
             if len(properties_fieldnames) > 0:
-                for obj in objs_query.all():
-                    for p, p_field, not_null_operator in properties_fieldnames:
-                        if request.args[p] == '':
-                            criteriae = []
-                        else:
-                            criteriae = request.args[p].split(',')
-                        print("p, p_field, prop criteriae:", p, p_field, criteriae)
-                        if not not_null_operator:
-                            if len(criteriae) == 0:
-                                if getattr(obj, p_field,
-                                           False):  # filter[myprop] means myprop is True (in pythonic terms)
-                                    filtered_prop_ids.append(obj.id)
+                # a row is kept as soon as it matches one of the property filters
+                prop_criteriae = []
+                python_properties = []
+                for p, p_field, not_null_operator in properties_fieldnames:
+                    expression = get_property_filter(model, p_field)
+                    if expression is not None and (not_null_operator or request.args[p] == ''):
+                        # filter[myprop] means myprop is True, filter[!myprop] means myprop is False
+                        prop_criteriae.append(not_(expression) if not_null_operator else expression)
+                    else:
+                        python_properties.append((p, p_field, not_null_operator))
+
+                if len(python_properties) > 0:
+                    # no SQL equivalent: evaluate the properties in python, streaming the rows
+                    filtered_prop_ids = []
+                    for obj in objs_query.yield_per(PROPERTY_FILTER_BATCH_SIZE):
+                        for p, p_field, not_null_operator in python_properties:
+                            if request.args[p] == '':
+                                criteriae = []
+                            else:
+                                criteriae = request.args[p].split(',')
+                            if not not_null_operator:
+                                if len(criteriae) == 0:
+                                    if getattr(obj, p_field,
+                                               False):  # filter[myprop] means myprop is True (in pythonic terms)
+                                        filtered_prop_ids.append(obj.id)
+                                else:
+                                    if getattr(obj, p_field, None) in criteriae:  # filter[myprop]=values
+                                        filtered_prop_ids.append(obj.id)
                             else:
-                                if getattr(obj, p_field, None) in criteriae:  # filter[myprop]=values
+                                if not getattr(obj, p_field,
+                                               True):  # filter[!myprop] means myprop is False (in pythonic terms)
                                     filtered_prop_ids.append(obj.id)
-                        else:
-                            if not getattr(obj, p_field,
-                                           True):  # filter[!myprop] means myprop is False (in pythonic terms)
-                                filtered_prop_ids.append(obj.id)
 
-                print("filtered prop id:", filtered_prop_ids)
-                objs_query = objs_query.filter(ColumnOperators.in_(model.id, filtered_prop_ids))
+                    print("filtered prop id:", filtered_prop_ids)
+                    prop_criteriae.append(ColumnOperators.in_(model.id, filtered_prop_ids))
+
+                objs_query = objs_query.filter(or_(*prop_criteriae))
         print('objs_query', objs_query)
         return objs_query
 
     @staticmethod
-    def parse_sort_parameter(objs_query, model):
-        # if request has sorting parameter
+    def get_sort_criteriae(model):
+        """
+        :return: the (column, direction) pairs of the sort parameter
+        """
+        sort_criteriae = []
         if "sort" in request.args:
-            sort_criteriae = []
-            order_criteriae = []
             sort_order = asc
             print('request.args["sort"] : ', request.args["sort"])
             for criteria in request.args["sort"].split(','):
                 if criteria.startswith('-'):
                     sort_order = desc
                     criteria = criteria[1:]
-                sort_criteriae.append(sort_order(getattr(model, criteria.replace("-", "_"))))
-                order_criteriae.append(sort_order)
+                sort_criteriae.append((getattr(model, criteria.replace("-", "_")), sort_order))
                 print('criteria.replace("-", "_") : ', criteria.replace("-", "_"))
             print("sort criteriae: ", sort_criteriae)
-            print("order_criteriae: ", order_criteriae)
+        return sort_criteriae
+
+    @staticmethod
+    def parse_sort_parameter(objs_query, model):
+        # if request has sorting parameter
+        if "sort" in request.args:
+            sort_criteriae = [sort_order(column)
+                              for column, sort_order in JSONAPIRouteRegistrar.get_sort_criteriae(model)]
             # reset the order clause
             objs_query = objs_query.order_by(False)
             # then apply the user order criteriae
@@ -288,7 +371,54 @@ class JSONAPIRouteRegistrar(object):
         return ranges
 
 
-    def search(self, index, query, ranges, groupby, sort_criteriae, page_id, page_size, page_after, highlight=None, searchtype=None, published=None, collectionsfacets=None, senders_facets=None, recipients_facets=None, persons_inlined_facets=None, location_dates_from_facets=None, location_dates_to_facets=None, locations_inlined_facets=None):
+    @staticmethod
+    def parse_fields_parameter():
+        """
+        fields[type]=attr1,attr2
+        :return: the requested attributes by resource type
+        """
+        fields = {}
+        for param, value in request.args.items():
+            if param.startswith("fields[") and param.endswith("]"):
+                fields[param[len("fields["):-1]] = [f for f in value.split(",") if f]
+        return fields
+
+    @staticmethod
+    def parse_facets_parameter():
+        """
+        - facets=name1,name2   aggregate only these facets (facets= for none), all of them by default for the front end searches
+        - facets[size]=N       number of buckets per facet, bounded by SEARCH_FACETS_MAX_SIZE
+        - facets[prefix]=abc   only the buckets whose label starts with abc (type-ahead)
+        - facets[only]         do not return any resource, only the total and the facets
+        :return: facets (None if not asked), size, prefix, only
+        """
+        facets = None
+        if "facets" in request.args:
+            facets = [f.replace("-", "_") for f in request.args["facets"].split(",") if f]
+
+        facets_size = None
+        if "facets[size]" in request.args:
+            facets_size = int(request.args["facets[size]"])
+            if facets_size <= 0:
+                raise ValueError("facets[size] must be positive")
+            facets_size = min(facets_size, int(current_app.config.get("SEARCH_FACETS_MAX_SIZE", 10000)))
+        elif facets is not None:
+            facets_size = int(current_app.config.get("SEARCH_FACETS_SIZE", 100))
+
+        facets_prefix = request.args.get("facets[prefix]") or None
+        facets_only = "facets[only]" in request.args
+        return facets, facets_size, facets_prefix, facets_only
+
+    def search(self, index, query, ranges, groupby, sort_criteriae, page_id, page_size, page_after, highlight=None, searchtype=None, published=None, collectionsfacets=None, senders_facets=None, recipients_facets=None, persons_inlined_facets=None, location_dates_from_facets=None, location_dates_to_facets=None, locations_inlined_facets=None, facets=None, facets_size=None, facets_prefix=None, facets_only=False, from_index=False):
+        """
+        :param from_index: build the resources from the indexed payloads instead of loading the objects
+        (the hits payloads are restricted to the fields[type] attributes)
+        """
+        source_includes = None
+        if from_index:
+            fields = JSONAPIRouteRegistrar.parse_fields_parameter()
+            source_includes = sorted({f for type_fields in fields.values() for f in type_fields}) or ["*"]
+
         # query the search engine
         print("\ndef search published index / collectionsfacets / senders_facets, recipients_facets, persons_inlined_facets, location_dates_from_facets, location_dates_to_facets, locations_inlined_facets : \n", index, published, collectionsfacets, senders_facets, recipients_facets, persons_inlined_facets, location_dates_from_facets, location_dates_to_facets, locations_inlined_facets)
 
@@ -310,7 +440,12 @@ class JSONAPIRouteRegistrar(object):
             highlight=highlight,
             page=page_id,
             after=page_after,
-            per_page=page_size
+            per_page=page_size,
+            facets=facets,
+            facets_size=facets_size,
+            facets_prefix=facets_prefix,
+            facets_only=facets_only,
+            source_includes=source_includes
         )
         print("\nESresponse :\n", (results, buckets, after_key, total))
         #print('def search total from query_index :', total)
@@ -319,7 +454,17 @@ class JSONAPIRouteRegistrar(object):
             return [], [], [], {}, {"total": 0}
 
         res_dict = {}
-        if groupby is None:
+        if from_index:
+            url_prefix = request.host_url[:-1] + self.url_prefix
+            for res in results:
+                facade_class = JSONAPIFacadeManager.get_facade_class_from_facade_type(
+                    res.type, request.args.get("facade", "search")
+                )
+                if facade_class is None:
+                    raise ValueError("cannot build the '%s' resources from the index" % res.type)
+                resource = facade_class.make_resource_from_index(url_prefix, res.source, fields.get(facade_class.TYPE))
+                res_dict.setdefault(res.type.replace("-", "_"), []).append(IndexedResource(res.id, resource))
+        elif groupby is None:
             for res in results:
                 res_type = res.type.replace("-", "_")
                 if res_type not in res_dict:
@@ -349,17 +494,22 @@ class JSONAPIRouteRegistrar(object):
             print("ids fetched !")
             print('res_dict', res_dict)
 
-        # build the query to get objects from their ids
-        for res_type, res_ids in res_dict.items():
-            when = []
-            for i, id in enumerate(res_ids):
-                when.append((id, i))
-
-            m = self.models[res_type]
-            print('model', m)
-            res_dict[res_type] = db.session.query(m).filter(m.id.in_(res_ids))
-            if len(when) > 0:
-                res_dict[res_type] = res_dict[res_type].order_by(db.case(when, value=m.id))
+        if not from_index:
+            # build the query to get objects from their ids
+            for res_type, res_ids in res_dict.items():
+                when = []
+                for i, id in enumerate(res_ids):
+                    when.append((id, i))
+
+                m = self.models[res_type]
+                print('model', m)
+                facade_class = JSONAPIFacadeManager.get_facade_class_from_facade_type(
+                    res_type, request.args.get("facade", "search")
+                )
+                loading_options = facade_class.get_request_loading_options() if facade_class else []
+                res_dict[res_type] = db.session.query(m).options(*loading_options).filter(m.id.in_(res_ids))
+                if len(when) > 0:
+                    res_dict[res_type] = res_dict[res_type].order_by(db.case(when, value=m.id))
         print("res_dict: ", res_dict)
         print({"total": total, "after": after_key})
 
@@ -374,48 +524,11 @@ class JSONAPIRouteRegistrar(object):
         count_rule = '/api/{api_version}/count'.format(api_version=self.api_version)
 
         def count_search():
-            index = current_app.config["DEFAULT_INDEX_NAME"]
+            """
+            Landing page counters, answered from the stats store (see app/api/count_stats.py)
+            """
             published = request.args["published"] if "published" in request.args else False
-            query_body={
-                "query": {
-                    "match_all": {}
-                },
-                "size": 0,
-                "track_total_hits": True,
-                "aggregations": {
-                    "person_count": {
-                        "cardinality": {
-                            "field": "persons.id"
-                        }
-                    },
-                    "place_count": {
-                        "cardinality": {
-                            "field": "placenames.id"
-                        }
-                    },
-                    "collections": {
-                        "terms": {
-                            "field": "collections.id",
-                            "size": 100000
-                        }
-                    },
-                    "parents": {
-                        "terms": {
-                            "field": "collections.parents.keyword",
-                            "size": 100000
-                        }
-                    }
-                }
-            }
-            if published:
-                query_body["query"] = {
-                    "term": { "is-published": True }
-                }
-            search = current_app.elasticsearch.search(index=index, body=query_body)
-
-            collection_set = set([x["key"] for x in search["aggregations"]["collections"]["buckets"]])
-            parent_set = set([x["key"] for x in search["aggregations"]["parents"]["buckets"]])
-            collection_count = len(collection_set.union(parent_set))
+            counts = current_app.count_stats.get(published=bool(published))
             # in case default collection is needed add cCollection in import and select with default_collection = Collection.query.filter_by(title=current_app.config["UNSORTED_DOCUMENTS_COLLECTION_TITLE"]).first()
 
             #if published:
@@ -423,18 +536,56 @@ class JSONAPIRouteRegistrar(object):
 
             response = JSONAPIResponseFactory.make_response(
                 {
-                    "documents": search["hits"]["total"]["value"],
-                    "persons": search["aggregations"]["person_count"]["value"],
-                    "placenames": search["aggregations"]["place_count"]["value"],
-                    "collections" : collection_count
+                    "documents": counts["documents"],
+                    "persons": counts["persons"],
+                    "placenames": counts["placenames"],
+                    "collections" : counts["collections"]
                 }
             )
             return response
 
+        count_search = self.cached_search_response(count_search)
+
         # register the rule
         current_app.add_url_rule(count_rule,  view_func=count_search)
 
 
+    def register_operations_route(self, decorators=()):
+        """
+        Apply a list of writes in a single transaction (JSON:API atomic extension, see app/api/operations.py)
+        """
+        operations_rule = '/api/{api_version}/operations'.format(api_version=self.api_version)
+
+        def operations_endpoint():
+            try:
+                request_data = json_loads(request.data)
+            except json.decoder.JSONDecodeError as e:
+                return JSONAPIResponseFactory.make_errors_response(
+                    {"status": 400, "title": "The request body is malformed", "detail": str(e)}, status=400
+                )
+
+            operations = request_data.get("atomic:operations") if isinstance(request_data, dict) else None
+            if not isinstance(operations, list) or not operations:
+                return JSONAPIResponseFactory.make_errors_response(
+                    {"status": 400, "title": "Missing 'atomic:operations' section"}, status=400
+                )
+            max_count = current_app.config["OPERATIONS_MAX_COUNT"]
+            if len(operations) > max_count:
+                return JSONAPIResponseFactory.make_errors_response(
+                    {"status": 413, "title": "Too many operations (%s max)" % max_count}, status=413
+                )
+
+            url_prefix = request.host_url[:-1] + self.url_prefix
+            return apply_operations(operations, self.api_version, url_prefix)
+
+        # APPLY decorators if any
+        for dec in decorators:
+            operations_endpoint = dec(operations_endpoint)
+
+        # register the rule
+        current_app.add_url_rule(operations_rule, endpoint="operations_endpoint", view_func=operations_endpoint,
+                                 methods=["POST"])
+
     def register_search_route(self, decorators=()):
 
         search_rule = '/api/{api_version}/search'.format(api_version=self.api_version)
@@ -522,6 +673,32 @@ class JSONAPIRouteRegistrar(object):
                     num_page = 1
                     page_size = int(current_app.config["SEARCH_RESULT_PER_PAGE"])
 
+            try:
+                facets, facets_size, facets_prefix, facets_only = JSONAPIRouteRegistrar.parse_facets_parameter()
+            except ValueError as e:
+                return JSONAPIResponseFactory.make_errors_response(
+                    {"status": 400, "title": "Wrong facets parameters", "detail": str(e)}, status=400
+                )
+
+            # source=index builds the resources from the indexed payloads, without any SQL query
+            source = request.args.get("source", "db")
+            if source not in ("db", "index"):
+                return JSONAPIResponseFactory.make_errors_response(
+                    {"status": 400, "title": "Wrong source parameter", "detail": "source must be 'db' or 'index'"},
+                    status=400
+                )
+            from_index = source == "index"
+            if from_index:
+                sql_params = [p for p in request.args.keys() if p.startswith("filter[") or p == "include"]
+                if groupby or sql_params:
+                    return JSONAPIResponseFactory.make_errors_response({
+                        "status": 400,
+                        "title": "Wrong source parameter",
+                        "detail": "source=index cannot be used with %s" % ", ".join(
+                            (["groupby"] if groupby else []) + sql_params
+                        )
+                    }, status=400)
+
             # Search, retrieve, filter, sort and paginate objs
             sort_criteriae = None
             if "sort" in request.args and request.args["sort"]:
@@ -554,7 +731,12 @@ class JSONAPIRouteRegistrar(object):
                     highlight=highlight,
                     page_id=num_page,
                     page_after=request.args["page[after]"] if "page[after]" in request.args else None,
-                    page_size=page_size
+                    page_size=page_size,
+                    facets=facets,
+                    facets_size=facets_size,
+                    facets_prefix=facets_prefix,
+                    facets_only=facets_only,
+                    from_index=from_index
                 )
                 print("\nroute_registrar.py search_endpoint searchtype ressource one : \n",
                       sorted_ids_list[0] if len(sorted_ids_list) > 0 else "No sorted_ids_list")
@@ -573,7 +755,9 @@ class JSONAPIRouteRegistrar(object):
                 sorted_facade_objs = []
                 included_resources = None
             else:
-                for idx in res.keys():
+                # the resource types to load from the database (none with source=index)
+                db_res_types = [] if from_index else list(res.keys())
+                for idx in db_res_types:
                     # FILTER
                     # post process filtering
                     try:
@@ -615,7 +799,7 @@ class JSONAPIRouteRegistrar(object):
 
                 try:
                     #print('res.keys()', res.keys())
-                    for idx in res.keys():
+                    for idx in db_res_types:
                         res[idx] = res[idx].all()
                         #print('idx, res[idx]', idx, res[idx])
                 except Exception as e:
@@ -659,9 +843,12 @@ class JSONAPIRouteRegistrar(object):
 
                 # finally make the facades
                 facade_objs = []
-                sorted_facade_objs = [None] * len(sorted_ids_list)
 
                 for idx, r in res.items():
+                    if from_index:
+                        # already built from the index
+                        facade_objs.extend(r)
+                        continue
                     for obj in r:
                         facade_class_type = request.args["facade"] if "facade" in request.args else "search"
                         facade_class = JSONAPIFacadeManager.get_facade_class(obj, facade_class_type)
@@ -674,16 +861,7 @@ class JSONAPIRouteRegistrar(object):
                 if groupby is None:
                     # print([(i, o)for i, o in enumerate(sorted_ids_list)])
                     # print([(i, o.id) for i, o in enumerate(facade_objs)])
-                    for f_obj in facade_objs:
-                        try:
-                            index = sorted_ids_list.index(str(f_obj.id))
-                            sorted_facade_objs[index] = f_obj
-                        except (ValueError, IndexError) as e:
-                            # print([o.id if o else None for o in sorted_facade_objs])
-                            # print("Not in list", index, f_obj.id, f_obj.obj.label)
-                            raise e
-
-                    sorted_facade_objs = [f for f in sorted_facade_objs if f is not None]
+                    sorted_facade_objs = JSONAPIRouteRegistrar.sort_by_ids(facade_objs, sorted_ids_list)
                     #print('sorted_facade_objs not groupby', sorted_facade_objs)
                 else:
                     # TODO gerer le groupby quand pas sur le doctype ? à revérifier
@@ -693,7 +871,7 @@ class JSONAPIRouteRegistrar(object):
                 # find out if related resources must be included too
                 included_resources = None
                 if "include" in request.args:
-                    included_resources = []
+                    included_resources = OrderedDict()
                     for facade_obj in sorted_facade_objs:
                         included_res, errors = JSONAPIRouteRegistrar.get_included_resources(
                             request.args["include"].split(','),
@@ -703,14 +881,16 @@ class JSONAPIRouteRegistrar(object):
                             pass
                             # return errors
                         # extend the included_res but avoid duplicates
-                        for _res in included_res:
-                            if (_res["type"], _res["id"]) not in [(r["type"], r["id"]) for r in included_resources]:
-                                included_resources.append(_res)
-                        # included_resources.extend(included_res)
+                        JSONAPIRouteRegistrar.merge_included_resources(included_resources, included_res)
+                    included_resources = list(included_resources.values())
 
-            resources = [f.resource for f in sorted_facade_objs]
+            with timed("facades"):
+                resources = [f.resource for f in sorted_facade_objs]
 
-            if searchtype:
+            if facets is not None:
+                if not buckets:
+                    buckets = {facet: [] for facet in facets}
+            elif searchtype:
                 if not buckets:
                     buckets = {
                         "persons": [],
@@ -724,35 +904,38 @@ class JSONAPIRouteRegistrar(object):
                     }
             if (searchtype and query) or (highlight and query):
                 print('\nsorted_highlights : ', sorted_highlights, '\n')
+                highlights_by_id = {}
+                for sorted_highlight in sorted_highlights:
+                    highlights_by_id.setdefault(sorted_highlight["id"], []).append(sorted_highlight)
                 for resource in resources:
                     if resource['type'] == 'document':
                         print('\nresource["type"] & resource["id"]', resource["type"], resource["id"], '\n')
-                        for sorted_highlight in sorted_highlights:
-                            if resource["id"] == sorted_highlight["id"]:
-                                if sorted_highlight["highlight"]:
-                                    for res_attrib in sorted_highlight["highlight"]:
-                                        if searchtype == "fulltext":
-                                            if res_attrib == "transcription" or res_attrib == "address":
-                                                if not isinstance(resource["attributes"]["transcription"], dict):
-                                                    resource["attributes"]["transcription"] = {'raw': resource["attributes"]["transcription"], 'highlight': []}
-                                                #print('\nsorted_highlight["highlight"][res_attrib] : ', sorted_highlight["highlight"][res_attrib])
-                                                for index, item in enumerate(sorted_highlight["highlight"][res_attrib]):
-                                                    resource["attributes"]["transcription"]["highlight"].append(sorted_highlight["highlight"][res_attrib][index])
-                                                    #print("\n resource['attributes']['transcription']['highlight']: \n", resource["attributes"]["transcription"]["highlight"])
-
-                                        elif searchtype == "paratext":
-                                            if res_attrib == "argument":
-                                                resource["attributes"]["argument"] = {'raw': resource["attributes"]["argument"], 'highlight': []}
-                                                for index, item in enumerate(sorted_highlight["highlight"][res_attrib]):
-                                                    resource["attributes"]["argument"]["highlight"].append(sorted_highlight["highlight"][res_attrib][index])
-                                        else:
-                                            if res_attrib in resource["attributes"]:
-                                                resource["attributes"][res_attrib] = {
-                                                    'raw': resource["attributes"][res_attrib],
-                                                    'highlight': sorted_highlight["highlight"][res_attrib]
-                                                }
-                                if sorted_highlight["score"]:
-                                    resource["score"] = sorted_highlight["score"]
+                        for sorted_highlight in highlights_by_id.get(resource["id"], []):
+                            if sorted_highlight["highlight"]:
+                                for res_attrib in sorted_highlight["highlight"]:
+                                    if searchtype == "fulltext":
+                                        # the highlighted attributes may have been left out by fields[document]
+                                        if (res_attrib == "transcription" or res_attrib == "address") and "transcription" in resource["attributes"]:
+                                            if not isinstance(resource["attributes"]["transcription"], dict):
+                                                resource["attributes"]["transcription"] = {'raw': resource["attributes"]["transcription"], 'highlight': []}
+                                            #print('\nsorted_highlight["highlight"][res_attrib] : ', sorted_highlight["highlight"][res_attrib])
+                                            for index, item in enumerate(sorted_highlight["highlight"][res_attrib]):
+                                                resource["attributes"]["transcription"]["highlight"].append(sorted_highlight["highlight"][res_attrib][index])
+                                                #print("\n resource['attributes']['transcription']['highlight']: \n", resource["attributes"]["transcription"]["highlight"])
+
+                                    elif searchtype == "paratext":
+                                        if res_attrib == "argument" and "argument" in resource["attributes"]:
+                                            resource["attributes"]["argument"] = {'raw': resource["attributes"]["argument"], 'highlight': []}
+                                            for index, item in enumerate(sorted_highlight["highlight"][res_attrib]):
+                                                resource["attributes"]["argument"]["highlight"].append(sorted_highlight["highlight"][res_attrib][index])
+                                    else:
+                                        if res_attrib in resource["attributes"]:
+                                            resource["attributes"][res_attrib] = {
+                                                'raw': resource["attributes"][res_attrib],
+                                                'highlight': sorted_highlight["highlight"][res_attrib]
+                                            }
+                            if sorted_highlight["score"]:
+                                resource["score"] = sorted_highlight["score"]
 
             print('\nRESOURCE sample (first) : ', resources[0] if len(resources) > 0 else "No ressource",'\n')
             res_meta = {
@@ -771,6 +954,8 @@ class JSONAPIRouteRegistrar(object):
             )
             return response
 
+        search_endpoint = self.cached_search_response(search_endpoint)
+
         # APPLY decorators if any
         for dec in decorators:
             search_endpoint = dec(search_endpoint)
@@ -803,6 +988,7 @@ class JSONAPIRouteRegistrar(object):
               filter[field_name]=searched_value
               filter[!field_name] means IS NOT NULL
               filter[field_name] means IS NULL
+              filter[field_name][op]=value with op in eq, prefix, contains, in, range (see app/api/filters.py)
               field_name MUST be a mapped field of the underlying queried model
             - Sorting syntax :
               The sort respects the fields order :
@@ -815,6 +1001,12 @@ class JSONAPIRouteRegistrar(object):
               If the page number is omitted, it is set to 1
               Provide self,first,last,prev,next links for the collection (top-level)
               Omit the prev link if the current page is the first one, omit the next link if it is the last one
+            - Keyset pagination syntax: page[after]=cursor&page[size]=100
+              The first page is requested with an empty cursor, the next link carries the cursor of the following page.
+              The rows are ordered by the sort parameter (then by id) and the total count is only computed
+              when meta[count] is given
+            - Total count: cached per filter set until the next write on the model,
+              meta[count]=none skips it (the last link is then omitted)
             - Related resource inclusion :
               ?include=relationname1,relationname2
             - Relationships inclusion
@@ -839,8 +1031,8 @@ class JSONAPIRouteRegistrar(object):
             if "facade" in request.args:
                 facade_class = JSONAPIFacadeManager.get_facade_class(model, request.args["facade"])
 
-            objs_query = model.query
             try:
+                objs_query = model.query
 
                 # if request has pagination parameters
                 # add links to the top-level object
@@ -856,34 +1048,82 @@ class JSONAPIRouteRegistrar(object):
 
                 # FILTER
                 objs_query = JSONAPIRouteRegistrar.parse_filter_parameter(objs_query, model)
-                # SORT
-                objs_query = JSONAPIRouteRegistrar.parse_sort_parameter(objs_query, model)
-
-                pagination_obj = objs_query.paginate(num_page, page_size, False)
-                all_objs = pagination_obj.items
                 args = OrderedDict(request.args)
 
-                count = objs_query.count()
-                nb_pages = max(1, ceil(count / page_size))
+                if "page[after]" in request.args:
+                    # keyset pagination: the total count is only computed on demand
+                    keyset_columns = get_keyset_columns(model, JSONAPIRouteRegistrar.get_sort_criteriae(model))
+                    count_mode = request.args.get("meta[count]", "none")
+                    count = self.get_count(model, objs_query) if count_mode != "none" else None
 
-                keep_pagination = "page[size]" in args or "page[number]" in args or count > page_size
-                if keep_pagination:
+                    page_query = order_by_keyset(objs_query, keyset_columns)
+                    if request.args["page[after]"]:
+                        page_query = page_query.filter(
+                            keyset_criteria(keyset_columns, decode_cursor(request.args["page[after]"], keyset_columns))
+                        )
+                    # fetch one more object to know if there is a next page
+                    all_objs = page_query.options(*facade_class.get_request_loading_options()).limit(page_size + 1).all()
+                    has_next = len(all_objs) > page_size
+                    all_objs = all_objs[:page_size]
+
+                    args.pop("page[number]", None)
                     args["page[size]"] = page_size
-                links["self"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
+                    links["self"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
+                    args["page[after]"] = ""
+                    links["first"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
+                    if has_next:
+                        args["page[after]"] = encode_cursor(all_objs[-1], keyset_columns)
+                        links["next"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
+                elif request.args.get("meta[count]") == "none":
+                    # SORT
+                    objs_query = JSONAPIRouteRegistrar.parse_sort_parameter(objs_query, model)
 
-                if keep_pagination:
+                    # no total count: fetch one more object to know if there is a next page
+                    all_objs = objs_query.options(*facade_class.get_request_loading_options()) \
+                        .limit(page_size + 1).offset((num_page - 1) * page_size).all()
+                    has_next = len(all_objs) > page_size
+                    all_objs = all_objs[:page_size]
+                    count = None
+
+                    args["page[size]"] = page_size
+                    links["self"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
                     args["page[number]"] = 1
                     links["first"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
-                    args["page[number]"] = nb_pages
-                    links["last"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
                     if num_page > 1:
-                        n = max(1, num_page - 1)
-                        if n * page_size <= count:
-                            args["page[number]"] = max(1, num_page - 1)
-                            links["prev"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
-                    if num_page < nb_pages:
-                        args["page[number]"] = min(nb_pages, num_page + 1)
+                        args["page[number]"] = num_page - 1
+                        links["prev"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
+                    if has_next:
+                        args["page[number]"] = num_page + 1
                         links["next"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
+                else:
+                    # SORT
+                    objs_query = JSONAPIRouteRegistrar.parse_sort_parameter(objs_query, model)
+
+                    # the loading options only apply to the page of objects, not to the count query
+                    all_objs = objs_query.options(*facade_class.get_request_loading_options()) \
+                        .limit(page_size).offset((num_page - 1) * page_size).all()
+
+                    count = self.get_count(model, objs_query)
+                    nb_pages = max(1, ceil(count / page_size))
+
+                    keep_pagination = "page[size]" in args or "page[number]" in args or count > page_size
+                    if keep_pagination:
+                        args["page[size]"] = page_size
+                    links["self"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
+
+                    if keep_pagination:
+                        args["page[number]"] = 1
+                        links["first"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
+                        args["page[number]"] = nb_pages
+                        links["last"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
+                        if num_page > 1:
+                            n = max(1, num_page - 1)
+                            if n * page_size <= count:
+                                args["page[number]"] = max(1, num_page - 1)
+                                links["prev"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
+                        if num_page < nb_pages:
+                            args["page[number]"] = min(nb_pages, num_page + 1)
+                            links["next"] = JSONAPIRouteRegistrar.make_url(request.base_url, args)
 
                 # should we retrieve relationships too ?
                 w_rel_links, w_rel_data = JSONAPIRouteRegistrar.get_relationships_mode(request.args)
@@ -895,7 +1135,7 @@ class JSONAPIRouteRegistrar(object):
                 # find out if related resources must be included too
                 included_resources = None
                 if "include" in request.args:
-                    included_resources = []
+                    included_resources = OrderedDict()
                     for facade_obj in facade_objs:
                         included_res, errors = JSONAPIRouteRegistrar.get_included_resources(
                             request.args["include"].split(','),
@@ -904,15 +1144,18 @@ class JSONAPIRouteRegistrar(object):
                         if errors:
                             return errors
                         # extend the included_res but avoid duplicates
-                        for _res in included_res:
-                            if (_res["type"], _res["id"]) not in [(r["type"], r["id"]) for r in included_resources]:
-                                included_resources.append(_res)
-
-                return JSONAPIResponseFactory.make_data_response(
-                    [obj.resource for obj in facade_objs],
+                        JSONAPIRouteRegistrar.merge_included_resources(included_resources, included_res)
+                    included_resources = list(included_resources.values())
+
+                # the resources are built while the response is sent, but the first one is built
+                # now so that a facade error is still answered with a 400
+                resources = iter_timed("facades", (obj.resource for obj in facade_objs))
+                first_resources = list(islice(resources, 1))
+                return JSONAPIResponseFactory.make_streamed_data_response(
+                    chain(first_resources, resources),
                     links=links,
                     included_resources=included_resources,
-                    meta={"total-count": count}
+                    meta={"total-count": count} if count is not None else None
                 )
 
             except (AttributeError, ValueError, OperationalError) as e:
@@ -921,6 +1164,8 @@ class JSONAPIRouteRegistrar(object):
                     {"status": 400, "detail": str(e)}, status=400
                 )
 
+        collection_endpoint = conditional_response(collection_endpoint)
+
         # APPLY decorators if any
         for dec in decorators:
             collection_endpoint = dec(collection_endpoint)
@@ -985,10 +1230,14 @@ class JSONAPIRouteRegistrar(object):
                     if errors:
                         return errors
 
+                with timed("facades"):
+                    resource = f_obj.resource
                 return JSONAPIResponseFactory.make_data_response(
-                    f_obj.resource, links=links, included_resources=included_resources, meta=None
+                    resource, links=links, included_resources=included_resources, meta=None
                 )
 
+        single_obj_endpoint = conditional_response(single_obj_endpoint)
+
         # APPLY decorators if any
         for dec in decorators:
             single_obj_endpoint = dec(single_obj_endpoint)
@@ -1090,6 +1339,8 @@ class JSONAPIRouteRegistrar(object):
                         {"status": 400, "detail": str(e)}, status=400
                     )
 
+        resource_relationship_endpoint = conditional_response(resource_relationship_endpoint)
+
         # APPLY decorators if any
         for dec in decorators:
             resource_relationship_endpoint = dec(resource_relationship_endpoint)
@@ -1132,7 +1383,8 @@ class JSONAPIRouteRegistrar(object):
                 return JSONAPIResponseFactory.make_errors_response(errors, **kwargs)
             else:
                 relationship = f_obj.relationships[rel_name]
-                resource_data = relationship["resource_getter"]()
+                with timed("facades"):
+                    resource_data = relationship["resource_getter"]()
                 if resource_data is None:
                     count = 0
                 else:
@@ -1182,7 +1434,7 @@ class JSONAPIRouteRegistrar(object):
 
                     # get the related resources to include
                     if "include" in request.args:
-                        included_resources = []
+                        included_resources = OrderedDict()
                         for res in resource_data:
                             f_class = JSONAPIFacadeManager.get_facade_class_from_facade_type(res["type"])
                             f_obj, kwargs, errors = f_class.get_resource_facade(
@@ -1195,11 +1447,10 @@ class JSONAPIRouteRegistrar(object):
                                 f_obj
                             )
                             # extend the included_res but avoid duplicates
-                            for _res in i_resources:
-                                if (_res["type"], _res["id"]) not in [(r["type"], r["id"]) for r in included_resources]:
-                                    included_resources.append(_res)
+                            JSONAPIRouteRegistrar.merge_included_resources(included_resources, i_resources)
                             if errors:
                                 return errors
+                        included_resources = list(included_resources.values())
                     # respond
                     return JSONAPIResponseFactory.make_data_response(
                         resource_data, links=links, included_resources=included_resources, meta={"total-count": count},
@@ -1210,6 +1461,8 @@ class JSONAPIRouteRegistrar(object):
                         {"status": 400, "detail": str(e)}, status=400
                     )
 
+        resource_endpoint = conditional_response(resource_endpoint)
+
         # APPLY decorators if any
         for dec in decorators:
             resource_endpoint = dec(resource_endpoint)
@@ -1336,7 +1589,7 @@ class JSONAPIRouteRegistrar(object):
                                          with_relationships_data=w_rel_data)
 
                     # reindex
-                    f_obj.reindex("insert", propagate=True)
+                    self.reindex(f_obj, "insert")
 
                     # RESPOND 201 CREATED
                     if "links" in f_obj.resource and "self" in f_obj.resource["links"]:
@@ -1350,6 +1603,8 @@ class JSONAPIRouteRegistrar(object):
                 else:
                     return JSONAPIResponseFactory.make_errors_response(e, status=e.get("status", 403))
 
+        collection_endpoint = self.invalidating_counts(model, collection_endpoint)
+
         # APPLY decorators if any
         for dec in decorators:
             collection_endpoint = dec(collection_endpoint)
@@ -1415,7 +1670,7 @@ class JSONAPIRouteRegistrar(object):
                                          with_relationships_data=w_rel_data)
 
                     # reindex
-                    f_obj.reindex("insert", propagate=True)
+                    self.reindex(f_obj, "insert")
 
                     # RESPOND 200
                     if "links" in f_obj.resource and "self" in f_obj.resource["links"]:
@@ -1429,6 +1684,11 @@ class JSONAPIRouteRegistrar(object):
                 else:
                     return JSONAPIResponseFactory.make_errors_response(e, status=e.get("status", 400))
 
+        # relationship writes may change the foreign keys of the related models
+        resource_relationship_endpoint = self.invalidating_counts(
+            self.models[facade_class.TYPE.replace("-", "_")], resource_relationship_endpoint
+        )
+
         # APPLY decorators if any
         for dec in decorators:
             resource_relationship_endpoint = dec(resource_relationship_endpoint)
@@ -1564,7 +1824,7 @@ class JSONAPIRouteRegistrar(object):
                                          with_relationships_data=True)
 
                     # reindex
-                    f_obj.reindex("update", propagate=True)
+                    self.reindex(f_obj, "update", updated_attributes=None if relationships else attributes)
 
                     # RESPOND 200
                     if "links" in f_obj.resource and "self" in f_obj.resource["links"]:
@@ -1578,6 +1838,8 @@ class JSONAPIRouteRegistrar(object):
                 else:
                     return JSONAPIResponseFactory.make_errors_response(e, status=e.get("status", 400))
 
+        single_obj_endpoint = self.invalidating_counts(model, single_obj_endpoint)
+
         # APPLY decorators if any
         for dec in decorators:
             single_obj_endpoint = dec(single_obj_endpoint)
@@ -1650,7 +1912,7 @@ class JSONAPIRouteRegistrar(object):
                                          with_relationships_data=True)
 
                     # reindex
-                    f_obj.reindex("update", propagate=True)
+                    self.reindex(f_obj, "update")
 
                     # RESPOND 200
                     if "links" in f_obj.resource and "self" in f_obj.resource["links"]:
@@ -1664,6 +1926,11 @@ class JSONAPIRouteRegistrar(object):
                 else:
                     return JSONAPIResponseFactory.make_errors_response(e, status=e.get("status", 400))
 
+        # relationship writes may change the foreign keys of the related models
+        resource_relationship_endpoint = self.invalidating_counts(
+            self.models[facade_class.TYPE.replace("-", "_")], resource_relationship_endpoint
+        )
+
         # APPLY decorators if any
         for dec in decorators:
             resource_relationship_endpoint = dec(resource_relationship_endpoint)
@@ -1709,15 +1976,17 @@ class JSONAPIRouteRegistrar(object):
             # =====================
             f_obj = facade_class("", obj)
             # reindex
-            f_obj.reindex("delete", propagate=True)
+            self.reindex(f_obj, "delete")
             errors = facade_class.delete_resource(obj)
 
             if errors is not None:
-                f_obj.reindex("insert", propagate=True) # entry has been deleted
+                self.reindex(f_obj, "insert") # entry has been deleted
                 return JSONAPIResponseFactory.make_errors_response(errors, status=404)
 
             return JSONAPIResponseFactory.make_data_response(None, None, None, None, status=204)
 
+        single_obj_endpoint = self.invalidating_counts(model, single_obj_endpoint)
+
         # APPLY decorators if any
         for dec in decorators:
             single_obj_endpoint = dec(single_obj_endpoint)
@@ -1791,10 +2060,15 @@ class JSONAPIRouteRegistrar(object):
             if errors is not None:
                 return JSONAPIResponseFactory.make_errors_response(errors, status=404)
 
-            f_obj.reindex("update", propagate=True)
+            self.reindex(f_obj, "update")
 
             return JSONAPIResponseFactory.make_data_response(None, None, None, None, status=204)
 
+        # relationship writes may change the foreign keys of the related models
+        resource_relationship_endpoint = self.invalidating_counts(
+            self.models[facade_class.TYPE.replace("-", "_")], resource_relationship_endpoint
+        )
+
         # APPLY decorators if any
         for dec in decorators:
             resource_relationship_endpoint = dec(resource_relationship_endpoint)
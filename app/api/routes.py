@@ -16,7 +16,8 @@ from flask_jwt_extended import (
 from sqlalchemy import or_
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from app import db, mail
+from app import db, mail, JSONAPIResponseFactory
+from app.api.decorators import api_require_roles
 from app.models import User, UserRole
 
 
@@ -256,5 +257,12 @@ def reset_password(api_version):
     return response, 200
 
 
+@current_app.route('/api/<api_version>/metrics')
+@api_require_roles("admin")
+def metrics(api_version):
+    """ Timings of the requests served by this process, per endpoint (see app/api/instrumentation.py) """
+    return JSONAPIResponseFactory.make_response(current_app.metrics.to_dict())
+
+
 # register manifest generation api url
 from app.api.manifest.routes import *
@@ -1,14 +1,234 @@
 import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import elasticsearch
 import pprint
-from flask import current_app
+from flask import current_app, has_app_context
+from sqlalchemy import select
+
+
+class BulkIndexer(object):
+    """
+    Buffers index/delete actions and sends them to elasticsearch through the _bulk API.
+    The buffer is flushed when it holds batch_size actions or when flush_interval seconds
+    have elapsed since the last flush. Per-document failures are collected in self.failures
+
+    on_read_only is called before retrying a request rejected because the index is blocked
+    (eg. read_only_allow_delete set by elasticsearch when the disk is almost full)
+    """
+
+    def __init__(self, batch_size=500, flush_interval=5.0, client=None, on_read_only=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.client = client
+        self.on_read_only = on_read_only
+        self.actions = []
+        self.nb_indexed = 0
+        self.nb_deleted = 0
+        self.failures = []
+        self.last_flush = time.monotonic()
+
+    def add(self, index, id, payload):
+        self.actions.append(({"index": {"_index": index, "_id": str(id)}}, payload))
+        self._flush_if_needed()
+
+    def add_all(self, data):
+        """
+        Add a list of {"id", "index", "payload"} dicts, such as returned by a facade
+        get_data_to_index_when_added()
+        """
+        for d in data or []:
+            self.add(d["index"], d["id"], d["payload"])
+
+    def delete(self, index, id):
+        self.actions.append(({"delete": {"_index": index, "_id": str(id)}}, None))
+        self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if len(self.actions) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the buffered actions. The buffer is only emptied once the request succeeded,
+        so that the caller can retry after a transport error (eg. a read-only index)
+        """
+        if not self.actions:
+            self.last_flush = time.monotonic()
+            return
+
+        operations = []
+        for action, payload in self.actions:
+            operations.append(action)
+            if payload is not None:
+                operations.append(payload)
+
+        client = self.client or current_app.elasticsearch
+        try:
+            res = client.bulk(operations=operations)
+        except elasticsearch.AuthorizationException:
+            if self.on_read_only is None:
+                raise
+            self.on_read_only()
+            res = client.bulk(operations=operations)
+        actions = self.actions
+        self.actions = []
+        self.last_flush = time.monotonic()
+        SearchIndexManager.bump_generation()
+
+        # the items are listed in the order of the actions
+        for (action, payload), item in zip(actions, res["items"]):
+            op, result = next(iter(item.items()))
+            count_stats = SearchIndexManager._get_count_stats(action[op]["_index"]) if has_app_context() else None
+            if count_stats and "error" not in result:
+                count_stats.update(action[op]["_id"], payload)
+            if "error" in result:
+                # a missing document is not an error when deleting it
+                if op == "delete" and result.get("status") == 404:
+                    continue
+                self.failures.append({
+                    "op": op,
+                    "index": result.get("_index"),
+                    "id": result.get("_id"),
+                    "status": result.get("status"),
+                    "error": result["error"]
+                })
+            elif op == "delete":
+                self.nb_deleted += 1
+            else:
+                self.nb_indexed += 1
+
+    def close(self):
+        self.flush()
+        return self.failures
+
+
+# facet name -> aggregated field
+FACETS = OrderedDict([
+    ("collections", "collections.id"),
+    ("senders", "senders.facet_key"),
+    ("recipients", "recipients.facet_key"),
+    ("persons_inlined", "persons_inlined.facet_key"),
+    ("location_dates_from", "location_dates_from.facet_key"),
+    ("location_dates_to", "location_dates_to.facet_key"),
+    ("locations_inlined", "locations_inlined.facet_key"),
+])
+# number of buckets of the facets when the client does not choose them
+LEGACY_FACETS_SIZE = 100000
+
+# replace the values of the entries of params.id in the params.fields lists of a document
+UPDATE_EMBEDDED_ENTRIES_SCRIPT = """
+for (field in params.fields) {
+    def entries = ctx._source[field];
+    if (entries == null) { continue; }
+    for (entry in entries) {
+        if (String.valueOf(entry.id) == params.id) { entry.putAll(params.values); }
+    }
+}
+"""
+
+LUCENE_REGEXP_RESERVED = set('.?+*|{}[]()"\\#@&<>~')
+
+
+def get_facet_prefix_include(field, prefix):
+    """
+    Regexp selecting the facet buckets starting with prefix (case insensitive).
+    facet_key values are "<id>###<label>", the prefix then applies to the label
+    """
+    regexp = ""
+    for char in prefix:
+        if char.lower() != char.upper():
+            regexp += "[%s%s]" % (char.lower(), char.upper())
+        elif char in LUCENE_REGEXP_RESERVED:
+            regexp += "\\" + char
+        else:
+            regexp += char
+    if field.endswith(".facet_key"):
+        return "[0-9]+###" + regexp + ".*"
+    return regexp + ".*"
+
+
+# row of the data_version table holding the generation of the indexes
+SEARCH_INDEX_VERSION_ID = 2
 
 
 class SearchIndexManager(object):
+
+    # depth of the deferred_generation_bump() blocks of the thread and whether they wrote to an index
+    _deferred = threading.local()
+
+    # (generation, expiration) of the generation last read by the process
+    _generation = None
+
+    @classmethod
+    def get_generation(cls):
+        """
+        The generation of the indexes, incremented after the index writes of every process (api
+        workers, index-worker, db-reindex): the search response caches are keyed on it.
+        It is read from the database at most once every SEARCH_GENERATION_TTL seconds, and again
+        after an index write of the process
+        """
+        generation = cls._generation
+        now = time.monotonic()
+        if generation is not None and now < generation[1]:
+            return generation[0]
+
+        from app import db
+        from app.models import DataVersion
+        table = DataVersion.__table__
+        version = db.session.execute(
+            select(table.c.version).where(table.c.id == SEARCH_INDEX_VERSION_ID)
+        ).scalar() or 0
+        cls._generation = (version, now + current_app.config.get("SEARCH_GENERATION_TTL", 0))
+        return version
+
+    @classmethod
+    def bump_generation(cls):
+        """ Called once the writes are sent, it is delayed until the end of a deferred_generation_bump() block """
+        if getattr(cls._deferred, "depth", 0):
+            cls._deferred.pending = True
+            return
+
+        from app import db
+        from app.models import DataVersion
+        table = DataVersion.__table__
+        # in its own transaction, the writes to the indexes do not depend on the session state
+        with db.engine.begin() as connection:
+            result = connection.execute(
+                table.update().where(table.c.id == SEARCH_INDEX_VERSION_ID).values(version=table.c.version + 1)
+            )
+            if result.rowcount == 0:
+                connection.execute(table.insert(), {"id": SEARCH_INDEX_VERSION_ID, "version": 1})
+        # the process sees its own writes at once
+        cls._generation = None
+
+    @classmethod
+    @contextmanager
+    def deferred_generation_bump(cls):
+        """ Increment the generation once, after all the index writes of the block (eg. a propagated reindex) """
+        cls._deferred.depth = getattr(cls._deferred, "depth", 0) + 1
+        try:
+            yield
+        finally:
+            cls._deferred.depth -= 1
+            if cls._deferred.depth == 0 and getattr(cls._deferred, "pending", False):
+                cls._deferred.pending = False
+                cls.bump_generation()
+
     #TODO Victor check if searchtype="fulltext" should be changed to "paratext" as default in backend
     @staticmethod
-    def query_index(index, query, published=False, collectionsfacets=False, senders_facets=False, recipients_facets=False, persons_inlined_facets=False, location_dates_from_facets=False, location_dates_to_facets=False, locations_inlined_facets=False, ranges=(), groupby=None, sort_criteriae=None, searchtype=False, highlight=False, page=None, per_page=None, after=None):
+    def query_index(index, query, published=False, collectionsfacets=False, senders_facets=False, recipients_facets=False, persons_inlined_facets=False, location_dates_from_facets=False, location_dates_to_facets=False, locations_inlined_facets=False, ranges=(), groupby=None, sort_criteriae=None, searchtype=False, highlight=False, page=None, per_page=None, after=None, facets=None, facets_size=None, facets_prefix=None, facets_only=False, source_includes=None):
+        """
+        :param facets: names of the facets to aggregate (see FACETS), None to get them all for the front end searches (searchtype)
+        :param facets_size: maximum number of buckets per facet
+        :param facets_prefix: only keep the buckets starting with this prefix
+        :param facets_only: do not return any hit, only the total and the facets
+        :param source_includes: the payload fields returned with the hits when the resources are built
+        from the index (source=index), wildcards allowed
+        """
         if not sort_criteriae:
             sort_criteriae = ["_score"]
 
@@ -98,52 +318,19 @@ class SearchIndexManager(object):
                 }
 
         body_aggregations = {}
-        if searchtype:
+        if facets is None:
             #for frontend searches on /search, searchtype is either fulltext/paratext and response require facets, obtained via aggregations
-            body_aggregations = {
-                    "collections": {
-                        "terms": {
-                            "field": "collections.id",
-                            "size": 100000
-                        },
-                    },
-                    "senders": {
-                        "terms": {
-                            "field": "senders.facet_key",
-                            "size": 100000
-                        }
-                    },
-                    "recipients": {
-                        "terms": {
-                            "field": "recipients.facet_key",
-                            "size": 100000
-                        }
-                    },
-                    "persons_inlined": {
-                        "terms": {
-                            "field": "persons_inlined.facet_key",
-                            "size": 100000
-                        }
-                    },
-                    "location_dates_from": {
-                        "terms": {
-                            "field": "location_dates_from.facet_key",
-                            "size": 100000
-                        }
-                    },
-                    "location_dates_to": {
-                        "terms": {
-                            "field": "location_dates_to.facet_key",
-                            "size": 100000
-                        }
-                    },
-                    "locations_inlined": {
-                        "terms": {
-                            "field": "locations_inlined.facet_key",
-                            "size": 100000
-                        }
-                    }
+            facets = list(FACETS.keys()) if searchtype else []
+        for facet in facets:
+            if facet not in FACETS:
+                raise ValueError("unknown facet '%s' (expected one of %s)" % (facet, ", ".join(FACETS.keys())))
+            terms = {
+                "field": FACETS[facet],
+                "size": facets_size or LEGACY_FACETS_SIZE
             }
+            if facets_prefix:
+                terms["include"] = get_facet_prefix_include(FACETS[facet], facets_prefix)
+            body_aggregations[facet] = {"terms": terms}
 
 
         if hasattr(current_app, 'elasticsearch'):
@@ -280,6 +467,20 @@ class SearchIndexManager(object):
                 body["size"] = per_page
                 # print("WARNING: /!\ for debug purposes the query size is limited to", body["size"])
 
+            if facets_only and groupby is None:
+                # the hits are fetched by another request
+                body["from"] = 0
+                body["size"] = 0
+                body["highlight"] = {}
+                body["track_scores"] = False
+
+            if source_includes is not None:
+                # the resources are built from the hits payloads
+                body["_source"] = {"includes": ["id", "type", *source_includes], "excludes": ["*.facet_key"]}
+            else:
+                # the objects are loaded from the database, only their type is needed
+                body["_source"] = ["type"]
+
             #check index and launch ES search
             try:
                 if index is None or len(index) == 0:
@@ -293,20 +494,20 @@ class SearchIndexManager(object):
                 from collections import namedtuple
                 results = []
                 if searchtype or highlight:
-                    Result = namedtuple("Result", "index id type score highlight")
+                    Result = namedtuple("Result", "index id type score highlight source")
                     #print("search['hits']['total'] : ", search['hits']['total'])
                     if search['hits']['total']['value'] > 0:
                         for hit in search['hits']['hits']:
                             results = [Result(str(hit['_index']), str(hit['_id']), str(hit['_source']["type"]),
-                                              str(hit['_score']), hit.get('highlight'))
+                                              str(hit['_score']), hit.get('highlight'), hit['_source'])
                                        for hit in search['hits']['hits']]
 
                     print('\nsearch.py query_index results searchtype or highlights : \n', results[0] if len(results) > 0 else "No result")
                 else:
-                    Result = namedtuple("Result", "index id type score")
+                    Result = namedtuple("Result", "index id type score source")
 
                     results = [Result(str(hit['_index']), str(hit['_id']), str(hit['_source']["type"]),
-                                      str(hit['_score']))
+                                      str(hit['_score']), hit['_source'])
                                for hit in search['hits']['hits']]
                     print('\nsearch.py query_index results no highlights : \n', results[0] if len(results) > 0 else "No result")
 
@@ -356,14 +557,64 @@ class SearchIndexManager(object):
                 raise e
 
     @staticmethod
-    def add_to_index(index, id, payload):
+    def _get_count_stats(index):
+        """ The /count stats store, when the index holds the documents """
+        count_stats = getattr(current_app, "count_stats", None)
+        if count_stats is None or index != current_app.config["DEFAULT_INDEX_NAME"]:
+            return None
+        return count_stats
+
+    @staticmethod
+    def add_to_index(index, id, payload, indexer=None):
+        """
+        :param indexer: a BulkIndexer buffering the write instead of sending it at once (see
+        app/api/indexing_queue.py), the generation and the /count stats are updated once it is sent
+        """
         # print("ADD_TO_INDEX", index, id)
+        if indexer is not None:
+            indexer.add(index, id, payload)
+            return
         current_app.elasticsearch.index(index=index, id=id, body=payload)
+        SearchIndexManager.bump_generation()
+        count_stats = SearchIndexManager._get_count_stats(index)
+        if count_stats:
+            count_stats.update(id, payload)
+
+    @staticmethod
+    def update_embedded_entries(index, id_field, fields, id, values):
+        """
+        Update in place the copies of a resource embedded into the documents of an index
+        (eg. the senders and recipients of the documents when a person is renamed)
+        :param id_field: the field listing the ids of the embedded resources
+        :param fields: the fields holding the copies
+        :param values: the new values of the copies
+        """
+        current_app.elasticsearch.update_by_query(
+            index=index,
+            query={"term": {id_field: str(id)}},
+            script={
+                "source": UPDATE_EMBEDDED_ENTRIES_SCRIPT,
+                "lang": "painless",
+                "params": {"fields": list(fields), "id": str(id), "values": values}
+            },
+            conflicts="proceed",
+            refresh=True
+        )
+        SearchIndexManager.bump_generation()
+        # the /count stats are left as they are: they only depend on the ids of the embedded
+        # resources and on is-published, which are not changed here
 
     @staticmethod
-    def remove_from_index(index, id):
+    def remove_from_index(index, id, indexer=None):
         # print("REMOVE_FROM_INDEX", index, id)
+        if indexer is not None:
+            indexer.delete(index, id)
+            return
         try:
             current_app.elasticsearch.delete(index=index,  id=id)
         except elasticsearch.exceptions.NotFoundError as e:
             print("WARNING: resource already removed from index:", str(e))
+        SearchIndexManager.bump_generation()
+        count_stats = SearchIndexManager._get_count_stats(index)
+        if count_stats:
+            count_stats.update(id, None)
@@ -28,14 +28,14 @@ class UserFacade(JSONAPIAbstractFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "username": self.obj.username,
                 "email": self.obj.email,
                 "confirmed-at": datetime_to_str(self.obj.email_confirmed_at),
                 "is-active": self.obj.active,
                 "firstname": self.obj.first_name,
                 "lastname": self.obj.last_name
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -104,6 +104,6 @@ class UserFacade(JSONAPIAbstractFacade):
         }
         return [{"id": _res["id"], "index": self.get_index_name(), "payload": payload}]
 
-    def remove_from_index(self, propagate):
+    def remove_from_index(self, propagate, indexer=None):
         from app.api.search import SearchIndexManager
-        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id)
+        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id, indexer=indexer)
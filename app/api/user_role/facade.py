@@ -25,10 +25,10 @@ class UserRoleFacade(JSONAPIAbstractFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "name": self.obj.name,
                 "description": self.obj.description,
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
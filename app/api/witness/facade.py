@@ -1,4 +1,5 @@
 from flask import current_app, request
+from sqlalchemy.orm import selectinload
 
 from app.api.abstract_facade import JSONAPIAbstractChangeloggedFacade
 from app.models import Witness
@@ -9,6 +10,7 @@ class WitnessFacade(JSONAPIAbstractChangeloggedFacade):
     """
     TYPE = "witness"
     TYPE_PLURAL = "witnesses"
+    PROPAGATED_RELATIONSHIPS = ("document",)
 
     MODEL = Witness
 
@@ -16,6 +18,15 @@ class WitnessFacade(JSONAPIAbstractChangeloggedFacade):
     def id(self):
         return self.obj.id
 
+    @classmethod
+    def get_loading_options(cls):
+        return [
+            selectinload(Witness.changes),
+            selectinload(Witness.images),
+            selectinload(Witness.document),
+            selectinload(Witness.institution),
+        ]
+
     def get_iiif_manifest_url(self):
         host = request.host_url[:-1]
         prefix = current_app.config['IIIF_URL_PREFIX']
@@ -29,14 +40,14 @@ class WitnessFacade(JSONAPIAbstractChangeloggedFacade):
     def resource(self):
         resource = {
             **self.resource_identifier,
-            "attributes": {
+            "attributes": self.make_attributes({
                 "content": self.obj.content,
                 "tradition": self.obj.tradition,
                 "classification-mark": self.obj.classification_mark,
                 "status": self.obj.status,
-                "manifest_url": self.get_iiif_manifest_url() if len(self.obj.images) > 0 else None,
+                "manifest_url": lambda: self.get_iiif_manifest_url() if len(self.obj.images) > 0 else None,
                 "num": self.obj.num if self.obj.num else 1
-            },
+            }),
             "meta": self.meta,
             "links": {
                 "self": self.self_link
@@ -90,16 +101,17 @@ class WitnessFacade(JSONAPIAbstractChangeloggedFacade):
         if not propagate:
             return witnesses_data
         else:
-            return witnesses_data + self.get_relationship_data_to_index(rel_name="document")
+            return witnesses_data + self.get_propagated_data_to_index()
 
-    def remove_from_index(self, propagate):
+    def remove_from_index(self, propagate, indexer=None):
         from app.api.search import SearchIndexManager
 
-        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id)
+        SearchIndexManager.remove_from_index(index=self.get_index_name(), id=self.id, indexer=indexer)
 
         if propagate:
             # reindex the docs without the resource
             for data in self.get_data_to_index_when_added(propagate):
                 if data["payload"]["id"] != self.id and data["payload"]["type"] != self.TYPE:
                     data["payload"]["witnesses"] = [l for l in data["payload"]["witnesses"] if l.get("id") != self.id]
-                    SearchIndexManager.add_to_index(index=data["index"], id=data["id"], payload=data["payload"])
+                    SearchIndexManager.add_to_index(index=data["index"], id=data["id"], payload=data["payload"],
+                                                    indexer=indexer)
@@ -1,14 +1,14 @@
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
 import click
 import json
-import re
 import pprint
-import requests
-from elasticsearch import AuthorizationException
 
 from app import create_app
+from app.api.search import BulkIndexer, SearchIndexManager
 from app.api.collection.facade import CollectionFacade
 from app.api.person.facade import PersonFacade
 from app.api.document.facade import DocumentFacade
@@ -22,18 +22,6 @@ from app.models import UserRole, User, Document, Collection, Language, Witness,
 app = None
 
 
-clean_tags = re.compile('<.*?>')
-clean_notes = re.compile('\[\d+\]')
-clean_page_breaks = re.compile('\[p\.?\s?\d+\]')
-def remove_html_tags(text):
-    without_unbreakable_space = text.replace('\ufeff','') if text else None
-    without_html_content = re.sub(clean_tags,'', without_unbreakable_space) if text else None
-    without_without_notes = without_html_content.replace("[note]","").strip() if without_html_content else None
-    without_numbered_notes = re.sub(clean_notes,' ', without_without_notes) if without_without_notes else None
-    without_page_breaks = re.sub(clean_page_breaks,' ', without_numbered_notes) if without_numbered_notes else None
-    cleaned = re.sub(' +', ' ', without_page_breaks) if without_page_breaks else None
-    return cleaned
-
 def add_default_users(db):
     UserRole.add_default_roles()
     db.session.flush()
@@ -41,40 +29,160 @@ def add_default_users(db):
 
 
 def load_elastic_conf(conf_name, index_name, rebuild=False):
-    url = '/'.join([app.config['ELASTICSEARCH_URL'], index_name])
+    """
+    Prepare the index that will receive the documents.
+
+    The name used by the application (index_name) is an alias. When rebuilding, a new
+    versioned index '{index_name}_v{timestamp}' is created with the mappings and settings
+    of the conf files while the alias keeps pointing to the live index, so that searches
+    are not disrupted. swap_index_alias() must be called once the new index is loaded.
+
+    :return: the name of the index to write into
+    """
+    if not rebuild:
+        return index_name
+
+    index_version = "{0}_v{1}".format(index_name, datetime.now().strftime("%Y%m%d%H%M%S"))
+    url = '/'.join([app.config['ELASTICSEARCH_URL'], index_version])
     print("url", url)
     res = None
     try:
-        if rebuild:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.76 Safari/537.36',
-                "Upgrade-Insecure-Requests": "1", "DNT": "1",
-                "Content-Type": "application/json",
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                "Accept-Language": "en-US,en;q=0.5", "Accept-Encoding": "gzip, deflate"}
-            res = requests.delete(url, headers=headers)
-            #res = requests.delete(url)
-            print("res delete: ", res)
-
-            with open('elasticsearch/_settings.conf.json', 'r') as _settings:
-                settings = json.load(_settings)
-                print("settings : ", settings)
-
-                print("'elasticsearch/%s.conf.json' % conf_name : ", 'elasticsearch/%s.conf.json' % conf_name)
-                with open('elasticsearch/%s.conf.json' % conf_name, 'r') as f:
-                    payload = json.load(f)
-                    print("payload : ", payload)
-                    payload["settings"] = settings
-                    print("payload : ", payload)
-                    res = requests.put(url, json=payload)
-                    assert str(res.status_code).startswith("20")
-
-    except FileNotFoundError as e:
-        print("no conf...", flush=True, end=" ")
+        with open('elasticsearch/_settings.conf.json', 'r') as _settings:
+            settings = json.load(_settings)
+
+        try:
+            with open('elasticsearch/%s.conf.json' % conf_name, 'r') as f:
+                payload = json.load(f)
+        except FileNotFoundError as e:
+            print("no conf...", flush=True, end=" ")
+            payload = {}
+
+        payload["settings"] = settings
+        res = app.http.put(url, json=payload)
+        assert str(res.status_code).startswith("20")
     except Exception as e:
-        print("res.text error : ", str(e), flush=True, end=" ")
+        print("res.text error : ", res.text if res is not None else str(e), flush=True, end=" ")
         raise e
 
+    return index_version
+
+
+def swap_index_alias(index_name, index_version, keep_versions=0):
+    """
+    Atomically point the alias index_name to index_version, then delete the previous versions
+    (but the keep_versions most recent ones)
+    """
+    es_url = app.config['ELASTICSEARCH_URL']
+
+    actions = [{"add": {"index": index_version, "alias": index_name}}]
+    res = app.http.get('/'.join([es_url, index_name]))
+    if res.status_code == 200:
+        for name, info in res.json().items():
+            if name == index_name:
+                # a concrete index created before the aliases were introduced
+                actions.append({"remove_index": {"index": name}})
+            else:
+                actions.append({"remove": {"index": name, "alias": index_name}})
+
+    res = app.http.post('/'.join([es_url, '_aliases']), json={"actions": actions})
+    assert str(res.status_code).startswith("20"), res.text
+    SearchIndexManager.bump_generation()
+
+    # garbage-collect the old versions
+    res = app.http.get('/'.join([es_url, '%s_v*' % index_name]))
+    if res.status_code == 200:
+        old_versions = sorted(name for name in res.json().keys() if name != index_version)
+        to_delete = old_versions[:-keep_versions] if keep_versions > 0 else old_versions
+        for name in to_delete:
+            print("deleting old index version", name)
+            app.http.delete('/'.join([es_url, name]))
+
+
+INDEXES_INFO = {
+    "collections": {"facade": CollectionFacade, "model": Collection},
+    "languages": {"facade": LanguageFacade, "model": Language},
+    "witnesses": {"facade": WitnessFacade, "model": Witness},
+    "persons": {"facade": PersonFacade, "model": Person},
+    "placenames": {"facade": PlacenameFacade, "model": Placename},
+    "documents": {"facade": DocumentFacade, "model": Document},
+    "institutions": {"facade": InstitutionFacade, "model": Institution},
+    "users": {"facade": UserFacade, "model": User}
+}
+
+
+def reset_readonly(index_name):
+    url = "/".join([app.config['ELASTICSEARCH_URL'], index_name, '_settings'])
+    r = app.http.put(url, json={"index.blocks.read_only_allow_delete": None})
+    assert (r.status_code == 200)
+
+
+def init_reindex_worker(config):
+    """ Each worker process gets its own application (db engine & elasticsearch client) """
+    global app
+    global env
+    env = config
+    app = create_app(config)
+
+
+def reindex_chunk(name, ids, prefix, batch_size, flush_interval, target_index=None):
+    """
+    Build and send the payloads of the given ids of an index
+    :param target_index: the index receiving the payloads, when it is not the alias (rebuild)
+    :return: (index name, nb of objects processed, nb of documents indexed, failures, start time of the chunk)
+    """
+    started_at = time.time()  # wall clock, comparable between the worker processes
+    info = INDEXES_INFO[name]
+    model = info["model"]
+    with app.app_context():
+        index_name = info["facade"].get_index_name()
+        target_index = target_index or index_name
+        indexer = BulkIndexer(batch_size=batch_size, flush_interval=flush_interval,
+                              on_read_only=lambda: reset_readonly(target_index))
+        # the payloads are streamed into the bulk buffer, which is sent
+        # every batch_size documents or flush_interval seconds
+        objs_query = model.query.options(*info["facade"].get_loading_options())
+        for obj in objs_query.filter(model.id.in_(ids)).order_by(model.id).yield_per(batch_size):
+            f_obj = info["facade"](prefix, obj)
+            for data in f_obj.get_data_to_index_when_added(propagate=False):
+                index = target_index if data["index"] == index_name else data["index"]
+                indexer.add(index, data["id"], data["payload"])
+        indexer.close()
+        return name, len(ids), indexer.nb_indexed, indexer.failures, started_at
+
+
+class ReindexProgress(object):
+    """
+    Keep track of the number of objects processed per index to report throughput and ETA
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.done = {}
+        self.started_at = {}
+
+    def start(self, name, total):
+        self.totals[name] = total
+        self.done[name] = 0
+
+    def begin(self, name, started_at):
+        """
+        Start the clock of an index when the result of its first chunk comes back, at the time
+        the worker started this chunk: the indexes still waiting in the queue are not timed.
+        A chunk started earlier but completed later moves the clock back to its start time
+        """
+        self.started_at[name] = min(self.started_at.get(name, started_at), started_at)
+
+    def update(self, name, nb):
+        self.done[name] += nb
+        elapsed = time.time() - self.started_at[name]
+        rate = self.done[name] / elapsed if elapsed > 0 else 0
+        remaining = self.totals[name] - self.done[name]
+        eta = remaining / rate if rate > 0 else 0
+        return "%s: %s/%s (%.1f docs/s, ETA %ss)" % (name, self.done[name], self.totals[name], rate, int(eta))
+
+    def is_complete(self, name):
+        return self.done[name] >= self.totals[name]
+
 
 def make_cli():
     """ Creates a Command Line Interface for everydays tasks
@@ -165,73 +273,162 @@ def make_cli():
     @click.command("db-reindex")
     @click.option('--indexes', default="all")
     @click.option('--host', required=True)
-    @click.option('--rebuild', is_flag=True, help="truncate the index before updating its configuration")
-    def db_reindex(indexes, host, rebuild):
+    @click.option('--rebuild', is_flag=True, help="build a new version of the index, then swap the alias to it")
+    @click.option('--keep-versions', default=0, show_default=True, help="number of previous index versions kept after a rebuild")
+    @click.option('--batch-size', default=500, show_default=True, help="number of documents sent per _bulk request")
+    @click.option('--flush-interval', default=5.0, show_default=True, help="max number of seconds between two _bulk requests")
+    @click.option('--workers', default=1, show_default=True, help="number of processes building the payloads")
+    @click.option('--chunk-size', default=1000, show_default=True, help="number of objects handled by a worker at once")
+    def db_reindex(indexes, host, rebuild, keep_versions, batch_size, flush_interval, workers, chunk_size):
         """
         Rebuild the elasticsearch indexes from the current database
         """
-        indexes_info = {
-            "collections": {"facade": CollectionFacade, "model": Collection},
-            "languages": {"facade": LanguageFacade, "model": Language},
-            "witnesses": {"facade": WitnessFacade, "model": Witness},
-            "persons": {"facade": PersonFacade, "model": Person},
-            "placenames": {"facade": PlacenameFacade, "model": Placename},
-            "documents": {"facade": DocumentFacade, "model": Document},
-            "institutions": {"facade": InstitutionFacade, "model": Institution},
-            "users": {"facade": UserFacade, "model": User}
-        }
-
-        def reindex_from_info(name, info):
-
-            with app.app_context():
-
-                prefix = "{host}{api_prefix}".format(host=host, api_prefix=app.config["API_URL_PREFIX"])
-                print("Reindexing %s... " % name, end="", flush=True)
-
-                index_name = info["facade"].get_index_name()
+        if indexes == "all": # reindex every index configured above
+            indexes = ",".join(INDEXES_INFO.keys())
 
-                url = "/".join([app.config['ELASTICSEARCH_URL'], index_name, '_settings'])
+        names = []
+        for name in indexes.split(","):
+            if name in INDEXES_INFO:
+                names.append(name)
+            else:
+                print("Warning: index %s does not exist or is not declared in the cli" % name)
 
-                def reset_readonly():
-                    r = requests.put(url, json={"index.blocks.read_only_allow_delete": None})
-                    assert (r.status_code == 200)
+        prefix = "{host}{api_prefix}".format(host=host, api_prefix=app.config["API_URL_PREFIX"])
+        progress = ReindexProgress()
+        failures = {name: [] for name in names}
+        targets = {}
+        broken = set()
 
+        # split every index into chunks of ids that can be processed independently
+        chunks = []
+        with app.app_context():
+            from app import db
+            for name in names:
+                info = INDEXES_INFO[name]
                 try:
-                    load_elastic_conf(name, index_name, rebuild=rebuild)
-
-                    for obj in info["model"].query.all():
-                        f_obj = info["facade"](prefix, obj)
-                        try:
-                            if index_name == "lettres__development__documents" or index_name == "lettres__production__documents":
-                                #print("Rebuilding ", index_name)
-                                if f_obj.obj.title is not None and len(f_obj.obj.title) >0:
-                                    f_obj.obj.title = remove_html_tags(f_obj.obj.title)
-                                    #print('f_obj.id / f_obj.obj.title : ', f_obj.id, f_obj.obj.title)
-                                if f_obj.obj.argument is not None and len(f_obj.obj.argument) >0:
-                                    f_obj.obj.argument = remove_html_tags(f_obj.obj.argument)
-                                    #print('f_obj.id / f_obj.obj.argument : ', f_obj.id, f_obj.obj.argument)
-                                if f_obj.obj.transcription is not None and len(f_obj.obj.transcription) >0:
-                                    f_obj.obj.transcription = remove_html_tags(f_obj.obj.transcription)
-                                    #print('f_obj.id / f_obj.obj.transcription : ', f_obj.id, f_obj.obj.transcription)
-                                f_obj.reindex("insert", propagate=False)
-                            else:
-                                f_obj.reindex("insert", propagate=False)
-                        except AuthorizationException:
-                            reset_readonly()
-                            f_obj.reindex("insert", propagate=False)
-
-                    print("OK")
+                    targets[name] = load_elastic_conf(name, info["facade"].get_index_name(), rebuild=rebuild)
                 except Exception as e:
-                    print("NOT OK!  ", str(e))
+                    print("NOT OK!  ", name, str(e))
+                    continue
+                model = info["model"]
+                ids = [id for (id,) in db.session.query(model.id).order_by(model.id)]
+                progress.start(name, len(ids))
+                if not ids:
+                    print("Reindexing %s... OK (nothing to index)" % name)
+                chunks.extend((name, ids[i:i + chunk_size]) for i in range(0, len(ids), chunk_size))
+
+        def on_chunk_done(result):
+            name, nb_objs, nb_indexed, chunk_failures, started_at = result
+            progress.begin(name, started_at)
+            failures[name].extend(chunk_failures)
+            print(progress.update(name, nb_objs), flush=True)
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_reindex_worker,
+                                     initargs=(env,)) as executor:
+                futures = {}
+                for name, ids in chunks:
+                    futures[executor.submit(reindex_chunk, name, ids, prefix, batch_size, flush_interval,
+                                            targets[name])] = name
+                for future in as_completed(futures):
+                    try:
+                        on_chunk_done(future.result())
+                    except Exception as e:
+                        broken.add(futures[future])
+                        print("NOT OK!  ", futures[future], str(e))
+        else:
+            for name, ids in chunks:
+                try:
+                    on_chunk_done(reindex_chunk(name, ids, prefix, batch_size, flush_interval, targets[name]))
+                except Exception as e:
+                    broken.add(name)
+                    print("NOT OK!  ", name, str(e))
+
+        # the documents rejected by elasticsearch are reported for every index, even the ones
+        # where a whole chunk failed
+        for name in targets:
+            if name in broken or not progress.is_complete(name):
+                print("Reindexing %s... NOT OK (%s/%s processed, %s failed)"
+                      % (name, progress.done[name], progress.totals[name], len(failures[name])))
+            else:
+                print("Reindexing %s... OK (%s failed)" % (name, len(failures[name])))
+            for failure in failures[name]:
+                print("  FAILED %s/%s [%s]: %s" % (failure["index"], failure["id"], failure["status"],
+                                                   failure["error"].get("reason", failure["error"])))
 
-        if indexes == "all": # reindex every index configured above
-            indexes = ",".join(indexes_info.keys())
+        if rebuild:
+            # searches kept hitting the previous version until now, and so did the writes of the
+            # application meanwhile: they are not replayed into the new version (see README)
+            with app.app_context():
+                for name, index_version in targets.items():
+                    index_name = INDEXES_INFO[name]["facade"].get_index_name()
+                    if name in broken:
+                        print("Warning: %s was not fully rebuilt, %s still points to the previous version (%s left for inspection)"
+                              % (name, index_name, index_version))
+                        continue
+                    swap_index_alias(index_name, index_version, keep_versions=keep_versions)
+                    print("%s now points to %s" % (index_name, index_version))
+
+    @click.command("db-collection-stats")
+    def db_collection_stats():
+        """ (Re)compute the document counts and date bounds of every collection
+        """
+        with app.app_context():
+            from app import db
+            from app.models import CollectionStats
+            from app.api.collection.stats import refresh_collection_stats
+            CollectionStats.__table__.create(db.engine, checkfirst=True)
+            refresh_collection_stats(db.session.connection())
+            db.session.commit()
+            click.echo("Collection stats computed")
 
-        for name in indexes.split(","):
-            if name in indexes_info:
-                reindex_from_info(name, indexes_info[name])
-            else:
-                print("Warning: index %s does not exist or is not declared in the cli" % name)
+    @click.command("index-worker")
+    @click.option('--host', required=True)
+    @click.option('--batch-size', default=500, show_default=True, help="max number of queued tasks handled at once, and of documents per _bulk request")
+    @click.option('--poll-interval', default=2.0, show_default=True, help="number of seconds between two polls of an empty queue")
+    @click.option('--once', is_flag=True, help="exit as soon as there is no task left to handle")
+    def index_worker(host, batch_size, poll_interval, once):
+        """ Send the index updates queued by the write requests (ASYNC_INDEXING)
+        """
+        from app import db
+        from app.models import IndexingTask
+        from app.api.indexing_queue import IndexingWorker
+
+        prefix = "{host}{api_prefix}".format(host=host, api_prefix=app.config["API_URL_PREFIX"])
+        with app.app_context():
+            IndexingTask.__table__.create(db.engine, checkfirst=True)
+        worker = IndexingWorker(prefix, batch_size=batch_size,
+                                retry_delay=app.config["INDEX_WORKER_RETRY_DELAY"],
+                                max_retry_delay=app.config["INDEX_WORKER_MAX_RETRY_DELAY"])
+        # the facades build the urls of the related resources from the request host
+        with app.test_request_context(base_url=host):
+            worker.run(poll_interval=poll_interval, once=once)
+
+    @click.command("iiif-build")
+    @click.option('--host', required=True)
+    @click.option('--documents', default=None, help="comma separated ids of the documents to build (all by default)")
+    def iiif_build(host, documents):
+        """ Render the witness manifests, the document collections and thumbnails into IIIF_STORE_PATH
+        """
+        from app import db
+        from app.api.manifest.store import bump_versions
+        from app.models import Document
+
+        # the manifests build their urls from the request host
+        with app.test_request_context(base_url=host):
+            query = db.session.query(Document.id).order_by(Document.id)
+            if documents is not None:
+                query = query.filter(Document.id.in_(documents.split(',')))
+            document_ids = [document_id for (document_id,) in query]
+            for i, document_id in enumerate(document_ids, 1):
+                doc = Document.query.get(document_id)
+                app.iiif_store.build_document(doc, app.manifest_factory)
+                # the witnesses and images of the built documents are not needed anymore
+                db.session.expunge_all()
+                if i % 100 == 0 or i == len(document_ids):
+                    print("%s/%s documents built" % (i, len(document_ids)))
+            if document_ids:
+                bump_versions()
 
     @click.command("add-user")
     @click.option('--email', required=True)
@@ -272,6 +469,9 @@ def make_cli():
     cli.add_command(db_create)
     cli.add_command(db_recreate)
     cli.add_command(db_reindex)
+    cli.add_command(db_collection_stats)
+    cli.add_command(index_worker)
+    cli.add_command(iiif_build)
     cli.add_command(db_add_user)
     #cli.add_command(make_manifests)
     #cli.add_command(make_collection_manifests)
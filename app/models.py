@@ -1,6 +1,7 @@
 import datetime
 from flask_user import UserMixin
-from sqlalchemy import Enum, DateTime, func
+from sqlalchemy import Enum, DateTime, func, exists, and_
+from sqlalchemy.orm import aliased
 from sqlalchemy.ext.declarative import declared_attr
 from werkzeug.security import check_password_hash
 
@@ -75,6 +76,8 @@ class Document(db.Model, ChangesMixin):
     collections = db.relationship("Collection",
                                 secondary=association_document_has_collection,
                                 backref=db.backref('documents', lazy='dynamic'), lazy='dynamic')
+    # read-only list view of the dynamic 'collections' relationship, which can be eager loaded
+    collections_list = db.relationship("Collection", secondary=association_document_has_collection, viewonly=True)
     next_document = db.relationship("Document", backref=db.backref('prev_document', remote_side=id), uselist=False)
 
     locks = db.relationship("Lock",
@@ -108,6 +111,8 @@ class Collection(db.Model, ChangesMixin):
     admin_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
     children = db.relationship("Collection", backref=db.backref('parent', remote_side=id))
+    # maintained by app/api/collection/stats.py
+    stats = db.relationship("CollectionStats", uselist=False, viewonly=True)
 
     @property
     def documents_including_children(self):
@@ -155,6 +160,22 @@ class Collection(db.Model, ChangesMixin):
             return [self.parent] + self.parent.parents
 
 
+class CollectionStats(db.Model):
+    """ Statistiques précalculées d'une collection, sous-collections incluses
+
+    """
+    __tablename__ = 'collection_stats'
+
+    collection_id = db.Column(db.Integer, db.ForeignKey('collection.id', ondelete='CASCADE'), primary_key=True)
+
+    nb_docs = db.Column(db.Integer, nullable=False, default=0)
+    nb_pub_docs = db.Column(db.Integer, nullable=False, default=0)
+    date_min = db.Column(db.String)
+    date_max = db.Column(db.String)
+    date_min_pub = db.Column(db.String)
+    date_max_pub = db.Column(db.String)
+
+
 class Note(db.Model, ChangesMixin):
     """ Note (appel point) de transcription non typée ; contenu riche """
     __tablename__ = 'note'
@@ -488,6 +509,35 @@ class Changelog(db.Model):
     user = db.relationship('User', backref=db.backref("changes", uselist=True),  single_parent=True)
 
 
+class IndexingTask(db.Model):
+    """ File d'attente des mises à jour de l'index (ASYNC_INDEXING), vidée par la commande index-worker """
+    __tablename__ = "indexing_task"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    object_type = db.Column(db.String, nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String, Enum("insert", "update", "delete"), nullable=False)
+    propagate = db.Column(db.Boolean, nullable=False, default=True)
+
+    created_at = db.Column(DateTime, nullable=False, default=datetime.datetime.now)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(DateTime, nullable=False, default=datetime.datetime.now, index=True)
+    last_error = db.Column(db.String, nullable=True)
+
+
+class DataVersion(db.Model):
+    """
+    Versions partagées par les processus de l'application :
+    - id 1 : version des données, incrémentée à chaque écriture (ETags des réponses)
+    - id 2 : génération des index, incrémentée après chaque écriture dans les index (cache des recherches)
+    """
+    __tablename__ = "data_version"
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
 MODELS = {
     Document.__tablename__: Document,
     Collection.__tablename__: Collection,
@@ -506,3 +556,47 @@ MODELS = {
     UserRole.__tablename__: UserRole,
     Lock.__tablename__:Lock
 }
+
+
+# ====================================
+# PROPERTY FILTERS
+# ====================================
+
+def _now():
+    return datetime.datetime.now()
+
+
+def _child_collection_exists():
+    child = aliased(Collection)
+    return exists().where(child.parent_id == Collection.id)
+
+
+# SQL equivalents of the python properties used in filter[...] parameters.
+# Each callable returns the boolean expression matching the rows where the property is truthy;
+# it is evaluated when the query is built since some of them depend on the current time.
+PROPERTY_FILTERS = {
+    (Document.__tablename__, "current_lock"): lambda: exists().where(and_(
+        Lock.object_type == Document.__tablename__,
+        Lock.object_id == Document.id,
+        Lock.expiration_date >= _now()
+    )),
+    (Lock.__tablename__, "is_active"): lambda: Lock.expiration_date > _now(),
+    (Collection.__tablename__, "parents"): lambda: Collection.parent_id.isnot(None),
+    (Collection.__tablename__, "children_including_children"): _child_collection_exists,
+    (Collection.__tablename__, "documents_including_children"): lambda: exists().where(and_(
+        CollectionStats.collection_id == Collection.id,
+        CollectionStats.nb_docs > 0
+    )),
+    (Collection.__tablename__, "published_including_children"): lambda: exists().where(and_(
+        CollectionStats.collection_id == Collection.id,
+        CollectionStats.nb_pub_docs > 0
+    )),
+}
+
+
+def get_property_filter(model, property_name):
+    """
+    :return: the SQL expression of the property truthiness, None when the property can only be evaluated in python
+    """
+    expression = PROPERTY_FILTERS.get((model.__tablename__, property_name))
+    return expression() if expression is not None else None
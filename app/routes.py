@@ -1,6 +1,7 @@
 from flask import current_app
 
 from app import JSONAPIResponseFactory
+from app.api.manifest.store import make_not_built_response, make_stored_response, schedule_build
 from app.models import Witness, Document
 
 headers = {"Access-Control-Allow-Origin": "*"}
@@ -17,10 +18,14 @@ def get_witness_manifest(witness_id):
             "title": data
         }), code
 
-    manifest, manifest_url = current_app.manifest_factory.make_manifest(witness=witness)
-    print('get manifest', manifest_url)
+    # built by the iiif-build command or after the modifications of the witness (see app/api/manifest/store.py)
+    stored = current_app.iiif_store.get_manifest(witness.id)
+    if stored is None:
+        schedule_build([witness.document_id])
+        return make_not_built_response("The manifest of witness %s has not been built yet" % witness_id,
+                                       headers=headers)
 
-    return JSONAPIResponseFactory.make_response(manifest, headers=headers)
+    return make_stored_response(stored, headers=headers)
 
 
 @current_app.route("/iiif/documents/<doc_id>/collection")
@@ -34,7 +39,10 @@ def get_document_collection(doc_id):
             "title": data
         }), code
 
-    collection, collection_url = current_app.manifest_factory.make_collection(doc)
-    print('get collection', collection_url)
+    stored = current_app.iiif_store.get_collection(doc.id)
+    if stored is None:
+        schedule_build([doc.id])
+        return make_not_built_response("The collection of document %s has not been built yet" % doc_id,
+                                       headers=headers)
 
-    return JSONAPIResponseFactory.make_response(collection, headers=headers)
+    return make_stored_response(stored, headers=headers)
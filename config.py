@@ -32,6 +32,61 @@ class Config(object):
     DEFAULT_INDEX_NAME = parse_var_env('DEFAULT_INDEX_NAME')
     SEARCH_RESULT_PER_PAGE =  parse_var_env('SEARCH_RESULT_PER_PAGE')
 
+    # total counts of the paginated listings (in seconds, 0 disables the cache)
+    COUNT_CACHE_TTL = float(parse_var_env('COUNT_CACHE_TTL') or 60)
+    COUNT_CACHE_SIZE = int(parse_var_env('COUNT_CACHE_SIZE') or 1024)
+    # responses of the search and count routes (in seconds, 0 disables the cache)
+    SEARCH_CACHE_TTL = float(parse_var_env('SEARCH_CACHE_TTL') or 300)
+    SEARCH_CACHE_SIZE = int(parse_var_env('SEARCH_CACHE_SIZE') or 256)
+    # the generation of the indexes keying this cache is read from the database at most once per
+    # interval (in seconds): the index writes of the other processes are seen after this delay
+    SEARCH_GENERATION_TTL = float(parse_var_env('SEARCH_GENERATION_TTL') or 1)
+    # number of buckets of the facets asked with facets=..., and its upper bound for facets[size]
+    SEARCH_FACETS_SIZE = int(parse_var_env('SEARCH_FACETS_SIZE') or 100)
+    SEARCH_FACETS_MAX_SIZE = int(parse_var_env('SEARCH_FACETS_MAX_SIZE') or 10000)
+    # landing page counters, rebuilt from a scan of the documents index (in seconds)
+    COUNT_STATS_RECONCILE_INTERVAL = float(parse_var_env('COUNT_STATS_RECONCILE_INTERVAL') or 600)
+    # index updates written to the indexing_task table and sent by the index-worker command
+    ASYNC_INDEXING = parse_var_env('ASYNC_INDEXING') or False
+    # delay before retrying a failed indexing task, doubled on every attempt (in seconds)
+    INDEX_WORKER_RETRY_DELAY = float(parse_var_env('INDEX_WORKER_RETRY_DELAY') or 5)
+    INDEX_WORKER_MAX_RETRY_DELAY = float(parse_var_env('INDEX_WORKER_MAX_RETRY_DELAY') or 600)
+
+    # writes applied in a single transaction by a request to /operations (JSON:API atomic extension)
+    OPERATIONS_MAX_COUNT = int(parse_var_env('OPERATIONS_MAX_COUNT') or 500)
+
+    # gzip/brotli compression of the responses (disable it when done by the front web server)
+    COMPRESS_RESPONSES = parse_var_env('COMPRESS_RESPONSES') is not False
+    COMPRESS_MIN_SIZE = int(parse_var_env('COMPRESS_MIN_SIZE') or 1024)
+    COMPRESS_LEVEL = int(parse_var_env('COMPRESS_LEVEL') or 6)
+    # ETags and 304 responses on the GET routes of the resources
+    CONDITIONAL_REQUESTS = parse_var_env('CONDITIONAL_REQUESTS') is not False
+    # outbound HTTP requests (remote IIIF servers, elasticsearch administration): connections kept
+    # alive per host, concurrent requests per host, retries of the idempotent requests (backoff in seconds)
+    HTTP_POOL_SIZE = int(parse_var_env('HTTP_POOL_SIZE') or 10)
+    HTTP_MAX_PER_HOST = int(parse_var_env('HTTP_MAX_PER_HOST') or 8)
+    HTTP_MAX_RETRIES = int(parse_var_env('HTTP_MAX_RETRIES') or 3)
+    HTTP_RETRY_BACKOFF = float(parse_var_env('HTTP_RETRY_BACKOFF') or 0.5)
+    HTTP_TIMEOUT = float(parse_var_env('HTTP_TIMEOUT') or 10)
+    # remote IIIF manifests the witness manifests are built from ("memory" or "sqlite", shared by the workers)
+    MANIFEST_CACHE_BACKEND = parse_var_env('MANIFEST_CACHE_BACKEND') or "memory"
+    MANIFEST_CACHE_PATH = parse_var_env('MANIFEST_CACHE_PATH') or os.path.join(basedir, "manifest_cache.sqlite")
+    MANIFEST_CACHE_SIZE = int(parse_var_env('MANIFEST_CACHE_SIZE') or 150)
+    # in seconds, the failed fetches are cached for MANIFEST_CACHE_NEGATIVE_TTL
+    MANIFEST_CACHE_TTL = float(parse_var_env('MANIFEST_CACHE_TTL') or 1800)
+    MANIFEST_CACHE_NEGATIVE_TTL = float(parse_var_env('MANIFEST_CACHE_NEGATIVE_TTL') or 60)
+    MANIFEST_FETCH_TIMEOUT = float(parse_var_env('MANIFEST_FETCH_TIMEOUT') or 10)
+    # concurrent requests to the remote IIIF servers (manifests and info.json of the folios)
+    MANIFEST_FETCH_WORKERS = int(parse_var_env('MANIFEST_FETCH_WORKERS') or 8)
+    # witness manifests, document collections and thumbnails served by the API, built by iiif-build
+    IIIF_STORE_PATH = parse_var_env('IIIF_STORE_PATH') or os.path.join(basedir, "iiif_store")
+    # rebuild in the background the documents whose witnesses or images have been modified
+    IIIF_STORE_BUILD_ON_COMMIT = parse_var_env('IIIF_STORE_BUILD_ON_COMMIT') is not False
+    # seconds after which the build claimed by a process which never released it can be claimed again
+    IIIF_STORE_BUILD_TIMEOUT = int(parse_var_env('IIIF_STORE_BUILD_TIMEOUT') or 600)
+    # seconds after which the clients retry to get a resource whose build has been scheduled (503 meanwhile)
+    IIIF_STORE_RETRY_AFTER = int(parse_var_env('IIIF_STORE_RETRY_AFTER') or 5)
+
     #ASSETS_DEBUG = parse_var_env('ASSETS_DEBUG') or False
     #SCSS_STATIC_DIR = os.path.join(basedir, "app ", "static", "css")
     #SCSS_ASSET_DIR = os.path.join(basedir, "app", "assets", "scss")
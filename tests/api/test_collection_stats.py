@@ -0,0 +1,66 @@
+import unittest
+
+from app import db
+from app.api.collection.stats import compute_collection_stats, STATS_FIELDS
+from app.models import Collection, CollectionStats, Document
+from tests.base_server import TestBaseServer
+
+
+class TestCollectionStats(TestBaseServer):
+
+    def load_fixtures(self):
+        from tests.data.fixtures.dataset001 import load_fixtures as load_dataset001
+        with self.app.app_context():
+            load_dataset001(db)
+
+    def get_nb_docs(self):
+        return {s.collection_id: s.nb_docs for s in CollectionStats.query.all()}
+
+    def assert_stats_up_to_date(self):
+        stored = {s.collection_id: {field: getattr(s, field) for field in STATS_FIELDS}
+                  for s in CollectionStats.query.all()}
+        computed = compute_collection_stats(db.session.connection(), [c.id for c in Collection.query.all()])
+        self.assertEqual(computed, stored)
+
+    def add_collection(self, parent):
+        collection = Collection(title="X", admin_id=parent.admin_id, parent=parent)
+        document = Document(title="Doc", collections=[collection])
+        db.session.add_all([collection, document])
+        db.session.commit()
+        return collection
+
+    def test_move_collection(self):
+        first, second = Collection.query.filter(Collection.parent_id == None).order_by(Collection.id).limit(2).all()
+        x = self.add_collection(first)
+        nb_docs = self.get_nb_docs()
+        self.assertEqual(1, nb_docs[x.id])
+        self.assert_stats_up_to_date()
+
+        # the parent_id column is only updated during the flush
+        x.parent = None
+        x.parent = second
+        db.session.commit()
+        self.assertEqual(nb_docs[first.id] - 1, self.get_nb_docs()[first.id])
+        self.assertEqual(nb_docs[second.id] + 1, self.get_nb_docs()[second.id])
+        self.assert_stats_up_to_date()
+
+        # through the children of the new parent
+        first.children.append(x)
+        db.session.commit()
+        self.assertEqual(nb_docs, self.get_nb_docs())
+        self.assert_stats_up_to_date()
+
+        # moved under a sub-collection, then out of it: the ancestors are refreshed too
+        child = Collection.query.filter(Collection.parent_id != None, Collection.id != x.id).first()
+        x.parent = child
+        db.session.commit()
+        self.assertEqual(nb_docs[child.id] + 1, self.get_nb_docs()[child.id])
+        self.assert_stats_up_to_date()
+        x.parent = None
+        db.session.commit()
+        self.assertEqual(nb_docs[child.id], self.get_nb_docs()[child.id])
+        self.assert_stats_up_to_date()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import gzip
+import unittest
+import zlib
+
+from app.api.compression import Compressor, iter_compressed
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.chunks = [('{"id": %s, "title": "Lettre de Jean à Marie"}' % i).encode("utf-8") for i in range(2000)]
+
+    def test_streamed_gzip(self):
+        compressed = list(iter_compressed(iter(self.chunks), "gzip"))
+        self.assertEqual(b"".join(self.chunks), gzip.decompress(b"".join(compressed)))
+        self.assertLess(len(b"".join(compressed)), len(b"".join(self.chunks)))
+
+    def test_streamed_chunks_are_flushed(self):
+        # every compressed chunk can be decoded as soon as it is received
+        decompressor = zlib.decompressobj(31)
+        for chunk, compressed in zip(self.chunks, iter_compressed(iter(self.chunks), "gzip")):
+            self.assertEqual(chunk, decompressor.decompress(compressed))
+
+    def test_buffered_gzip(self):
+        data = b"".join(self.chunks)
+        compressor = Compressor("gzip")
+        self.assertEqual(data, gzip.decompress(compressor.compress(data) + compressor.finish()))
+
+
+if __name__ == '__main__':
+    unittest.main()
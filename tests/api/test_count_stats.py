@@ -0,0 +1,90 @@
+import threading
+import unittest
+from unittest import mock
+
+from flask import Flask
+
+from app.api.count_stats import CountStats
+
+
+def make_source(published, persons=(), collections=()):
+    return {
+        "is-published": published,
+        "persons": [{"id": p} for p in persons],
+        "placenames": [],
+        "collections": [{"id": c, "parents": parents} for c, parents in collections],
+    }
+
+
+class TestCountStats(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["DEFAULT_INDEX_NAME"] = "documents"
+        self.app.elasticsearch = None
+        self.stats = CountStats()
+        hits = [
+            {"_id": "1", "_source": make_source(True, persons=[1, 2], collections=[(10, ["1"])])},
+            {"_id": "2", "_source": make_source(False, persons=[2])},
+        ]
+        with self.app.app_context(), mock.patch("app.api.count_stats.scan", return_value=iter(hits)):
+            self.stats.reconcile()
+
+    def test_reconcile(self):
+        self.assertEqual({"documents": 2, "persons": 2, "placenames": 0, "collections": 2}, self.stats.get())
+        self.assertEqual({"documents": 1, "persons": 2, "placenames": 0, "collections": 2},
+                         self.stats.get(published=True))
+
+    def test_update(self):
+        # the previous contribution of the document is known, the index is not read
+        self.stats.update(1, make_source(False, persons=[3]))
+        self.assertEqual({"documents": 2, "persons": 2, "placenames": 0, "collections": 0}, self.stats.get())
+        self.assertEqual({"documents": 0, "persons": 0, "placenames": 0, "collections": 0},
+                         self.stats.get(published=True))
+
+        self.stats.update(3, make_source(True, persons=[3]))
+        self.stats.update(2, None)
+        self.assertEqual({"documents": 2, "persons": 1, "placenames": 0, "collections": 0}, self.stats.get())
+        self.assertEqual(1, self.stats.get(published=True)["documents"])
+
+    def test_updates_during_reconcile(self):
+        def hits():
+            yield {"_id": "1", "_source": make_source(True, persons=[1])}
+            # a write sent while the index is being scanned, the scan has already read the document
+            self.stats.update(1, None)
+            self.stats.update(4, make_source(True, persons=[4]))
+            # a single scan runs at a time
+            self.assertFalse(self.stats.reconcile())
+            yield {"_id": "2", "_source": make_source(False, persons=[2])}
+
+        with self.app.app_context(), mock.patch("app.api.count_stats.scan", return_value=hits()) as scan:
+            self.assertTrue(self.stats.reconcile())
+        self.assertEqual(1, scan.call_count)
+        self.assertEqual({"documents": 2, "persons": 2, "placenames": 0, "collections": 0}, self.stats.get())
+        self.assertEqual(["2", "4"], sorted(self.stats.documents))
+
+    def test_reconcile_in_background(self):
+        self.stats.reconcile_interval = 0
+        scanning, done = threading.Event(), threading.Event()
+
+        def hits():
+            scanning.set()
+            done.wait(5)
+            yield {"_id": "5", "_source": make_source(True)}
+
+        with self.app.app_context(), mock.patch("app.api.count_stats.scan", return_value=hits()) as scan:
+            # the previous counters are served while the index is scanned
+            self.assertEqual(2, self.stats.get()["documents"])
+            self.assertTrue(scanning.wait(5))
+            self.assertEqual(2, self.stats.get()["documents"])
+            done.set()
+            for _ in range(100):
+                if self.stats.pending_updates is None:
+                    break
+                threading.Event().wait(0.05)
+        self.assertEqual(1, scan.call_count)
+        self.assertEqual(["5"], list(self.stats.documents))
+
+
+if __name__ == '__main__':
+    unittest.main()
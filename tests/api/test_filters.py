@@ -0,0 +1,77 @@
+import unittest
+
+from app import db
+from app.models import Document
+from tests.base_server import TestBaseServer
+
+
+class TestFilters(TestBaseServer):
+
+    TITLES = {
+        1: "Lettre à Voltaire",
+        2: "Lettre de Voltaire",
+        3: "Réponse de Voltaire, 100% sincère",
+        4: "Mémoire au roi",
+    }
+
+    def load_fixtures(self):
+        from tests.data.fixtures.dataset001 import load_fixtures as load_dataset001
+        with self.app.app_context():
+            load_dataset001(db)
+            for doc in Document.query.all():
+                doc.title = self.TITLES.get(doc.id, "Document %s" % doc.id)
+                doc.is_published = doc.id in (1, 2)
+                doc.creation = "1750-01-0%s" % doc.id if doc.id < 4 else None
+            db.session.commit()
+
+    def get_ids(self, filters):
+        r, status, resource = self.api_get("documents?%s&without-relationships" % filters)
+        self.assert200(r)
+        return sorted(d["id"] for d in resource["data"])
+
+    def test_legacy_syntax(self):
+        self.assertEqual([2, 3], self.get_ids("filter[title]=de,Voltaire"))
+        self.assertEqual([1, 2], self.get_ids("filter[is_published]=true"))
+        self.assertEqual(list(range(4, 11)), self.get_ids("filter[creation]="))
+        self.assertEqual([1, 2, 3], self.get_ids("filter[!creation]"))
+
+    def test_eq_and_prefix(self):
+        self.assertEqual([4], self.get_ids("filter[title][eq]=Mémoire au roi"))
+        self.assertEqual(list(range(4, 11)), self.get_ids("filter[creation][eq]="))
+        self.assertEqual([1, 2], self.get_ids("filter[title][prefix]=Lettre"))
+        self.assertEqual(list(range(3, 11)), self.get_ids("filter[!title][prefix]=Lettre"))
+
+    def test_contains(self):
+        self.assertEqual([2, 3], self.get_ids("filter[title][contains]=de,Voltaire"))
+        # the LIKE wildcards are escaped
+        self.assertEqual([3], self.get_ids("filter[title][contains]=100%25"))
+        self.assertEqual([], self.get_ids("filter[title][contains]=_"))
+
+    def test_in(self):
+        self.assertEqual([1, 3], self.get_ids("filter[id][in]=1,3"))
+        self.assertEqual(list(range(3, 11)), self.get_ids("filter[!id][in]=1,2"))
+        self.assertEqual([2, 4], self.get_ids("filter[title][in]=Lettre de Voltaire,Mémoire au roi"))
+
+    def test_range(self):
+        self.assertEqual([2, 3, 4], self.get_ids("filter[id][range]=2,4"))
+        self.assertEqual([8, 9, 10], self.get_ids("filter[id][range]=8,"))
+        self.assertEqual([1, 2], self.get_ids("filter[id][range]=,2"))
+        self.assertEqual([2, 3], self.get_ids("filter[creation][range]=1750-01-02,1750-12-31"))
+
+    def test_coercion(self):
+        # the values are bound with the type of the column
+        self.assertEqual([1, 2], self.get_ids("filter[is_published][eq]=TRUE"))
+        self.assertEqual(list(range(3, 11)), self.get_ids("filter[is_published][eq]=false"))
+        self.assertEqual([10], self.get_ids("filter[id][eq]=10"))
+        self.assertEqual([9, 10], self.get_ids("filter[id][range]=9,10"))
+        self.assertEqual([], self.get_ids("filter[id][eq]=abc"))
+
+    def test_errors(self):
+        for filters in ("filter[title][like]=Lettre", "filter[unknown][eq]=1", "filter[id][eq]=1&filter[id][bad]=2"):
+            r, status, resource = self.api_get("documents?%s" % filters)
+            self.assert400(r)
+            self.assertEqual(400, resource["errors"]["status"])
+
+
+if __name__ == '__main__':
+    unittest.main()
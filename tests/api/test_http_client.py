@@ -0,0 +1,55 @@
+import threading
+import time
+import unittest
+
+from app.api.http import HTTPClient
+from tests.data.fixtures.iiif_stub_server import IIIFStubServer
+
+DELAY = 0.2
+
+
+class TestHTTPClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = IIIFStubServer().start()
+        self.manifest_url, canvas_ids = self.server.add_manifest("ms")
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_connections_are_kept_alive(self):
+        http = HTTPClient()
+        for i in range(5):
+            self.assertEqual(200, http.get(self.manifest_url).status_code)
+        pools = http.stats["pools"]
+        self.assertEqual(1, len(pools))
+        self.assertEqual({"connections": 1, "requests": 5, "idle": 1}, list(pools.values())[0])
+
+    def test_retries(self):
+        self.server.failures["/ms/manifest.json"] = 2
+        http = HTTPClient(max_retries=3, backoff_factor=0)
+        self.assertEqual(200, http.get(self.manifest_url).status_code)
+        host = list(http.stats["hosts"].values())[0]
+        self.assertEqual((1, 0, 2), (host["requests"], host["errors"], host["retries"]))
+
+        self.server.failures["/ms/manifest.json"] = 2
+        self.assertEqual(503, HTTPClient(max_retries=1, backoff_factor=0).get(self.manifest_url).status_code)
+
+    def test_concurrency_per_host(self):
+        self.server.delay = DELAY
+        http = HTTPClient(max_per_host=2)
+        threads = [threading.Thread(target=http.get, args=(self.manifest_url,)) for i in range(4)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # two rounds of two requests
+        self.assertGreaterEqual(time.perf_counter() - start, 2 * DELAY)
+        host = list(http.stats["hosts"].values())[0]
+        self.assertEqual(4, host["requests"])
+        self.assertGreater(host["mean-wait-duration"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import os
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from app import db
+from app.api.manifest.store import IIIFStore, IIIFStoreBuilder
+from app.models import DataVersion, Witness
+from tests.base_server import TestBaseServer
+
+
+class StubManifestFactory(object):
+
+    def make_manifest(self, witness):
+        canvases = [{"@id": canvas_id, "thumbnail": {"@id": canvas_id + "/thumbnail.jpg"}}
+                    for canvas_id in witness.canvas_ids]
+        url = "http://localhost/iiif/witnesses/%s/manifest" % witness.id
+        return {"@id": url, "sequences": [{"canvases": canvases}]}, url
+
+    def make_collection(self, doc):
+        url = "http://localhost/iiif/documents/%s/collection" % doc.id
+        return {"@id": url, "manifests": [{"@id": "http://localhost/iiif/witnesses/%s/manifest" % w.id}
+                                          for w in doc.witnesses]}, url
+
+
+class TestIIIFStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = IIIFStore(self.tmp_dir.name)
+        self.doc = SimpleNamespace(id=1, witnesses=[
+            SimpleNamespace(id=10, canvas_ids=[]),
+            SimpleNamespace(id=11, canvas_ids=["https://gallica.bnf.fr/canvas/f1", "https://gallica.bnf.fr/canvas/f2"]),
+        ])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_build_document(self):
+        self.assertEqual((False, None), self.store.get_thumbnail_url(1))
+        self.store.build_document(self.doc, StubManifestFactory())
+
+        self.assertEqual((True, "https://gallica.bnf.fr/canvas/f1/thumbnail.jpg"), self.store.get_thumbnail_url(1))
+        self.assertEqual(2, len(self.store.get_manifest(11).json()["sequences"][0]["canvases"]))
+        self.assertEqual(2, len(self.store.get_collection(1).json()["manifests"]))
+
+    def test_etag(self):
+        self.store.build_document(self.doc, StubManifestFactory())
+        etag = self.store.get_manifest(11).etag
+        self.store.build_document(self.doc, StubManifestFactory())
+        self.assertEqual(etag, self.store.get_manifest(11).etag)
+
+        self.doc.witnesses[1].canvas_ids.pop()
+        self.store.build_document(self.doc, StubManifestFactory())
+        self.assertNotEqual(etag, self.store.get_manifest(11).etag)
+
+    def test_delete(self):
+        self.store.build_document(self.doc, StubManifestFactory())
+        self.store.delete_witness(11)
+        self.store.delete_document(1)
+        self.assertIsNone(self.store.get_manifest(11))
+        self.assertIsNone(self.store.get_collection(1))
+        self.assertFalse(self.store.is_built(1))
+
+    def test_claim_build(self):
+        self.assertTrue(self.store.claim_build(1, timeout=60))
+        # claimed by another process
+        self.assertFalse(IIIFStore(self.tmp_dir.name).claim_build(1, timeout=60))
+        self.assertTrue(self.store.claim_build(2, timeout=60))
+        self.store.release_build(1)
+        self.assertTrue(IIIFStore(self.tmp_dir.name).claim_build(1, timeout=60))
+
+        # the claim of a process which never released it expires
+        filename = os.path.join(self.tmp_dir.name, self.store.claim_name(2))
+        os.utime(filename, (time.time() - 120, time.time() - 120))
+        self.assertTrue(IIIFStore(self.tmp_dir.name).claim_build(2, timeout=60))
+        self.assertFalse(self.store.claim_build(2, timeout=60))
+
+
+class TestIIIFRoutes(TestBaseServer):
+
+    def load_fixtures(self):
+        from tests.data.fixtures.dataset001 import load_fixtures as load_dataset001
+        with self.app.app_context():
+            load_dataset001(db)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.app.iiif_store = IIIFStore(self.tmp_dir.name)
+        self.app.iiif_store_builder = IIIFStoreBuilder(self.app, self.app.iiif_store)
+
+    def test_not_built(self):
+        # the views of app/routes.py are registered on the first app created only
+        from app.routes import get_document_collection, get_witness_manifest
+        from app.api.manifest.routes import get_collection
+
+        witness = Witness.query.filter(Witness.document_id == 1).first()
+        views = [lambda: get_witness_manifest(witness.id), lambda: get_document_collection(1),
+                 lambda: get_collection("1.0", 1)]
+        with mock.patch.object(self.app.iiif_store_builder, "schedule") as schedule:
+            for view in views:
+                with self.app.test_request_context():
+                    r = view()
+                self.assertEqual(503, r.status_code)
+                self.assertEqual(str(self.app.config["IIIF_STORE_RETRY_AFTER"]), r.headers["Retry-After"])
+                self.assertEqual("no-store", r.headers["Cache-Control"])
+        # the build of the document has been scheduled
+        self.assertEqual([[1]] * len(views), [list(c[0][0]) for c in schedule.call_args_list])
+
+        doc = SimpleNamespace(id=1, witnesses=[SimpleNamespace(id=witness.id, canvas_ids=[])])
+        self.app.iiif_store.build_document(doc, StubManifestFactory())
+        for view in views:
+            with self.app.test_request_context():
+                self.assert200(view())
+
+    def get_versions(self):
+        """ :return: the data version and the search generation """
+        versions = {v.id: v.version for v in DataVersion.query.all()}
+        return versions.get(1, 0), versions.get(2, 0)
+
+    def test_build(self):
+        manifest_factory = SimpleNamespace(
+            make_manifest=lambda witness: ({"sequences": [{"canvases": []}]}, None),
+            make_collection=lambda doc: ({"manifests": []}, None)
+        )
+        # read before it is built, the document is not built in the background meanwhile
+        with mock.patch.object(self.app.iiif_store_builder, "schedule"):
+            etag = self.get("documents/1").headers["ETag"]
+        versions = self.get_versions()
+
+        with mock.patch.object(self.app, "manifest_factory", manifest_factory, create=True):
+            self.app.iiif_store_builder.schedule([1], "http://localhost/")
+            self.app.iiif_store_builder.join()
+        self.assertTrue(self.app.iiif_store.is_built(1))
+        # the claim is released once the document is built
+        self.assertTrue(self.app.iiif_store.claim_build(1, timeout=60))
+
+        # the data version and the search generation are incremented: the representations have changed
+        data_version, generation = self.get_versions()
+        self.assertGreater(data_version, versions[0])
+        self.assertGreater(generation, versions[1])
+        self.assert200(self.get("documents/1", headers={"If-None-Match": etag}))
+
+    def test_schedule(self):
+        builder = self.app.iiif_store_builder
+        # another process is building the document
+        IIIFStore(self.tmp_dir.name).claim_build(2, timeout=60)
+        with mock.patch.object(builder, "queue") as builder_queue, mock.patch("threading.Thread"):
+            builder.schedule([1, 2], "http://localhost/")
+            builder.schedule([1], "http://localhost/")
+            self.assertEqual([(1, "http://localhost/")], [c[0][0] for c in builder_queue.put.call_args_list])
+            # modified since the other process started its build
+            builder.schedule([2], "http://localhost/", rebuild=True)
+            self.assertEqual((2, "http://localhost/"), builder_queue.put.call_args[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
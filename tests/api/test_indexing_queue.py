@@ -0,0 +1,141 @@
+import datetime
+import unittest
+from unittest import mock
+
+from app import db
+from app.api.document.facade import DocumentFacade
+from app.api.indexing_queue import IndexingWorker
+from app.models import Document, IndexingTask, Person, User, Witness
+from tests.base_server import TestBaseServer
+
+
+def bulk_response(operations, errors=()):
+    """ The response of elasticsearch to a _bulk request, the ids listed in errors being rejected """
+    items = []
+    for operation in operations:
+        if "index" not in operation and "delete" not in operation:
+            continue  # a payload
+        op, action = next(iter(operation.items()))
+        if action["_id"] in errors:
+            items.append({op: {"_index": action["_index"], "_id": action["_id"], "status": 400,
+                               "error": {"reason": "rejected"}}})
+        else:
+            items.append({op: {"_index": action["_index"], "_id": action["_id"], "status": 200}})
+    return {"errors": bool(errors), "items": items}
+
+
+class TestIndexingQueue(TestBaseServer):
+
+    def load_fixtures(self):
+        from tests.data.fixtures.dataset001 import load_fixtures as load_dataset001
+        with self.app.app_context():
+            load_dataset001(db)
+        self.app.config["ASYNC_INDEXING"] = True
+
+    def get_tasks(self):
+        return [(t.object_type, t.object_id, t.op, t.propagate) for t in IndexingTask.query.order_by(IndexingTask.id)]
+
+    def drain(self, worker, errors=()):
+        """ Run the worker against a _bulk API rejecting the given document ids """
+        with self.app.test_request_context(base_url="http://localhost"), \
+                mock.patch.object(self.app.elasticsearch, "bulk",
+                                  side_effect=lambda operations: bulk_response(operations, errors)) as bulk:
+            nb_done, failed = worker.drain_once()
+        return nb_done, failed, bulk
+
+    def test_outbox(self):
+        doc = Document.query.get(1)
+        doc.title = "New title"
+        person = Person(label="New person")
+        db.session.add(person)
+        witness = Witness.query.filter(Witness.document_id == 2).first()
+        db.session.delete(witness)
+        with mock.patch("app.api.search.SearchIndexManager.add_to_index") as add_to_index:
+            db.session.commit()
+        add_to_index.assert_not_called()
+
+        tasks = self.get_tasks()
+        self.assertIn(("document", 1, "update", True), tasks)
+        self.assertIn(("person", person.id, "insert", True), tasks)
+        # the documents of a deleted resource are collected before the flush
+        self.assertIn(("witness", witness.id, "delete", True), tasks)
+        self.assertIn(("document", 2, "update", False), tasks)
+
+        # the routes only write into the queue
+        db.session.query(IndexingTask).delete()
+        db.session.commit()
+        with mock.patch("app.api.search.SearchIndexManager.add_to_index") as add_to_index:
+            r, status, resource = self.api_patch("documents/3", data={
+                "data": {"id": 3, "type": "document", "attributes": {"title": "Patched"}}
+            }, auth_username=User.query.first().username)
+        self.assert200(r)
+        add_to_index.assert_not_called()
+        self.assertEqual([("document", 3, "update", True)], self.get_tasks())
+
+    def test_coalescing(self):
+        for title in ("a", "b", "c"):
+            Document.query.get(1).title = title
+            db.session.commit()
+        Document.query.get(2).title = "d"
+        db.session.commit()
+        self.assertEqual(4, len(self.get_tasks()))
+
+        with mock.patch.object(self.app.count_stats, "update") as count_stats_update:
+            nb_done, failed, bulk = self.drain(IndexingWorker("http://localhost"))
+        self.assertEqual((2, {}), (nb_done, failed))
+        self.assertEqual([], self.get_tasks())
+
+        # a single _bulk request, each document being written once from its current state
+        self.assertEqual(1, bulk.call_count)
+        operations = bulk.call_args[1]["operations"]
+        index = DocumentFacade.get_index_name()
+        actions = [o["index"] for o in operations if "index" in o]
+        self.assertEqual([(index, "1"), (index, "2")], [(a["_index"], a["_id"]) for a in actions])
+        self.assertEqual("c", operations[1]["title"])
+        # the /count stats follow the documents sent
+        self.assertEqual(["1", "2"], [c[0][0] for c in count_stats_update.call_args_list])
+
+    def test_retry(self):
+        worker = IndexingWorker("http://localhost", retry_delay=5, max_retry_delay=12)
+        self.assertEqual([5, 10, 12, 12], [worker.get_retry_delay(attempts) for attempts in range(1, 5)])
+
+        Document.query.get(1).title = "a"
+        Document.query.get(2).title = "b"
+        db.session.commit()
+
+        before = datetime.datetime.now()
+        nb_done, failed, bulk = self.drain(worker, errors=("1",))
+        self.assertEqual(1, nb_done)
+        self.assertEqual({("document", 1): "rejected"}, failed)
+        task = IndexingTask.query.one()
+        self.assertEqual((1, 1, "rejected"), (task.object_id, task.attempts, task.last_error))
+        self.assertGreaterEqual(task.next_attempt_at, before + datetime.timedelta(seconds=5))
+
+        # not retried before the delay
+        self.assertEqual((0, {}), self.drain(worker)[:2])
+
+        # the delay doubles with the attempts
+        task.next_attempt_at = before
+        db.session.commit()
+        self.drain(worker, errors=("1",))
+        task = IndexingTask.query.one()
+        self.assertEqual(2, task.attempts)
+        self.assertGreaterEqual(task.next_attempt_at, before + datetime.timedelta(seconds=10))
+
+        # a transport error fails every task of the request
+        task.next_attempt_at = before
+        db.session.commit()
+        with self.app.test_request_context(base_url="http://localhost"), \
+                mock.patch.object(self.app.elasticsearch, "bulk", side_effect=ConnectionError("unreachable")):
+            self.assertEqual((0, {("document", 1): "unreachable"}), worker.drain_once())
+        self.assertEqual(3, IndexingTask.query.one().attempts)
+
+        task = IndexingTask.query.one()
+        task.next_attempt_at = before
+        db.session.commit()
+        self.assertEqual((1, {}), self.drain(worker)[:2])
+        self.assertEqual([], self.get_tasks())
+
+
+if __name__ == '__main__':
+    unittest.main()
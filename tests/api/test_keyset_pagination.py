@@ -0,0 +1,91 @@
+import datetime
+import unittest
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy import asc, desc
+
+from app import db
+from app.api.pagination import decode_cursor, encode_cursor, get_keyset_columns
+from app.models import Changelog, Document
+from tests.base_server import TestBaseServer
+
+
+class TestKeysetPagination(TestBaseServer):
+
+    CREATIONS = {1: "1750-03-01", 2: "1750-01-01", 3: None, 4: "1750-01-01", 5: None}
+
+    def load_fixtures(self):
+        from tests.data.fixtures.dataset001 import load_fixtures as load_dataset001
+        with self.app.app_context():
+            load_dataset001(db)
+            for doc in Document.query.all():
+                doc.creation = self.CREATIONS.get(doc.id, "1760-01-%02d" % (20 - doc.id))
+            db.session.commit()
+
+    def get_pages(self, url):
+        """ Follow the next links from the first page """
+        pages = []
+        r, status, resource = self.api_get(url)
+        while True:
+            self.assert200(r)
+            pages.append(resource)
+            if "next" not in resource["links"]:
+                return pages
+            r, status, resource = self.api_get(resource["links"]["next"], absolute=True)
+
+    def get_expected_ids(self, reverse):
+        creations = {doc.id: doc.creation for doc in Document.query.all()}
+        dated = sorted((c_id for c_id in creations if creations[c_id] is not None),
+                       key=lambda c_id: (creations[c_id], -c_id if reverse else c_id), reverse=reverse)
+        not_dated = sorted(c_id for c_id in creations if creations[c_id] is None)
+        # the ties are broken by the id, the NULLs come first in ascending order, last in descending order
+        return dated + not_dated if reverse else not_dated + dated
+
+    def test_ascending(self):
+        pages = self.get_pages("documents?sort=creation&page[after]=&page[size]=3&without-relationships")
+        self.assertEqual([3, 3, 3, 1], [len(page["data"]) for page in pages])
+        self.assertEqual(self.get_expected_ids(reverse=False), [d["id"] for page in pages for d in page["data"]])
+        self.assertEqual([3, 5, 2, 4], [d["id"] for page in pages for d in page["data"]][:4])
+        # no total count unless requested
+        self.assertNotIn("meta", pages[0])
+
+    def test_descending(self):
+        pages = self.get_pages("documents?sort=-creation&page[after]=&page[size]=4&without-relationships")
+        self.assertEqual([4, 4, 2], [len(page["data"]) for page in pages])
+        self.assertEqual(self.get_expected_ids(reverse=True), [d["id"] for page in pages for d in page["data"]])
+        self.assertEqual([3, 5], [d["id"] for d in pages[-1]["data"]])
+
+    def test_links(self):
+        r, status, resource = self.api_get("documents?page[after]=&page[size]=4&meta[count]=exact")
+        self.assertEqual(10, resource["meta"]["total-count"])
+        self.assertIn("page%5Bafter%5D=&", resource["links"]["first"])
+        self.assertNotIn("page%5Bnumber%5D", resource["links"]["next"])
+
+        # the cursor of the next page holds the sort values and the id of the last resource
+        keyset_columns = get_keyset_columns(Document, [(Document.creation, asc)])
+        pages = self.get_pages("documents?sort=creation&page[after]=&page[size]=4")
+        for page in pages[:-1]:
+            last = Document.query.get(page["data"][-1]["id"])
+            cursor = parse_qs(urlparse(page["links"]["next"]).query)["page[after]"][0]
+            self.assertEqual([last.creation, last.id], decode_cursor(cursor, keyset_columns))
+        self.assertNotIn("next", pages[-1]["links"])
+
+    def test_cursor(self):
+        keyset_columns = get_keyset_columns(Changelog, [(Changelog.event_date, desc)])
+        self.assertEqual([("event_date", desc), ("id", asc)], [(c.key, d) for c, d in keyset_columns])
+        obj = SimpleNamespace(event_date=datetime.datetime(1750, 1, 2, 3, 4, 5), id=7)
+        self.assertEqual([obj.event_date, 7], decode_cursor(encode_cursor(obj, keyset_columns), keyset_columns))
+        obj.event_date = None
+        self.assertEqual([None, 7], decode_cursor(encode_cursor(obj, keyset_columns), keyset_columns))
+
+        # a cursor built for other sort columns
+        with self.assertRaises(ValueError):
+            decode_cursor(encode_cursor(obj, keyset_columns), keyset_columns[1:])
+        for cursor in ("abc", encode_cursor(obj, keyset_columns)):
+            r, status, resource = self.api_get("documents?sort=creation,title&page[after]=%s" % cursor)
+            self.assert400(r)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import time
+import unittest
+
+from app.api.manifest.cache import MISSING, MemoryManifestCache, SQLiteManifestCache
+from app.api.manifest.manifest_factory import ManifestFactory
+
+MANIFEST_URL = "https://gallica.bnf.fr/iiif/ark:/12148/btv1b0000/manifest.json"
+
+
+def make_manifest(width=1000):
+    return {"sequences": [{"canvases": [
+        {"@id": "https://gallica.bnf.fr/iiif/ark:/12148/btv1b0000/canvas/f1", "width": width, "height": 800,
+         "images": [{"resource": {"width": width, "height": 800}}]}
+    ]}]}
+
+
+class StubManifestFactory(ManifestFactory):
+    """ answers the fetches with the given responses (exceptions are raised) """
+
+    def __init__(self, responses, **kwargs):
+        super(StubManifestFactory, self).__init__(**kwargs)
+        self.responses = responses
+        self.fetched = []
+
+    def _fetch(self, url):
+        self.fetched.append(url)
+        response = self.responses[url]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class TestManifestCache(unittest.TestCase):
+
+    def test_expiration(self):
+        cache = MemoryManifestCache(ttl=0.05)
+        cache.set(MANIFEST_URL, make_manifest())
+        self.assertEqual(make_manifest(), cache.get(MANIFEST_URL))
+        time.sleep(0.06)
+        self.assertIs(MISSING, cache.get(MANIFEST_URL))
+        self.assertEqual({"hits": 1, "misses": 1}, {k: cache.stats[k] for k in ("hits", "misses")})
+
+    def test_negative_caching(self):
+        cache = MemoryManifestCache(ttl=60, negative_ttl=0.05)
+        cache.set(MANIFEST_URL, None)
+        self.assertIsNone(cache.get(MANIFEST_URL))
+        time.sleep(0.06)
+        self.assertIs(MISSING, cache.get(MANIFEST_URL))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = MemoryManifestCache(maxsize=2)
+        cache.set("a", {"a": 1})
+        cache.set("b", {"b": 1})
+        cache.get("a")
+        cache.set("c", {"c": 1})
+        self.assertIs(MISSING, cache.get("b"))
+        self.assertEqual({"a": 1}, cache.get("a"))
+        self.assertEqual({"c": 1}, cache.get("c"))
+
+    def test_sqlite_cache_is_shared(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "manifest_cache.sqlite")
+            SQLiteManifestCache(path).set(MANIFEST_URL, make_manifest())
+            cache = SQLiteManifestCache(path, maxsize=1)
+            self.assertEqual(make_manifest(), cache.get(MANIFEST_URL))
+            cache.set("https://example.org/manifest.json", None)
+            self.assertEqual(1, len(cache))
+            self.assertIsNone(cache.get("https://example.org/manifest.json"))
+
+    def test_failed_fetch_is_not_retried(self):
+        factory = StubManifestFactory({MANIFEST_URL: ValueError("not json")})
+        canvas_ids = ["https://gallica.bnf.fr/iiif/ark:/12148/btv1b0000/canvas/f1"]
+        self.assertEqual([], factory.fetch_canvas(MANIFEST_URL, canvas_ids, cache=True))
+        self.assertEqual([], factory.fetch_canvas(MANIFEST_URL, canvas_ids, cache=True))
+        self.assertEqual([MANIFEST_URL], factory.fetched)
+
+    def test_corrected_dimensions_are_cached(self):
+        info_url = "https://gallica.bnf.fr/iiif/ark:/12148/btv1b0000/f1/info.json"
+        factory = StubManifestFactory({MANIFEST_URL: make_manifest(width=-1),
+                                       info_url: {"width": 1200, "height": 900}})
+        canvas_ids = ["https://gallica.bnf.fr/iiif/ark:/12148/btv1b0000/canvas/f1"]
+        for i in range(2):
+            canvases = factory.fetch_canvas(MANIFEST_URL, canvas_ids, cache=True)
+            self.assertEqual((1200, 900), (canvases[0]["width"], canvases[0]["height"]))
+        self.assertEqual([MANIFEST_URL, info_url], factory.fetched)
+
+
+if __name__ == '__main__':
+    unittest.main()
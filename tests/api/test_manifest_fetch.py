@@ -0,0 +1,70 @@
+import time
+import unittest
+
+from app.api.http import HTTPClient
+from app.api.manifest.cache import MemoryManifestCache
+from app.api.manifest.manifest_factory import ManifestFactory
+from tests.data.fixtures.iiif_stub_server import IIIFStubServer
+
+DELAY = 0.3
+
+
+class TestManifestFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.server = IIIFStubServer(delay=DELAY).start()
+        self.factory = ManifestFactory(cache=MemoryManifestCache(), timeout=5, max_workers=8)
+
+    def tearDown(self):
+        self.factory.executor.shutdown()
+        self.server.stop()
+
+    def test_manifests_are_fetched_concurrently(self):
+        grouped_canvas_ids = dict(self.server.add_manifest("ms%s" % i) for i in range(4))
+
+        start = time.perf_counter()
+        grouped_canvases = self.factory.fetch_canvases(grouped_canvas_ids, cache=True)
+        duration = time.perf_counter() - start
+
+        self.assertLess(duration, 2 * DELAY)
+        self.assertEqual(list(grouped_canvas_ids), list(grouped_canvases))
+        for url, canvas_ids in grouped_canvas_ids.items():
+            self.assertEqual(canvas_ids, [c["@id"] for c in grouped_canvases[url]])
+
+    def test_invalid_dimensions_are_fetched_concurrently(self):
+        grouped_canvas_ids = dict(self.server.add_manifest("ms%s" % i, nb_canvases=3, invalid_dimensions=True)
+                                  for i in range(2))
+
+        start = time.perf_counter()
+        grouped_canvases = self.factory.fetch_canvases(grouped_canvas_ids, cache=True)
+        duration = time.perf_counter() - start
+
+        # one round trip for the manifests, one for the 6 info.json
+        self.assertLess(duration, 3 * DELAY)
+        for canvases in grouped_canvases.values():
+            self.assertEqual([(1001, 1501), (1002, 1502), (1003, 1503)],
+                             [(c["width"], c["height"]) for c in canvases])
+            self.assertEqual((1001, 1501), (canvases[0]["images"][0]["resource"]["width"],
+                                            canvases[0]["images"][0]["resource"]["height"]))
+
+        # the corrected manifests are cached
+        nb_requests = len(self.server.requested)
+        self.factory.fetch_canvases(grouped_canvas_ids, cache=True)
+        self.assertEqual(nb_requests, len(self.server.requested))
+
+    def test_unreachable_manifest(self):
+        manifest_url, canvas_ids = self.server.add_manifest("ms")
+        missing_url = self.server.url + "/missing/manifest.json"
+        grouped_canvases = self.factory.fetch_canvases({missing_url: [], manifest_url: canvas_ids}, cache=True)
+        self.assertEqual([], grouped_canvases[missing_url])
+        self.assertEqual(canvas_ids, [c["@id"] for c in grouped_canvases[manifest_url]])
+
+    def test_timeout(self):
+        manifest_url, canvas_ids = self.server.add_manifest("ms")
+        factory = ManifestFactory(cache=MemoryManifestCache(), timeout=DELAY / 3, http=HTTPClient(max_retries=0))
+        self.assertEqual([], factory.fetch_canvas(manifest_url, canvas_ids))
+        factory.executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import unittest
+from collections import Counter
+from types import SimpleNamespace
+from unittest import mock
+
+from app import db
+from app.api.document.facade import DocumentFacade
+from app.api.operations import make_request, OperationError, OperationsBatch
+from app.models import Document, Institution, TRADITION_VALUES, User, Witness, WITNESS_STATUS_VALUES
+from tests.base_server import TestBaseServer
+
+
+class StubFacade(object):
+
+    def __init__(self, type, id, propagated=(), removed=()):
+        self.TYPE = type
+        self.MODEL = type
+        self.obj = SimpleNamespace(id=id)
+        self.propagated = list(propagated)
+        self.removed = list(removed)
+
+    def get_propagated_resource_identifiers(self):
+        return self.propagated
+
+    def get_data_to_index_when_removed(self, propagate):
+        return self.removed
+
+
+class TestOperations(unittest.TestCase):
+
+    def test_add(self):
+        method, path, body, lid = make_request({"op": "add", "data": {
+            "type": "witness", "lid": "w", "attributes": {"num": 1},
+            "relationships": {"document": {"data": {"type": "document", "lid": "d"}}}
+        }}, {"d": 11}, "1.0")
+        self.assertEqual(("POST", "/api/1.0/witnesses", "w"), (method, path, lid))
+        self.assertEqual({"type": "witness", "attributes": {"num": 1},
+                          "relationships": {"document": {"data": {"type": "document", "id": 11}}}}, body["data"])
+
+    def test_update_and_remove(self):
+        self.assertEqual(
+            ("PATCH", "/api/1.0/documents/11", {"data": {"type": "document", "id": 11, "attributes": {}}}, None),
+            make_request({"op": "update", "data": {"type": "document", "lid": "d", "attributes": {}}}, {"d": 11}, "1.0")
+        )
+        self.assertEqual(("DELETE", "/api/1.0/notes/7", None, None),
+                         make_request({"op": "remove", "ref": {"type": "note", "id": "7"}}, {}, "1.0"))
+
+    def test_relationship(self):
+        method, path, body, lid = make_request({
+            "op": "add", "ref": {"type": "document", "lid": "d", "relationship": "collections"},
+            "data": [{"type": "collection", "id": "3"}]
+        }, {"d": 11}, "1.0")
+        self.assertEqual(("POST", "/api/1.0/documents/11/relationships/collections"), (method, path))
+        self.assertEqual({"data": [{"type": "collection", "id": "3"}]}, body)
+
+    def test_errors(self):
+        for operation in ({"op": "replace"},
+                          {"op": "add", "ref": {"type": "document", "lid": "unknown", "relationship": "notes"},
+                           "data": []},
+                          {"op": "remove", "ref": {"type": "document"}}):
+            with self.assertRaises(OperationError):
+                make_request(operation, {}, "1.0")
+        with self.assertRaises(OperationError) as cm:
+            make_request({"op": "add", "data": {"type": "unknown"}}, {}, "1.0")
+        self.assertEqual(404, cm.exception.status)
+
+    def test_batch_records_each_resource_once(self):
+        batch = OperationsBatch()
+        document = {"type": "document", "id": 11}
+        batch.record(StubFacade("witness", 31, propagated=[document]), "insert")
+        batch.record(StubFacade("document", "11"), "update")
+        batch.record(StubFacade("person-has-role", 5, propagated=[{"type": "person", "id": 3}]), "insert")
+        batch.record(StubFacade("document", 12, removed=[{"index": "documents", "id": 12}]), "delete")
+
+        self.assertEqual([("witness", "31"), ("document", "11"), ("person-has-role", "5"), ("person", "3"),
+                          ("document", "12")], list(batch.affected))
+        self.assertEqual({("documents", "12"): 12}, dict(batch.removed))
+
+
+class TestOperationsRoute(TestBaseServer):
+
+    def load_fixtures(self):
+        from tests.data.fixtures.dataset001 import load_fixtures as load_dataset001
+        with self.app.app_context():
+            load_dataset001(db)
+
+    def post_operations(self, operations):
+        """ :return: the response and the (index, id) of the calls to add_to_index """
+        with mock.patch("app.api.search.SearchIndexManager.add_to_index") as add_to_index, \
+                mock.patch("app.api.search.SearchIndexManager.remove_from_index"), \
+                mock.patch.object(self.app.iiif_store_builder, "schedule"):
+            r, status, resource = self.api_post("operations", data={"atomic:operations": operations},
+                                                auth_username=User.query.first().username)
+        return r, resource, [(c[1]["index"], str(c[1]["id"])) for c in add_to_index.call_args_list]
+
+    @staticmethod
+    def add_witness(document_id, **institution):
+        return {"op": "add", "data": {
+            "type": "witness",
+            "attributes": {"content": "Witness", "tradition": TRADITION_VALUES[0], "status": WITNESS_STATUS_VALUES[0]},
+            "relationships": dict({"document": {"data": {"type": "document", "id": document_id}}},
+                                  **({"institution": {"data": dict(institution, type="institution")}}
+                                     if institution else {}))
+        }}
+
+    def test_rollback(self):
+        title = Document.query.get(1).title
+        nb_witnesses = Witness.query.count()
+        nb_institutions = Institution.query.count()
+
+        r, resource, indexed = self.post_operations([
+            {"op": "update", "data": {"type": "document", "id": "1", "attributes": {"title": "Updated"}}},
+            {"op": "add", "data": {"type": "institution", "lid": "i", "attributes": {"name": "ABC"}}},
+            self.add_witness(1, lid="i"),
+            {"op": "update", "data": {"type": "document", "id": "9999", "attributes": {"title": "Missing"}}},
+        ])
+        self.assert404(r)
+        self.assertEqual("/atomic:operations/3", resource["errors"][0]["source"]["pointer"])
+
+        # none of the operations applied before the failed one is kept, nothing is reindexed
+        db.session.expire_all()
+        self.assertEqual(title, Document.query.get(1).title)
+        self.assertEqual(nb_witnesses, Witness.query.count())
+        self.assertEqual(nb_institutions, Institution.query.count())
+        self.assertEqual([], indexed)
+
+    def test_reindex_once(self):
+        r, resource, indexed = self.post_operations([
+            {"op": "update", "data": {"type": "document", "id": "1", "attributes": {"title": "A"}}},
+            {"op": "update", "data": {"type": "document", "id": "1", "attributes": {"title": "B"}}},
+            self.add_witness(1),
+            {"op": "add", "data": {"type": "institution", "lid": "i", "attributes": {"name": "ABC"}}},
+            self.add_witness(2, lid="i"),
+            {"op": "update", "data": {"type": "document", "id": "2", "attributes": {"title": "C"}}},
+        ])
+        self.assert200(r)
+        self.assertEqual(6, len(resource["atomic:results"]))
+        self.assertEqual("B", Document.query.get(1).title)
+
+        # each affected document is written once into the index, after the commit
+        index = DocumentFacade.get_index_name()
+        self.assertEqual(Counter({(index, "1"): 1, (index, "2"): 1}), Counter(key for key in indexed if key[0] == index))
+        # as well as the created witnesses and institution
+        self.assertEqual(5, len(indexed))
+        self.assertEqual(len(indexed), len(set(indexed)))
+
+
+if __name__ == '__main__':
+    unittest.main()
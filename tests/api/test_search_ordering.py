@@ -0,0 +1,91 @@
+import random
+import time
+import unittest
+from collections import OrderedDict, namedtuple
+
+from app.api.route_registrar import JSONAPIRouteRegistrar
+
+FakeFacade = namedtuple("FakeFacade", ("id", "resource"))
+
+# pages of 5k search results
+NB_RESULTS = 5000
+# the durations are compared between NB_RESULTS / SCALE and NB_RESULTS results rather than against
+# a fixed bound: a linear implementation takes about SCALE times longer, the former quadratic ones
+# about SCALE ** 2 times longer
+SCALE = 8
+MAX_RATIO = 3 * SCALE
+
+
+def make_results(nb):
+    ids = list(range(1, nb + 1))
+    random.shuffle(ids)
+    sorted_ids_list = [str(i) for i in ids]
+    facade_objs = [FakeFacade(i, {"type": "document", "id": i}) for i in range(1, nb + 1)]
+    return facade_objs, sorted_ids_list
+
+
+def make_included(nb):
+    # every result includes 3 persons, the number of distinct persons grows with the number of results
+    return [[{"type": "person", "id": random.randint(1, nb)} for _ in range(3)] for _ in range(nb)]
+
+
+def merge_all(included):
+    included_resources = OrderedDict()
+    for included_res in included:
+        JSONAPIRouteRegistrar.merge_included_resources(included_resources, included_res)
+    return included_resources
+
+
+def measure(func, *args):
+    """ The best of 3 runs, less sensitive to the load of the machine """
+    durations = []
+    for _ in range(3):
+        start = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+class TestSearchOrdering(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.facade_objs, self.sorted_ids_list = make_results(NB_RESULTS)
+
+    def test_sort_by_ids(self):
+        sorted_facade_objs = JSONAPIRouteRegistrar.sort_by_ids(self.facade_objs, self.sorted_ids_list)
+        self.assertEqual(self.sorted_ids_list, [str(f.id) for f in sorted_facade_objs])
+
+    def test_sort_by_ids_duplicated_id(self):
+        # an id listed twice is placed at its first occurrence, the facade is not repeated
+        facade_objs = [FakeFacade(1, None), FakeFacade(2, None)]
+        sorted_facade_objs = JSONAPIRouteRegistrar.sort_by_ids(facade_objs, ["2", "1", "2"])
+        self.assertEqual([2, 1], [f.id for f in sorted_facade_objs])
+
+    def test_sort_by_ids_unknown_id(self):
+        with self.assertRaises(ValueError):
+            JSONAPIRouteRegistrar.sort_by_ids([FakeFacade(NB_RESULTS + 1, None)], self.sorted_ids_list)
+
+    def test_sort_by_ids_scales_linearly(self):
+        small = measure(JSONAPIRouteRegistrar.sort_by_ids, *make_results(NB_RESULTS // SCALE))
+        large = measure(JSONAPIRouteRegistrar.sort_by_ids, *make_results(NB_RESULTS))
+        self.assertLess(large, MAX_RATIO * small)
+
+    def test_merge_included_resources(self):
+        included = make_included(NB_RESULTS)
+        expected, seen = [], set()
+        for included_res in included:
+            for res in included_res:
+                if (res["type"], res["id"]) not in seen:
+                    seen.add((res["type"], res["id"]))
+                    expected.append(res)
+        self.assertEqual(expected, list(merge_all(included).values()))
+
+    def test_merge_included_resources_scales_linearly(self):
+        small = measure(merge_all, make_included(NB_RESULTS // SCALE))
+        large = measure(merge_all, make_included(NB_RESULTS))
+        self.assertLess(large, MAX_RATIO * small)
+
+
+if __name__ == '__main__':
+    unittest.main()
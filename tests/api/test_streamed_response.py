@@ -0,0 +1,39 @@
+import json
+import unittest
+
+from flask import Flask
+
+from app.api.response_factory import JSONAPIResponseFactory
+
+
+def iter_resources(nb, failing_at=None):
+    for i in range(nb):
+        if i == failing_at:
+            raise AttributeError("'NoneType' object has no attribute 'label'")
+        yield {"type": "document", "id": i}
+
+
+class TestStreamedResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def get_document(self, resources):
+        with self.app.test_request_context():
+            response = JSONAPIResponseFactory.make_streamed_data_response(resources, None, None, {"total-count": 3})
+            return json.loads(response.get_data())
+
+    def test_complete(self):
+        document = self.get_document(iter_resources(3))
+        self.assertEqual([0, 1, 2], [r["id"] for r in document["data"]])
+        self.assertNotIn("errors", document)
+
+    def test_interrupted(self):
+        # the body stays valid json, the error follows the resources already sent
+        document = self.get_document(iter_resources(3, failing_at=2))
+        self.assertEqual([0, 1], [r["id"] for r in document["data"]])
+        self.assertEqual(500, document["errors"][0]["status"])
+
+
+if __name__ == '__main__':
+    unittest.main()
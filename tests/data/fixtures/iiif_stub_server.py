@@ -0,0 +1,84 @@
+"""
+Local stub of a remote IIIF server (eg. Gallica), serving manifests and the info.json of their
+folios after a configurable delay
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class IIIFStubServer(object):
+
+    def __init__(self, delay=0.0):
+        """ :param delay: seconds waited before answering each request """
+        self.delay = delay
+        self.documents = {}  # path -> json served
+        self.failures = {}  # path -> number of 503 responses sent before the document
+        self.requested = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return "http://{host}:{port}".format(host=host, port=port)
+
+    def add_manifest(self, name, nb_canvases=2, invalid_dimensions=False):
+        """
+        Serve the manifest {url}/{name}/manifest.json and the info.json of its folios
+        :return: (manifest url, canvas ids)
+        """
+        base_url = "{url}/{name}".format(url=self.url, name=name)
+        width, height = (-1, -1) if invalid_dimensions else (1000, 1500)
+        canvases = []
+        for i in range(1, nb_canvases + 1):
+            canvas_id = "{base_url}/canvas/f{i}".format(base_url=base_url, i=i)
+            canvases.append({
+                "@id": canvas_id, "@type": "sc:Canvas", "width": width, "height": height,
+                "thumbnail": {"@id": "{base_url}/f{i}/full/,128/0/native.jpg".format(base_url=base_url, i=i)},
+                "images": [{"resource": {"width": width, "height": height}}]
+            })
+            self.documents["/{name}/f{i}/info.json".format(name=name, i=i)] = {"width": 1000 + i, "height": 1500 + i}
+        self.documents["/{name}/manifest.json".format(name=name)] = {
+            "@id": "{base_url}/manifest.json".format(base_url=base_url),
+            "sequences": [{"canvases": canvases}]
+        }
+        return "{base_url}/manifest.json".format(base_url=base_url), [c["@id"] for c in canvases]
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.requested.append(self.path)
+                if stub.delay:
+                    threading.Event().wait(stub.delay)
+                with stub.lock:
+                    failing = stub.failures.get(self.path, 0) > 0
+                    if failing:
+                        stub.failures[self.path] -= 1
+                document = stub.documents.get(self.path) if not failing else None
+                body = json.dumps(document).encode("utf-8") if document is not None else b"not found"
+                self.send_response(200 if document is not None else 503 if failing else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()